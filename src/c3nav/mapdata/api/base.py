@@ -1,5 +1,7 @@
 import json
 import time
+from copy import copy
+from dataclasses import dataclass, field
 from functools import wraps
 from typing import Optional
 
@@ -7,21 +9,53 @@ from django.conf import settings
 from django.core.cache import cache
 from django.core.serializers.json import DjangoJSONEncoder
 from django.db.models import Prefetch
-from django.utils.cache import get_conditional_response
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response, patch_vary_headers
 from django.utils.http import quote_etag
 from django.utils.translation import get_language
 from ninja.decorators import decorate_view
 
+from c3nav.mapdata.api.snapshots import APISnapshots
 from c3nav.mapdata.models import AccessRestriction, Building, Door, LocationGroup, MapUpdate, Space
 from c3nav.mapdata.models.access import AccessPermission
 from c3nav.mapdata.models.geometry.base import GeometryMixin
 from c3nav.mapdata.models.locations import SpecificLocation
 from c3nav.mapdata.utils.cache.local import LocalCacheProxy
 from c3nav.mapdata.utils.cache.stats import increment_cache_key
+from c3nav.mapdata.utils.compression import choose_encoding, encode_content, get_encodings
 
 request_cache = LocalCacheProxy(maxsize=settings.CACHE_SIZE_API)
 
 
+@dataclass(frozen=True)
+class CachedAPIResponse:
+    """
+    A rendered API response as it is stored in the request cache: only the body, pre-compressed with all configured
+    encodings, and its content type. Cheap to pickle and to turn back into a response.
+    """
+    content: bytes
+    content_type: str
+    encoded: dict[str, bytes] = field(default_factory=dict)
+
+    @classmethod
+    def from_response(cls, response) -> "CachedAPIResponse":
+        return cls(
+            content=response.content,
+            content_type=response['Content-Type'],
+            encoded=encode_content(response.content, get_encodings()),
+        )
+
+    def to_response(self, request) -> HttpResponse:
+        encoding = choose_encoding(request, self.encoded.keys())
+        response = HttpResponse(self.content if encoding is None else self.encoded[encoding],
+                                content_type=self.content_type)
+        if encoding is not None:
+            response['Content-Encoding'] = encoding
+        if self.encoded:
+            patch_vary_headers(response, ('Accept-Encoding', ))
+        return response
+
+
 def api_etag(permissions=True, quests=False, etag_func=AccessPermission.etag_func, base_mapdata=False,
              etag_add_key: Optional[tuple[str, str]] = None):
 
@@ -30,11 +64,13 @@ def api_etag(permissions=True, quests=False, etag_func=AccessPermission.etag_fun
         def outer_wrapped_func(request, *args, **kwargs):
             response = func(request, *args, **kwargs)
             if response.status_code == 200:
+                if request._target_cache_key and not response.streaming and not hasattr(response, "wsgi_request"):
+                    cached_response = CachedAPIResponse.from_response(response)
+                    request_cache.set(request._target_cache_key, cached_response, 900)
+                    response = cached_response.to_response(request)
                 if request._target_etag:
                     response['ETag'] = request._target_etag
                 response['Cache-Control'] = 'no-cache'
-                if request._target_cache_key and not hasattr(response, "wsgi_request"):
-                    request_cache.set(request._target_cache_key, response, 900)
             return response
         return outer_wrapped_func
 
@@ -61,7 +97,8 @@ def api_etag(permissions=True, quests=False, etag_func=AccessPermission.etag_fun
                 raw_etag += ':%d' % etag_add
 
 
-            etag = quote_etag(raw_etag)
+            # weak, because the same ETag is used for every content-coding of the response
+            etag = 'W/' + quote_etag(raw_etag)
 
             response = get_conditional_response(request, etag)
             if response:
@@ -80,18 +117,26 @@ def api_etag(permissions=True, quests=False, etag_func=AccessPermission.etag_fun
                     value = model_dump()
                 data[name] = value
 
-            cache_key = 'mapdata:api:%s:%s:%s' % (
+            cache_key = 'mapdata:api:response:%s:%s:%s' % (
                 request.resolver_match.route.replace('/', '-').strip('-'),
                 raw_etag,
                 json.dumps(data, separators=(',', ':'), sort_keys=True, cls=DjangoJSONEncoder),
             )
 
             request._target_cache_key = cache_key
+            request._api_cache_key = cache_key
 
-            response = request_cache.get(cache_key)
+            # responses for the public permission set might have been written to disk after the map update
+            response = APISnapshots.get_response(request, MapUpdate.current_cache_key(), cache_key)
             if response is not None:
                 return response
 
+            cached_response = request_cache.get(cache_key)
+            if cached_response is not None:
+                # don't store it again on the way out
+                request._target_cache_key = None
+                return cached_response.to_response(request)
+
             with GeometryMixin.dont_keep_originals():
                 return func(request, *args, **kwargs)
 
@@ -133,6 +178,13 @@ def api_stats_clean_location_value(value):
     return (value, )
 
 
+def without_geometry(obj):
+    # locations are shared between requests through the location index, so they are copied instead of changed
+    obj = copy(obj)
+    obj._hide_geometry = True
+    return obj
+
+
 def can_access_geometry(request, obj):
     if isinstance(obj, Space):
         return obj.base_mapdata_accessible or request.user_permissions.can_access_base_mapdata
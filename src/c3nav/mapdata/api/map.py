@@ -19,7 +19,7 @@ from c3nav.api.auth import auth_permission_responses, auth_responses, validate_r
 from c3nav.api.exceptions import API404, APIPermissionDenied, APIRequestValidationFailed
 from c3nav.api.schema import BaseSchema
 from c3nav.api.utils import NonEmptyStr
-from c3nav.mapdata.api.base import api_etag, api_stats, can_access_geometry
+from c3nav.mapdata.api.base import api_etag, api_stats, can_access_geometry, without_geometry
 from c3nav.mapdata.grid import DummyGrid, grid
 from c3nav.mapdata.models import Source, Theme, Area, Space
 from c3nav.mapdata.models.geometry.space import ObstacleGroup, Obstacle, RangingBeacon, AutoBeaconMeasurement, \
@@ -36,7 +36,8 @@ from c3nav.mapdata.schemas.models import (AnyPositionStatusSchema, FullListableL
 from c3nav.mapdata.schemas.responses import LocationGeometry, WithBoundsSchema, MapSettingsSchema
 from c3nav.mapdata.utils.geometry import unwrap_geom
 from c3nav.mapdata.utils.locations import (get_location_by_id_for_request, get_location_by_slug_for_request,
-                                           searchable_locations_for_request, visible_locations_for_request)
+                                           search_locations_for_request, searchable_locations_for_request,
+                                           visible_locations_for_request)
 from c3nav.mapdata.utils.user import can_access_editor
 
 map_api_router = APIRouter(tags=["map"])
@@ -89,11 +90,10 @@ def _location_list(request, filters: LocationListFilters):
     else:
         locations = visible_locations_for_request(request).values()
 
-    for location in locations:
-        if not filters.geometry or not can_access_geometry(request, location):
-            location._hide_geometry = True
-
-    return locations
+    return [
+        location if filters.geometry and can_access_geometry(request, location) else without_geometry(location)
+        for location in locations
+    ]
 
 
 @map_api_router.get('/locations/', summary="list locations (slim)",
@@ -114,6 +114,32 @@ def location_list_full(request, filters: Query[LocationListFilters]):
     return _location_list(request, filters=filters)
 
 
+class LocationSearchParameters(RemoveGeometryFilter):
+    q: NonEmptyStr = APIField(
+        title="search query",
+        description="words to search for in titles, slugs and groups of locations, the last one may be incomplete"
+    )
+    limit: int = APIField(
+        20,
+        ge=1,
+        le=100,
+        title="maximum number of results",
+    )
+
+
+@map_api_router.get('/locations/search/', summary="search locations",
+                    description=("Search searchable locations, best matches first\n\n"
+                                 "Possible location types:\n"+listable_location_definitions),
+                    response={200: list[SlimListableLocationSchema], **validate_responses, **auth_responses})
+def location_search(request, parameters: Query[LocationSearchParameters]):
+    locations = search_locations_for_request(request, parameters.q, limit=parameters.limit)
+
+    return [
+        location if parameters.geometry and can_access_geometry(request, location) else without_geometry(location)
+        for location in locations
+    ]
+
+
 def _location_retrieve(request, location, detailed: bool, geometry: bool, show_redirects: bool):
     if location is None:
         raise API404()
@@ -128,7 +154,7 @@ def _location_retrieve(request, location, detailed: bool, geometry: bool, show_r
         request._target_cache_key = None
 
     if not geometry or not can_access_geometry(request, location):
-        location._hide_geometry = True
+        location = without_geometry(location)
 
     return location
 
@@ -0,0 +1,167 @@
+import hashlib
+import json
+import logging
+import os
+from dataclasses import dataclass
+from shutil import rmtree
+from typing import Optional
+from wsgiref.util import FileWrapper
+
+from django.conf import settings
+from django.http import StreamingHttpResponse
+from django.utils.cache import patch_vary_headers
+
+from c3nav.mapdata.utils.compression import choose_encoding, encode_content, encoders, get_encodings
+
+try:
+    from asgiref.local import Local as LocalContext
+except ImportError:
+    from threading import local as LocalContext
+
+logger = logging.getLogger('c3nav')
+
+
+@dataclass(frozen=True)
+class APISnapshot:
+    name: str
+    content_type: str
+    encodings: tuple[str, ...]
+
+
+class APISnapshots:
+    """
+    Responses of the heaviest read-only API endpoints for the public permission set, written to
+    CACHE_ROOT/<update>/api/ after each map update, uncompressed and pre-compressed with every available encoding.
+    They are stored by the request cache key of api_etag, so they are only found for requests that would get the
+    exact same response, and are served with the same weak ETag, whatever encoding is chosen.
+    """
+    cached = LocalContext()
+
+    def __init__(self, snapshots: dict[str, APISnapshot]):
+        self.snapshots = snapshots
+
+    @staticmethod
+    def get_path(update_cache_key: str):
+        return settings.CACHE_ROOT / update_cache_key / 'api'
+
+    @classmethod
+    def open(cls, update_cache_key: str) -> Optional["APISnapshots"]:
+        try:
+            with (cls.get_path(update_cache_key) / 'index.json').open('r') as f:
+                index = json.load(f)
+        except FileNotFoundError:
+            return None
+        return cls({cache_key: APISnapshot(name=snapshot['name'], content_type=snapshot['content_type'],
+                                           encodings=tuple(snapshot['encodings']))
+                    for cache_key, snapshot in index.items()})
+
+    @classmethod
+    def open_cached(cls, update_cache_key: str) -> Optional["APISnapshots"]:
+        if getattr(cls.cached, 'key', None) != update_cache_key:
+            snapshots = cls.open(update_cache_key)
+            if snapshots is None:
+                # the snapshots for a new update are written some time after it was created, so don't remember that
+                # they are missing, the failed open() is cheap enough to just try again on the next request
+                return None
+            cls.cached.key = update_cache_key
+            cls.cached.data = snapshots
+        return cls.cached.data
+
+    @classmethod
+    def get_response(cls, request, update_cache_key: str, cache_key: str) -> Optional[StreamingHttpResponse]:
+        if not settings.API_SNAPSHOTS:
+            return None
+        snapshots = cls.open_cached(update_cache_key)
+        if snapshots is None:
+            return None
+        snapshot = snapshots.snapshots.get(cache_key, None)
+        if snapshot is None:
+            return None
+
+        encoding = choose_encoding(request, snapshot.encodings)
+        filename = cls.get_path(update_cache_key) / (snapshot.name if encoding is None
+                                                     else '%s.%s' % (snapshot.name, encoding))
+        try:
+            size = filename.stat().st_size
+            f = filename.open('rb')
+        except FileNotFoundError:
+            # a newer snapshot replaced this one, the request is simply answered without it
+            return None
+
+        response = StreamingHttpResponse(FileWrapper(f), content_type=snapshot.content_type)
+        # The next 2 lines cause django to use the wsgi.file_wrapper if provided by the wsgi server.
+        response.file_to_stream = f
+        response.block_size = 8192
+        response['Content-Length'] = size
+        if encoding is not None:
+            response['Content-Encoding'] = encoding
+        if snapshot.encodings:
+            patch_vary_headers(response, ('Accept-Encoding', ))
+        return response
+
+    @classmethod
+    def build(cls, update_cache_key: str):
+        """
+        Request all snapshot endpoints as an anonymous user in every language and write the responses to disk.
+        """
+        from django.test.client import Client
+        from django.test.utils import override_settings
+
+        from c3nav.mapdata.api.mapdata import mapdata_api_router
+        from c3nav.mapdata.models import Theme
+
+        api_paths = [
+            '/api/v2/map/locations/full/',
+            '/api/v2/map/bounds/',
+            '/api/v2/map/settings/',
+            *('/api/v2/map/legend/%d/' % theme_id for theme_id in (0, *Theme.objects.values_list('pk', flat=True))),
+            # all mapdata list endpoints
+            *('/api/v2/mapdata%s' % path for path, path_view in mapdata_api_router.path_operations.items()
+              if '{' not in path and any('GET' in operation.methods for operation in path_view.operations)),
+        ]
+        encodings = get_encodings() or tuple(encoders.keys())
+
+        path = cls.get_path(update_cache_key)
+        tmp_path = path.with_name('api.tmp')
+        rmtree(tmp_path, ignore_errors=True)
+        tmp_path.mkdir(parents=True)
+
+        index = {}
+        client = Client()
+        # the test client always uses testserver as host name
+        with override_settings(ALLOWED_HOSTS=['testserver']):
+            for language in sorted(settings.SELECTED_LANGUAGES):
+                for api_path in api_paths:
+                    response = client.get(api_path, headers={'X-API-Key': 'anonymous', 'Accept-Language': language})
+                    if response.status_code != 200:
+                        logger.warning('Could not create API snapshot for %s (%s)' % (api_path, language))
+                        continue
+                    cache_key = getattr(response.wsgi_request, '_api_cache_key', None)
+                    if cache_key is None:
+                        # endpoints without api_etag are not cached, so there can't be a snapshot for them either
+                        continue
+
+                    content = response.getvalue()
+                    name = hashlib.sha256(cache_key.encode()).hexdigest()[:32]
+                    (tmp_path / name).write_bytes(content)
+                    encoded = encode_content(content, encodings)
+                    for encoding, encoded_content in encoded.items():
+                        (tmp_path / ('%s.%s' % (name, encoding))).write_bytes(encoded_content)
+                    index[cache_key] = {
+                        'name': name,
+                        'content_type': response['Content-Type'],
+                        'encodings': [encoding for encoding in encodings if encoding in encoded],
+                    }
+
+        with (tmp_path / 'index.json').open('w') as f:
+            json.dump(index, f)
+
+        rmtree(path, ignore_errors=True)
+        os.rename(tmp_path, path)
+
+        # snapshots of older updates will never be served again
+        for old_path in settings.CACHE_ROOT.glob('*/api'):
+            if old_path != path:
+                rmtree(old_path, ignore_errors=True)
+
+        logger.info('%d API snapshots created.' % len(index))
@@ -7,7 +7,7 @@ from django.utils.translation import ngettext
 
 from c3nav.mapdata.models import AccessRestriction, Level, Source
 from c3nav.mapdata.models.theme import Theme
-from c3nav.mapdata.render.engines import get_engine, get_engine_filetypes
+from c3nav.mapdata.render.engines import SVGEngine, get_engine, get_engine_filetypes
 from c3nav.mapdata.render.renderer import MapRenderer
 
 
@@ -130,8 +130,8 @@ class Command(BaseCommand):
             filename = settings.RENDER_ROOT / ('%s.%s' % (name, options['filetype']))
 
             if options['filetype'] == 'svg':
-                engine, index = get_engine('png')
-                render = renderer.render(engine, options['theme'], center=not options['no_center'],
+                # not registered if another image renderer is configured
+                render = renderer.render(SVGEngine, options['theme'], center=not options['no_center'],
                                          force_transparent_background=options['transparent_bg'])
                 data = render.get_xml().encode()
             else:
@@ -0,0 +1,97 @@
+import argparse
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.translation import gettext as _
+from django.utils.translation import ngettext
+
+from c3nav.mapdata.models import AccessRestriction, Level, MapUpdate
+from c3nav.mapdata.render.seed import seed_tiles
+
+
+class Command(BaseCommand):
+    help = 'pre-render map tiles into the tile cache'
+
+    @staticmethod
+    def levels_value(value):
+        if value == '*':
+            return None
+
+        values = set(v for v in value.split(',') if v)
+        levels = Level.objects.filter(on_top_of__isnull=True, level_index__in=values)
+
+        not_found = values - set(level.level_index for level in levels)
+        if not_found:
+            raise argparse.ArgumentTypeError(
+                ngettext('Unknown level: %s', 'Unknown levels: %s', len(not_found)) % ', '.join(not_found)
+            )
+
+        return set(level.pk for level in levels)
+
+    @staticmethod
+    def zooms_value(value):
+        try:
+            zooms = tuple(int(v) for v in value.split(',') if v)
+        except ValueError:
+            raise argparse.ArgumentTypeError(_('Invalid zoom'))
+
+        if not all((-2 <= zoom <= 5) for zoom in zooms):
+            raise argparse.ArgumentTypeError(_('Zoom has to be between -2 and 5'))
+
+        return zooms
+
+    @staticmethod
+    def permissions_value(value) -> frozenset[int]:
+        if value == '*':
+            return frozenset(AccessRestriction.get_all())
+        if value == '0':
+            # like the tile view without a tile access cookie
+            return frozenset()
+
+        values = set(v for v in value.split(',') if v)
+        permissions = set(permission.pk for permission in AccessRestriction.objects.all().filter(pk__in=values))
+
+        not_found = values - set(map(str, permissions))
+        if not_found:
+            raise argparse.ArgumentTypeError(
+                ngettext('Unknown access restriction: %s',
+                         'Unknown access restrictions: %s', len(not_found)) % ', '.join(not_found)
+            )
+
+        return frozenset(permissions)
+
+    def add_arguments(self, parser):
+        parser.add_argument('--zooms', default=settings.TILE_SEED_ZOOMS or (-2, -1, 0, 1, 2, 3),
+                            type=self.zooms_value,
+                            help=_('zoom levels to render, e.g. 0,1,2 (default: tile_seed_zooms or -2 to 3)'))
+        parser.add_argument('--formats', default=','.join(settings.TILE_SEED_FORMATS),
+                            help=_('formats to render, e.g. png,webp (default: tile_seed_formats)'))
+        parser.add_argument('--levels', default='*', type=self.levels_value,
+                            help=_('levels to render, e.g. 0,1,2 or * for all levels (default)'))
+        parser.add_argument('--permissions', action='append', type=self.permissions_value,
+                            help=_('permissions to render tiles for, e.g. 2,3 or * for all permissions or 0 for '
+                                   'public, can be given multiple times (default: public, the permissions needed '
+                                   'for each restricted level and tile_seed_permissions)'))
+        parser.add_argument('--since', default=None, type=int,
+                            help=_('only render tiles that changed after the map update with this id'))
+        parser.add_argument('--processes', default=settings.TILE_SEED_PROCESSES, type=int,
+                            help=_('number of processes to render tiles in (default: tile_seed_processes)'))
+
+    def handle(self, *args, **options):
+        if not settings.CACHE_TILES:
+            raise CommandError(_('Tile caching is disabled.'))
+
+        formats = tuple(ext for ext in options['formats'].split(',') if ext)
+        if not formats or set(formats) - {'png', 'webp'}:
+            raise CommandError(_('Formats have to be png or webp.'))
+
+        since = None
+        if options['since'] is not None:
+            try:
+                since = MapUpdate.objects.get(pk=options['since']).to_tuple
+            except MapUpdate.DoesNotExist:
+                raise CommandError(_('Unknown map update: %s') % options['since'])
+
+        seed_tiles(zooms=options['zooms'], formats=formats,
+                   access_permissions=options['permissions'],
+                   since=since, levels=options['levels'], processes=options['processes'])
@@ -37,6 +37,10 @@ if settings.METRICS:
         name_registry: dict[str, None | Sequence[str]] = dict()
 
         def collect(self):
+            # increments buffered by other processes will show up in a later scrape
+            from c3nav.mapdata.utils.cache.stats import stats_buffer
+            stats_buffer.flush()
+
             metrics: dict[str, CounterMetricFamily] = dict()
             if settings.CACHES['default']['BACKEND'] == 'django.core.cache.backends.redis.RedisCache':
                 client = cache._cache.get_client()
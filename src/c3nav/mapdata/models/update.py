@@ -14,7 +14,7 @@ from django.utils.timezone import make_naive
 from django.utils.translation import gettext_lazy as _
 from shapely.ops import unary_union
 
-from c3nav.mapdata.tasks import process_map_updates, delete_map_cache_key
+from c3nav.mapdata.tasks import build_api_snapshots, delete_map_cache_key, process_map_updates, seed_tiles
 from c3nav.mapdata.utils.cache.changes import GeometryChangeTracker
 from c3nav.mapdata.utils.cache.local import per_request_cache
 from c3nav.mapdata.utils.cache.types import MapUpdateTuple
@@ -222,6 +222,11 @@ class MapUpdate(models.Model):
 
             last_geometry_update = ([None] + [update for update in new_updates if update.geometries_changed])[-1]
 
+            last_processed_update = cls.last_processed_update(force=True, lock=False)
+
+            # geometries changed since the last processed update, by level. None means everything changed.
+            router_changed_geometries = {}
+
             if last_geometry_update is not None:
                 geometry_update_cache_key = MapUpdate.build_cache_key(*last_geometry_update.to_tuple)
                 (settings.CACHE_ROOT / geometry_update_cache_key).mkdir(exist_ok=True)
@@ -236,10 +241,9 @@ class MapUpdate(models.Model):
 
                 logger.info('%.3f m² of altitude areas affected.' % changed_geometries.area)
 
-                last_processed_update = cls.last_processed_update(force=True, lock=False)
-
                 purging_updates = [new_update.to_tuple for new_update in new_updates if new_update.purge_all_cache]
                 num_purges = 0
+                changes_missing = False
 
                 for new_update in new_updates:
                     logger.info('Applying changed geometries from MapUpdate #%(id)s (%(type)s)...' %
@@ -253,6 +257,7 @@ class MapUpdate(models.Model):
 
                         if new_changes is None:
                             logger.warning('changed_geometries pickle file not found.')
+                            changes_missing = True
                         else:
                             if new_update.purge_all_cache:
                                 # delete changed geometries of that update
@@ -267,11 +272,17 @@ class MapUpdate(models.Model):
 
                     except EOFError:
                         logger.warning('changed_geometries pickle file corrupted.')
+                        changes_missing = True
 
                 if purging_updates:
                     logger.info('Cache completely purged. After purge update,')
                 logger.info('%.3f m² of geometries affected in total.' % changed_geometries.area)
 
+                if not purging_updates and not changes_missing:
+                    router_changed_geometries = changed_geometries.get_geometries_by_level()
+                else:
+                    router_changed_geometries = None
+
                 purge_levels = ()
                 if purging_updates:
                     from c3nav.mapdata.models import Level
@@ -292,12 +303,18 @@ class MapUpdate(models.Model):
                     lambda: per_request_cache.set('mapdata:last_processed_geometry_update',
                                               last_geometry_update.to_tuple, None)
                 )
+
+                # the map history includes purges, so this covers everything that needs to be rendered again
+                transaction.on_commit(
+                    lambda: seed_tiles.delay(since=last_processed_update)
+                )
             else:
                 logger.info('No geometries affected.')
 
             logger.info('Rebuilding router...')
             from c3nav.routing.router import Router
-            router = Router.rebuild(new_updates[-1].to_tuple)
+            router = Router.rebuild(new_updates[-1].to_tuple, changed_geometries=router_changed_geometries,
+                                    previous_update=last_processed_update)
 
             logger.info('Rebuilding locator...')
             from c3nav.routing.locator import Locator
@@ -311,6 +328,15 @@ class MapUpdate(models.Model):
                 lambda: cache.set('mapdata:last_processed_update', new_updates[-1].to_tuple, None)
             )
 
+            from c3nav.routing.tasks import warm_router_cache
+            transaction.on_commit(
+                lambda: warm_router_cache.delay(update=new_updates[-1].to_tuple)
+            )
+
+            transaction.on_commit(
+                lambda: build_api_snapshots.delay(update=new_updates[-1].to_tuple)
+            )
+
             return new_updates
 
     def save(self, **kwargs):
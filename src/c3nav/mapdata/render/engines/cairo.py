@@ -0,0 +1,183 @@
+import math
+from typing import Optional
+
+import numpy as np
+from PIL import Image
+from scipy.ndimage import gaussian_filter
+from shapely.affinity import translate
+from shapely.geometry import LineString, Polygon
+
+from c3nav.mapdata.render.engines.base import FillAttribs, RenderEngine, StrokeAttribs
+from c3nav.mapdata.render.engines.svg import (empty_tile_png, encode_formats, encode_image, png_to_webp,
+                                              unwrap_hybrid_geom)
+
+try:
+    import cairocffi as cairo
+except ImportError:
+    import cairo
+
+
+class CairoEngine(RenderEngine):
+    """
+    Draws the geometries directly onto a cairo image surface, without generating an SVG document first.
+    Produces the same images as the SVGEngine, including the blurred shadows.
+    """
+    filetype = ('png', 'webp')
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        # for fast numpy operations, the buffer is part of the offset
+        self.np_scale = np.array((self.scale, -self.scale))
+        self.np_offset = np.array((-self.minx * self.scale + self.buffer, self.maxy * self.scale + self.buffer))
+
+        self.surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, self.buffered_width, self.buffered_height)
+        self.context = cairo.Context(self.surface)
+        self.context.set_source_rgba(*self.background_rgb)
+        self.context.paint()
+        self.context.set_fill_rule(cairo.FILL_RULE_WINDING)  # svg default (nonzero)
+        self.context.set_miter_limit(4)  # svg default
+        self.empty = True
+
+        self._create_geometry_cache = {}
+
+    def render(self, ext: Optional[str] = None) -> tuple[bytes, bytes] | bytes:
+        # render the image to png and webp, or only to the given format
+        if self.width == 256 and self.height == 256 and self.empty:
+            png = empty_tile_png(self.background_rgb)
+            return encode_formats(ext, png=lambda: png, webp=lambda: png_to_webp(png))
+
+        self.surface.flush()
+        # cairo stores premultiplied native-endian ARGB
+        img = Image.frombuffer('RGBA', (self.buffered_width, self.buffered_height), bytes(self.surface.get_data()),
+                               'raw', 'BGRa', self.surface.get_stride(), 1)
+        img = img.crop((self.buffer, self.buffer, self.buffer + self.width, self.buffer + self.height))
+        if len(self.background_rgb) < 4 or self.background_rgb[3] >= 1:
+            img = img.convert('RGB')
+
+        return encode_formats(ext, png=lambda: encode_image(img, 'png'), webp=lambda: encode_image(img, 'webp'))
+
+    def _geometry_to_shapes(self, geom) -> list[list[tuple[np.ndarray, bool]]]:
+        # scale and move geometry and split it into shapes, each a list of (pixel coordinates, closed) paths
+        if isinstance(geom, Polygon):
+            return [[(np.array(ring.coords)*self.np_scale+self.np_offset, True)
+                     for ring in (geom.exterior, *geom.interiors)]]
+        if isinstance(geom, LineString):
+            return [[(np.array(geom.coords)*self.np_scale+self.np_offset, False)]]
+        try:
+            geoms = geom.geoms
+        except AttributeError:
+            return []
+        return [shape for g in geoms for shape in self._geometry_to_shapes(g)]
+
+    def _create_geometry(self, geometry, cache_key=None):
+        result = None
+        if cache_key is not None:
+            result = self._create_geometry_cache.get(cache_key, None)
+        if result is None:
+            result = self._geometry_to_shapes(geometry)
+            if cache_key is not None:
+                self._create_geometry_cache[cache_key] = result
+        return result
+
+    @staticmethod
+    def _append_path(context, shape):
+        for coords, closed in shape:
+            coords = coords.tolist()
+            context.move_to(*coords[0])
+            for x, y in coords[1:]:
+                context.line_to(x, y)
+            if closed:
+                context.close_path()
+
+    def _draw_shapes(self, shapes, fill_rgba=None, stroke_rgba=None, stroke_width=None):
+        # like in svg, every shape is filled and then stroked before the next one is drawn
+        context = self.context
+        for shape in shapes:
+            context.new_path()
+            self._append_path(context, shape)
+            if fill_rgba is not None:
+                context.set_source_rgba(*fill_rgba)
+                context.fill_preserve()
+            if stroke_rgba is not None:
+                context.set_source_rgba(*stroke_rgba)
+                context.set_line_width(stroke_width)
+                context.stroke_preserve()
+        context.new_path()
+        self.empty = False
+
+    def add_shadow(self, geometry, elevation, color):
+        # add a shadow for the given geometry with the given elevation
+        elevation = float(min(elevation, 2))
+        blur_radius = elevation / 3 * 0.25
+        sigma = blur_radius * self.scale
+
+        shadow_geom = translate(geometry.buffer(blur_radius),
+                                xoff=(elevation / 3 * 0.12), yoff=-(elevation / 3 * 0.12))
+        shapes = self._geometry_to_shapes(shadow_geom)
+        if not shapes:
+            return
+
+        # only rasterize and blur the area of the image that the shadow can reach
+        coords = np.vstack([coords for shape in shapes for coords, closed in shape])
+        margin = math.ceil(sigma * 3) + 1
+        x0, y0 = (max(0, int(i) - margin) for i in coords.min(axis=0))
+        x1 = min(self.buffered_width, int(math.ceil(coords[:, 0].max())) + margin)
+        y1 = min(self.buffered_height, int(math.ceil(coords[:, 1].max())) + margin)
+        if x0 >= x1 or y0 >= y1:
+            return
+
+        mask = cairo.ImageSurface(cairo.FORMAT_A8, x1 - x0, y1 - y0)
+        mask_context = cairo.Context(mask)
+        mask_context.set_fill_rule(cairo.FILL_RULE_WINDING)
+        mask_context.translate(-x0, -y0)
+        for shape in shapes:
+            self._append_path(mask_context, shape)
+        mask_context.fill()
+        mask.flush()
+
+        if sigma > 0:
+            alpha = np.ndarray((y1 - y0, mask.get_stride()), dtype=np.uint8, buffer=mask.get_data())[:, :x1 - x0]
+            alpha[:] = np.rint(gaussian_filter(alpha.astype(np.float32), sigma, mode='constant'))
+            mask.mark_dirty()
+
+        r, g, b, a = self.color_to_rgb(color or '#000')
+        self.context.set_source_rgba(r, g, b, a * 0.2)
+        self.context.mask_surface(mask, x0, y0)
+        self.empty = False
+
+    def darken(self, area, much=False):
+        if area:
+            self.add_geometry(geometry=area, fill=FillAttribs('#000000', 0.4 if much else 0.1), category='darken')
+
+    def _add_geometry(self, geometry, fill: Optional[FillAttribs], stroke: Optional[StrokeAttribs],
+                      altitude=None, height=None, shadow_color=None, shape_cache_key=None, **kwargs):
+        geometry = self.buffered_bbox.intersection(unwrap_hybrid_geom(geometry))
+
+        if geometry.is_empty:
+            return
+
+        fill_rgba = None
+        if fill:
+            fill_rgba = self.color_to_rgb(fill.color)
+            if fill.opacity:
+                fill_rgba = (*fill_rgba[:3], fill_rgba[3] * fill.opacity)
+
+        if altitude is not None and stroke is None:
+            stroke = StrokeAttribs('rgba(0, 0, 0, 0.15)', 0.05, min_px=0.2)
+
+        stroke_rgba = None
+        stroke_width = None
+        if stroke:
+            stroke_width = stroke.width*self.scale
+            if stroke.min_px:
+                stroke_width = max(stroke_width, stroke.min_px)
+            stroke_rgba = self.color_to_rgb(stroke.color)
+            if stroke.opacity:
+                stroke_rgba = (*stroke_rgba[:3], stroke_rgba[3] * stroke.opacity)
+
+        if height is not None:
+            self.add_shadow(geometry, height, shadow_color)
+
+        self._draw_shapes(self._create_geometry(geometry, cache_key=shape_cache_key),
+                          fill_rgba=fill_rgba, stroke_rgba=stroke_rgba, stroke_width=stroke_width)
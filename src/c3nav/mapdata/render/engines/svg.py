@@ -3,7 +3,7 @@ import re
 import subprocess
 import zlib
 from itertools import chain
-from typing import Optional
+from typing import Callable, Optional
 
 import numpy as np
 from PIL import Image
@@ -51,12 +51,48 @@ def check_svg_renderer(app_configs, **kwargs):
     return errors
 
 
+def empty_tile_png(background_rgb) -> bytes:
+    # create empty 256x256 tile png with minimal size, indexed color palette with only one entry
+    plte = b'PLTE' + bytearray(tuple(int(i*255) for i in background_rgb))
+    return (
+        b'\x89PNG\r\n\x1a\n' +
+        b'\x00\x00\x00\rIHDR\x00\x00\x01\x00\x00\x00\x01\x00\x01\x03\x00\x00\x00f\xbc:%\x00\x00\x00\x03' +
+        plte + zlib.crc32(plte).to_bytes(4, byteorder='big') +
+        b'\x00\x00\x00\x1fIDATh\xde\xed\xc1\x01\r\x00\x00\x00\xc2\xa0\xf7Om\x0e7\xa0\x00\x00\x00\x00\x00' +
+        b'\x00\x00\x00\xbe\r!\x00\x00\x01\x7f\x19\x9c\xa7\x00\x00\x00\x00IEND\xaeB`\x82'
+    )
+
+
 webp_kwargs = {
     **({"quality": settings.WEBP_QUALITY} if settings.WEBP_QUALITY < 100 else {"lossless": True}),
     "method": 6,
 }
 
 
+def encode_image(img: Image.Image, ext: str) -> bytes:
+    f = io.BytesIO()
+    if ext == 'webp':
+        img.save(f, 'WEBP', **webp_kwargs)
+    else:
+        img.save(f, 'PNG')
+    return f.getvalue()
+
+
+def png_to_webp(png: bytes) -> bytes:
+    # png is lossless, so this gives the same result as encoding the webp directly
+    return encode_image(Image.open(io.BytesIO(png)), 'webp')
+
+
+def encode_formats(ext: Optional[str], png: Callable[[], bytes],
+                   webp: Callable[[], bytes]) -> tuple[bytes, bytes] | bytes:
+    # only encode the requested format, or both if no format was requested
+    if ext == 'png':
+        return png()
+    if ext == 'webp':
+        return webp()
+    return png(), webp()
+
+
 class SVGEngine(RenderEngine):
     filetype = ('png', 'svg')
 
@@ -103,32 +139,12 @@ class SVGEngine(RenderEngine):
         result += '</svg>'
         return result
 
-    def render(self) -> tuple[bytes, bytes]:
-        # render the image to png and webp. returns bytes if f is None, otherwise it calls f.write()
+    def render(self, ext: Optional[str] = None) -> tuple[bytes, bytes] | bytes:
+        # render the image to png and webp, or only to the given format
 
         if self.width == 256 and self.height == 256 and not self.g:
-            # create empty tile png with minimal size, indexed color palette with only one entry
-
-            f_png = io.BytesIO()
-
-            plte = b'PLTE' + bytearray(tuple(int(i*255) for i in self.background_rgb))
-            f_png.write(
-                b'\x89PNG\r\n\x1a\n' +
-                b'\x00\x00\x00\rIHDR\x00\x00\x01\x00\x00\x00\x01\x00\x01\x03\x00\x00\x00f\xbc:%\x00\x00\x00\x03' +
-                plte + zlib.crc32(plte).to_bytes(4, byteorder='big') +
-                b'\x00\x00\x00\x1fIDATh\xde\xed\xc1\x01\r\x00\x00\x00\xc2\xa0\xf7Om\x0e7\xa0\x00\x00\x00\x00\x00' +
-                b'\x00\x00\x00\xbe\r!\x00\x00\x01\x7f\x19\x9c\xa7\x00\x00\x00\x00IEND\xaeB`\x82'
-            )
-
-            # write webp  TODO: this should be simplifyable as well
-            f_webp = io.BytesIO()
-            f_png.seek(0)
-            Image.open(f_png).save(f_webp, "webp", **webp_kwargs)
-
-            f_png.seek(0)
-            f_webp.seek(0)
-
-            return f_png.read(), f_webp.read()
+            png = empty_tile_png(self.background_rgb)
+            return encode_formats(ext, png=lambda: png, webp=lambda: png_to_webp(png))
 
         if settings.SVG_RENDERER == 'rsvg':
             # create buffered surfaces
@@ -141,7 +157,7 @@ class SVGEngine(RenderEngine):
             svg.render_cairo(buffered_context)
 
             # create cropped image
-            surface = buffered_surface.create_similar(cairo.CONTENT_COLOR_ALPHA, self.width, self.height)
+            surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, self.width, self.height)
             context = cairo.Context(surface)
 
             # set background color
@@ -151,19 +167,18 @@ class SVGEngine(RenderEngine):
             # paste buffered immage with offset
             context.set_source_surface(buffered_surface, -self.buffer, -self.buffer)
             context.paint()
+            surface.flush()
 
-            f_png = io.BytesIO()
-            surface.write_to_png(f_png)
-
-            # write webp
-            f_webp = io.BytesIO()
-            f_png.seek(0)
-            Image.open(f_png).save(f_webp, "webp", **webp_kwargs)
+            def render_png():
+                f_png = io.BytesIO()
+                surface.write_to_png(f_png)
+                return f_png.getvalue()
 
-            f_png.seek(0)
-            f_webp.seek(0)
-
-            return f_png.read(), f_webp.read()
+            # no need to go through png for webp, cairo stores premultiplied native-endian ARGB
+            return encode_formats(ext, png=render_png, webp=lambda: encode_image(
+                Image.frombuffer('RGBA', (self.width, self.height), bytes(surface.get_data()),
+                                 'raw', 'BGRa', surface.get_stride(), 1), 'webp'
+            ))
 
         elif settings.SVG_RENDERER == 'rsvg-convert':
             p = subprocess.run(('rsvg-convert', '-b', self.background, '--format', 'png'),
@@ -174,16 +189,7 @@ class SVGEngine(RenderEngine):
                             self.buffer + self.width,
                             self.buffer + self.height))
 
-            f_png = io.BytesIO()
-            img.save(f_png, 'PNG')
-
-            f_webp = io.BytesIO()
-            img.save(f_webp, 'WEBP', **webp_kwargs)
-
-            f_png.seek(0)
-            f_webp.seek(0)
-
-            return f_png.read(), f_webp.read()
+            return encode_formats(ext, png=lambda: encode_image(img, 'png'), webp=lambda: encode_image(img, 'webp'))
 
         elif settings.SVG_RENDERER == 'inkscape':
             p = subprocess.run(('inkscape', '-z', '-b', self.background, '-e', '/dev/stderr', '/dev/stdin'),
@@ -191,12 +197,7 @@ class SVGEngine(RenderEngine):
                                check=True)
             png: bytes = p.stderr[p.stderr.index(b'\x89PNG'):]  # noqa
 
-            # write webp
-            f_webp = io.BytesIO()
-            Image.open(io.BytesIO(png)).save(f_webp, "webp", **webp_kwargs)
-            f_webp.seek(0)
-
-            return png, f_webp.read()
+            return encode_formats(ext, png=lambda: png, webp=lambda: png_to_webp(png))
 
     def _trim_decimals(self, data):
         # remove trailing zeros from a decimal – yes this is slow, but it greatly speeds up cairo rendering
@@ -99,7 +99,7 @@ class HybridGeometry:
         return HybridGeometry(geom, tuple(faces_i)), vertices, faces
 
     def union(self, other):
-        add_faces = self.add_faces
+        add_faces = dict(self.add_faces)
         for crop_id, faces in other.add_faces.items():
             add_faces[crop_id] = add_faces.get(crop_id, ())+faces
         return HybridGeometry(geom=self.geom.union(other.geom), faces=self.faces+other.faces, add_faces=add_faces,
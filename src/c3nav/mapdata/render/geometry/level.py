@@ -1,16 +1,17 @@
 import operator
 import typing
 from collections import Counter, deque
-from dataclasses import dataclass
+from dataclasses import dataclass, replace
 from functools import reduce
 from itertools import chain
 
 import numpy as np
-from shapely import prepared, box
+import shapely
+from shapely import prepared, box, STRtree
 from shapely.geometry import GeometryCollection, Polygon, MultiPolygon
 from shapely.ops import unary_union
 
-from c3nav.mapdata.models import Space, Level, AltitudeArea, Source
+from c3nav.mapdata.models import Space, Level, AltitudeArea, Source, Area, Obstacle, LineObstacle
 from c3nav.mapdata.render.geometry.altitudearea import AltitudeAreaGeometries
 from c3nav.mapdata.render.geometry.hybrid import HybridGeometry
 from c3nav.mapdata.render.geometry.mesh import Mesh
@@ -115,15 +116,16 @@ class SingleLevelGeometries(BaseLevelGeometries):
         restricted_spaces_indoors: dict[int, list[ZeroOrMorePolygons]]
         restricted_spaces_outdoors: dict[int, list[ZeroOrMorePolygons]]
 
-        colors: dict[tuple, dict[int, ZeroOrMorePolygons]]
-        obstacles: dict[int, dict[str | None, list[ZeroOrMorePolygons]]]
+        # colors and obstacles depend on the theme, so we just remember which objects they belong to
+        colored_areas: list[tuple[Space | Area, int | None, ZeroOrMorePolygons]]
+        obstacles: list[tuple[int, Obstacle | LineObstacle, ZeroOrMorePolygons]]
         heightareas: dict[int, list[ZeroOrMorePolygons]]
 
         ramps: list[ZeroOrMorePolygons]
 
     @classmethod
     def analyze_spaces(cls, level: Level, spaces: list[SpaceGeometries], walkable_spaces_geom: ZeroOrMorePolygons,
-                       buildings_geom: ZeroOrMorePolygons, color_manager: 'ThemeColorManager') -> Analysis:
+                       buildings_geom: ZeroOrMorePolygons) -> Analysis:
         buildings_geom_prep = prepared.prep(buildings_geom)
 
         # keep track which areas are affected by access restrictions
@@ -134,8 +136,8 @@ class SingleLevelGeometries(BaseLevelGeometries):
         restricted_spaces_outdoors: dict[int, list[ZeroOrMorePolygons]] = {}
 
         # go through spaces and their areas for access control, ground colors, height areas and obstacles
-        colors: dict[tuple | None, dict[int, list[ZeroOrMorePolygons]]] = {}
-        obstacles: dict[int, dict[str | None, list[ZeroOrMorePolygons]]] = {}
+        colored_areas: list[tuple[Space | Area, int | None, ZeroOrMorePolygons]] = []
+        obstacles: list[tuple[int, Obstacle | LineObstacle, ZeroOrMorePolygons]] = []
         heightareas: dict[int, list[ZeroOrMorePolygons]] = {}
 
         ramps: list[ZeroOrMorePolygons] = []
@@ -160,19 +162,14 @@ class SingleLevelGeometries(BaseLevelGeometries):
                         buffered.difference(buildings_geom)
                     )
 
-            colors.setdefault(space.instance.get_color_sorted(color_manager), {}).setdefault(access_restriction,
-                                                                                             []).append(
-                unwrap_geom(space.geometry)
-            )
+            colored_areas.append((space.instance, access_restriction, unwrap_geom(space.geometry)))
 
             for area in space.instance.areas.all():  # noqa
                 access_restriction = area.access_restriction_id or space.instance.access_restriction_id
                 area.geometry = area.geometry.intersection(unwrap_geom(space.walkable_geom))
                 if access_restriction is not None:
                     access_restriction_affected.setdefault(access_restriction, []).append(area.geometry)
-                colors.setdefault(
-                    area.get_color_sorted(color_manager), {}
-                ).setdefault(access_restriction, []).append(area.geometry)
+                colored_areas.append((area, access_restriction, area.geometry))
 
             for column in space.instance.columns.all():  # noqa
                 access_restriction = column.access_restriction_id
@@ -189,38 +186,20 @@ class SingleLevelGeometries(BaseLevelGeometries):
             for obstacle in sorted(space.instance.obstacles.all(), key=lambda o: o.height + o.altitude):  # noqa
                 if not obstacle.height:
                     continue
-                obstacles.setdefault(
-                    int((obstacle.height + obstacle.altitude) * 1000), {}
-                ).setdefault(obstacle.get_color(color_manager), []).append(
-                    obstacle.geometry.intersection(unwrap_geom(space.walkable_geom))
-                )
+                obstacles.append((int((obstacle.height + obstacle.altitude) * 1000), obstacle,
+                                  obstacle.geometry.intersection(unwrap_geom(space.walkable_geom))))
 
             for lineobstacle in space.instance.lineobstacles.all():  # noqa
                 if not lineobstacle.height:
                     continue
-                obstacles.setdefault(int(lineobstacle.height * 1000), {}).setdefault(
-                    lineobstacle.get_color(color_manager), []
-                ).append(
-                    lineobstacle.buffered_geometry.intersection(unwrap_geom(space.walkable_geom))
-                )
+                obstacles.append((int(lineobstacle.height * 1000), lineobstacle,
+                                  lineobstacle.buffered_geometry.intersection(unwrap_geom(space.walkable_geom))))
 
             ramps.extend(ramp.geometry for ramp in space.instance.ramps.all())  # noqa
 
             heightareas.setdefault(int((space.instance.height or level.default_height) * 1000), []).append(
                 unwrap_geom(space.geometry)
             )
-        colors.pop(None, None)
-
-        new_colors: dict[tuple, dict[int, ZeroOrMorePolygons]] = {}
-
-        # merge ground colors
-        for color, color_group in colors.items():
-            new_color_group = {}
-            new_colors[color] = new_color_group
-            for access_restriction, areas in tuple(color_group.items()):
-                new_color_group[access_restriction] = unary_union(areas)
-
-        new_colors = {color: geometry for color, geometry in sorted(new_colors.items(), key=lambda v: v[0][0])}
 
         return cls.Analysis(
             access_restriction_affected=access_restriction_affected,
@@ -228,7 +207,7 @@ class SingleLevelGeometries(BaseLevelGeometries):
             restricted_spaces_indoors=restricted_spaces_indoors,
             restricted_spaces_outdoors=restricted_spaces_outdoors,
 
-            colors=new_colors,
+            colored_areas=colored_areas,
             obstacles=obstacles,
             heightareas=heightareas,
 
@@ -236,39 +215,76 @@ class SingleLevelGeometries(BaseLevelGeometries):
         )
     
     @classmethod
-    def build_altitudeareas(cls, level: Level, analysis: Analysis) -> list[AltitudeAreaGeometries]:
-        # add altitudegroup geometries and split ground colors into them
-        altitudearea_geoms: list[AltitudeAreaGeometries] = [] 
+    def build_altitudeareas(cls, level: Level) -> list[AltitudeAreaGeometries]:
+        # add altitudegroup geometries, ground colors and obstacles are added for each theme later
+        altitudearea_geoms: list[AltitudeAreaGeometries] = []
         for altitudearea in level.altitudeareas.all():  # noqa
             altitudearea.geometry = unwrap_geom(altitudearea.geometry).buffer(0)
-            altitudearea_prep = prepared.prep(unwrap_geom(altitudearea.geometry))
-            altitudearea_colors = {color: {access_restriction: area.intersection(unwrap_geom(altitudearea.geometry))
+            altitudearea_geoms.append(AltitudeAreaGeometries(altitudearea=altitudearea, colors={}, obstacles={}))
+        return altitudearea_geoms
+
+    @classmethod
+    def get_theme_colors(cls, analysis: Analysis, color_manager: 'ThemeColorManager') -> tuple[
+        dict[tuple, dict[int, ZeroOrMorePolygons]],
+        dict[int, dict[str | None, list[ZeroOrMorePolygons]]],
+    ]:
+        colors: dict[tuple | None, dict[int, list[ZeroOrMorePolygons]]] = {}
+        for instance, access_restriction, geometry in analysis.colored_areas:
+            colors.setdefault(instance.get_color_sorted(color_manager), {}).setdefault(access_restriction,
+                                                                                       []).append(geometry)
+        colors.pop(None, None)
+
+        # merge ground colors
+        new_colors: dict[tuple, dict[int, ZeroOrMorePolygons]] = {}
+        for color, color_group in colors.items():
+            new_color_group = {}
+            new_colors[color] = new_color_group
+            for access_restriction, areas in tuple(color_group.items()):
+                new_color_group[access_restriction] = unary_union(areas)
+
+        new_colors = {color: geometry for color, geometry in sorted(new_colors.items(), key=lambda v: v[0][0])}
+
+        obstacles: dict[int, dict[str | None, list[ZeroOrMorePolygons]]] = {}
+        for height, obstacle, geometry in analysis.obstacles:
+            obstacles.setdefault(height, {}).setdefault(obstacle.get_color(color_manager), []).append(geometry)
+
+        return new_colors, obstacles
+
+    @classmethod
+    def color_altitudeareas(cls, altitudeareas: list[AltitudeAreaGeometries], analysis: Analysis,
+                            color_manager: 'ThemeColorManager') -> list[AltitudeAreaGeometries]:
+        # split ground colors and obstacles into the altitude areas
+        colors, obstacles = cls.get_theme_colors(analysis, color_manager)
+        altitudearea_geoms: list[AltitudeAreaGeometries] = []
+        for altitudearea in altitudeareas:
+            altitudearea_prep = prepared.prep(altitudearea.geometry)
+            altitudearea_colors = {color: {access_restriction: area.intersection(altitudearea.geometry)
                                            for access_restriction, area in areas.items()
                                            if altitudearea_prep.intersects(area)}
-                                   for color, areas in analysis.colors.items()}
+                                   for color, areas in colors.items()}
             altitudearea_colors = {color: areas for color, areas in altitudearea_colors.items() if areas}
 
             altitudearea_obstacles = {}
-            for height, height_obstacles in analysis.obstacles.items():
+            for height, height_obstacles in obstacles.items():
                 new_height_obstacles = {}
                 for color, color_obstacles in height_obstacles.items():
                     new_color_obstacles = []
                     for obstacle in color_obstacles:
                         obstacle = obstacle.buffer(0)
                         if altitudearea_prep.intersects(obstacle):
-                            new_color_obstacles.append(obstacle.intersection(unwrap_geom(altitudearea.geometry)))
+                            new_color_obstacles.append(obstacle.intersection(altitudearea.geometry))
                     if new_color_obstacles:
                         new_height_obstacles[color] = new_color_obstacles
                 if new_height_obstacles:
                     altitudearea_obstacles[height] = new_height_obstacles
 
-            altitudearea_geoms.append(AltitudeAreaGeometries(
-                altitudearea=altitudearea, 
-                colors=altitudearea_colors, 
-                obstacles=altitudearea_obstacles
-            ))     
+            new_altitudearea = AltitudeAreaGeometries(colors=altitudearea_colors, obstacles=altitudearea_obstacles)
+            new_altitudearea.geometry = altitudearea.geometry
+            new_altitudearea.altitude = altitudearea.altitude
+            new_altitudearea.points = altitudearea.points
+            altitudearea_geoms.append(new_altitudearea)
         return altitudearea_geoms
-    
+
     @classmethod
     def build_short_walls(cls, altitudeareas_above,
                           walls_geom: ZeroOrMorePolygons) -> list[tuple[AltitudeArea, ZeroOrMorePolygons]]:
@@ -283,7 +299,10 @@ class SingleLevelGeometries(BaseLevelGeometries):
         return short_walls
 
     @classmethod
-    def build_for_level(cls, level: Level, color_manager: 'ThemeColorManager', altitudeareas_above):
+    def build_for_level(cls, level: Level, altitudeareas_above) -> tuple["SingleLevelGeometries", Analysis]:
+        """
+        Build the theme-independent geometries for this level, use for_theme() to add ground colors and obstacles.
+        """
         buildings_geom = unary_union([unwrap_geom(b.geometry) for b in level.buildings.all()])  # noqa
 
         # remove columns and holes from space areas
@@ -312,10 +331,9 @@ class SingleLevelGeometries(BaseLevelGeometries):
             spaces=spaces,
             walkable_spaces_geom=walkable_spaces_geom,
             buildings_geom=buildings_geom,
-            color_manager=color_manager
         )
 
-        altitudearea_geoms = cls.build_altitudeareas(level=level, analysis=analysis)
+        altitudearea_geoms = cls.build_altitudeareas(level=level)
         heightareas_geom = tuple((unary_union(geoms), height) for height, geoms in
                                  sorted(analysis.heightareas.items(), key=operator.itemgetter(0)))
 
@@ -377,7 +395,13 @@ class SingleLevelGeometries(BaseLevelGeometries):
         
         AccessRestrictionAffected.build(geoms.access_restriction_affected).save_level(level.pk, 'base')
 
-        return geoms
+        return geoms, analysis
+
+    def for_theme(self, analysis: Analysis, color_manager: 'ThemeColorManager') -> "SingleLevelGeometries":
+        """
+        Get a copy of these geometries with the ground colors and obstacles of the given theme.
+        """
+        return replace(self, altitudeareas=self.color_altitudeareas(self.altitudeareas, analysis, color_manager))
 
 
 @dataclass(slots=True)
@@ -394,6 +418,7 @@ class CompositeLevelGeometries(BaseLevelGeometries):
     walls_base: None | HybridGeometry
     walls_bottom: None | HybridGeometry
     walls_extended: None | HybridGeometry
+    render_index: None | STRtree = None
 
     def get_geometries(self):  # called on the final thing
         # omit heightareas as these are never drawn
@@ -651,3 +676,38 @@ class CompositeLevelGeometries(BaseLevelGeometries):
         # self.heightareas = None
         self.vertices = None
         self.faces = None
+
+        self.build_render_index()
+
+    def iter_obstacles(self):
+        """
+        Iterate over (color, obstacle) of all altitude areas, in the order they are rendered and indexed in.
+        """
+        for altitudearea in self.altitudeareas:
+            for height, height_obstacles in altitudearea.obstacles.items():
+                for color, color_obstacles in height_obstacles.items():
+                    for obstacle in color_obstacles:
+                        yield color, obstacle
+
+    def build_render_index(self):
+        """
+        Build a spatial index over the altitude areas, followed by the obstacles, so tile renderers only need to
+        look at the ones that are inside the tile. Only the envelopes are indexed to keep the render data small.
+        """
+        self.render_index = STRtree(shapely.envelope([
+            *(area.geometry.geom for area in self.altitudeareas),
+            *(obstacle.geom for color, obstacle in self.iter_obstacles()),
+        ]))
+
+    def query_render_index(self, geometry) -> tuple[list[int], list[int]]:
+        """
+        Get the indices of all altitude areas and of all obstacles whose bounds intersect the given geometry.
+        """
+        num_altitudeareas = len(self.altitudeareas)
+        render_index = getattr(self, 'render_index', None)
+        if render_index is None:
+            # render data pickled before the index existed, it will be there after the next map update
+            return list(range(num_altitudeareas)), list(range(sum(1 for obstacle in self.iter_obstacles())))
+        indices = np.sort(render_index.query(geometry))
+        return (indices[indices < num_altitudeareas].tolist(),
+                (indices[indices >= num_altitudeareas] - num_altitudeareas).tolist())
@@ -1,10 +1,12 @@
+from collections import OrderedDict
 from itertools import chain
+from typing import ClassVar
 
 from django.utils.functional import cached_property
 from shapely import prepared
 from shapely.geometry import box
 
-from c3nav.mapdata.models import Level, Source
+from c3nav.mapdata.models import Level, MapUpdate, Source
 from c3nav.mapdata.render.engines.base import FillAttribs, StrokeAttribs
 from c3nav.mapdata.render.geometry import hybrid_union
 from c3nav.mapdata.render.renderdata import LevelRenderData
@@ -12,8 +14,103 @@ from c3nav.mapdata.render.theme import ColorManager
 from c3nav.mapdata.render.utils import get_full_levels, get_min_altitude
 from c3nav.mapdata.utils.color import color_to_rgb, rgb_to_color
 
+try:
+    from asgiref.local import Local as LocalContext
+except ImportError:
+    from threading import local as LocalContext
+
+
+class CroppedLevelGeometries:
+    """
+    The geometries of a CompositeLevelGeometries with everything cropped that is not visible with the given access
+    permissions. These only depend on the permissions, so they are calculated once and shared between tiles.
+    Altitude areas and obstacles are cropped individually, once the first tile that contains them is rendered.
+    """
+    def __init__(self, geoms, access_permissions):
+        self.geoms = geoms
+
+        # hide indoor and outdoor rooms if their access restriction was not unlocked
+        self.add_walls = hybrid_union(tuple(area for access_restriction, area
+                                            in geoms.restricted_spaces_indoors.items()
+                                            if access_restriction not in access_permissions))
+        self.crop_areas = hybrid_union(
+            tuple(area for access_restriction, area in geoms.restricted_spaces_outdoors.items()
+                  if access_restriction not in access_permissions)
+        ).union(self.add_walls)
+
+        self.access_permissions = access_permissions
+
+        # cropped geometries by altitude area or obstacle index, only calculated once a tile needs them
+        self._altitudeareas_base = {}
+        self._altitudeareas = {}
+        self._ground_colors = {}
+        self._cropped_obstacles = {}
+
+    @staticmethod
+    def get_relevant_restrictions(geoms) -> frozenset:
+        # only these access restrictions make a difference for the given level geometries
+        return frozenset(chain(
+            geoms.restricted_spaces_indoors.keys(),
+            geoms.restricted_spaces_outdoors.keys(),
+            *(areas.keys() for altitudearea in geoms.altitudeareas for areas in altitudearea.colors.values()),
+        ))
+
+    def altitudearea_base(self, i):
+        result = self._altitudeareas_base.get(i)
+        if result is None:
+            altitudearea = self.geoms.altitudeareas[i]
+            result = (altitudearea.base.difference(self.crop_areas), altitudearea.bottom.difference(self.crop_areas))
+            self._altitudeareas_base[i] = result
+        return result
+
+    def altitudearea(self, i):
+        result = self._altitudeareas.get(i)
+        if result is None:
+            result = self.geoms.altitudeareas[i].geometry.difference(self.crop_areas)
+            self._altitudeareas[i] = result
+        return result
+
+    def ground_colors(self, i):
+        result = self._ground_colors.get(i)
+        if result is None:
+            # only select ground colors if their access restriction is unlocked
+            result = []
+            for (order, color), areas in self.geoms.altitudeareas[i].colors.items():
+                areas = tuple(area for access_restriction, area in areas.items()
+                              if access_restriction in self.access_permissions)
+                if areas:
+                    result.append((color, hybrid_union(areas)))
+            self._ground_colors[i] = result
+        return result
+
+    @cached_property
+    def _obstacles(self):
+        return tuple(self.geoms.iter_obstacles())
+
+    def obstacle(self, i):
+        result = self._cropped_obstacles.get(i)
+        if result is None:
+            color, obstacle = self._obstacles[i]
+            result = (color, obstacle.difference(self.crop_areas))
+            self._cropped_obstacles[i] = result
+        return result
+
+    @cached_property
+    def walls(self):
+        # we use all_walls instead of walls, because the short wall rendering stuff doesn't work
+        if not self.add_walls.is_empty or not self.geoms.all_walls.is_empty:
+            return self.geoms.all_walls.union(self.add_walls)
+        return None
+
+    @cached_property
+    def doors(self):
+        return self.geoms.doors.difference(self.add_walls)
+
 
 class MapRenderer:
+    cropped_geometries_cache_size: ClassVar = 256
+    cropped_geometries_cache = LocalContext()
+
     def __init__(self, level, minx, miny, maxx, maxy, scale=1, access_permissions=None, full_levels=False,
                  min_width=None):
         self.level = level.pk if isinstance(level, Level) else level
@@ -33,6 +130,27 @@ class MapRenderer:
     def bbox(self):
         return box(self.minx-1, self.miny-1, self.maxx+1, self.maxy+1)
 
+    def get_cropped_geometries(self, theme, geoms, access_permissions) -> CroppedLevelGeometries:
+        # neighboring tiles and other zoom levels need the same cropped geometries, so keep them in a small lru cache
+        cache_key = MapUpdate.current_processed_geometry_cache_key()
+        cache = self.cropped_geometries_cache
+        if getattr(cache, 'key', None) != cache_key:
+            cache.key = cache_key
+            cache.data = OrderedDict()
+
+        access_permissions = frozenset(access_permissions & CroppedLevelGeometries.get_relevant_restrictions(geoms))
+        key = (self.level, theme, geoms.pk, access_permissions)
+        result = cache.data.get(key)
+        if result is not None:
+            cache.data.move_to_end(key)
+            return result
+
+        result = CroppedLevelGeometries(geoms, access_permissions)
+        cache.data[key] = result
+        if len(cache.data) > self.cropped_geometries_cache_size:
+            cache.data.popitem(last=False)
+        return result
+
     def render(self, engine_cls, theme, center=True, force_transparent_background=False):
         color_manager = ColorManager.for_theme(theme)
         # add no access restriction to “unlocked“ access restrictions so lookup gets easier
@@ -70,22 +188,18 @@ class MapRenderer:
             if not bbox.intersects(geoms.affected_area):
                 continue
 
-            # hide indoor and outdoor rooms if their access restriction was not unlocked
-            add_walls = hybrid_union(tuple(area for access_restriction, area in geoms.restricted_spaces_indoors.items()
-                                           if access_restriction not in access_permissions))
-            crop_areas = hybrid_union(
-                tuple(area for access_restriction, area in geoms.restricted_spaces_outdoors.items()
-                      if access_restriction not in access_permissions)
-            ).union(add_walls)
+            cropped = self.get_cropped_geometries(theme, geoms, access_permissions)
+
+            # only look at altitude areas and obstacles that are inside this tile
+            altitudeareas, obstacles = geoms.query_render_index(self.bbox)
 
             if not_full_levels:
                 engine.add_geometry(geoms.walls_base, fill=FillAttribs(color_manager.wall_fill), category='walls')
                 engine.add_geometry(geoms.walls_bottom.fit(scale=geoms.min_altitude-min_altitude,
                                                            offset=min_altitude-int(0.7*1000)),
                                     fill=FillAttribs(color_manager.wall_fill), category='walls')
-                for i, altitudearea in enumerate(geoms.altitudeareas):
-                    base = altitudearea.base.difference(crop_areas)
-                    bottom = altitudearea.bottom.difference(crop_areas)
+                for i in altitudeareas:
+                    base, bottom = cropped.altitudearea_base(i)
                     engine.add_geometry(base, fill=FillAttribs(color_manager.ground_fill), category='ground', item=i)
                     engine.add_geometry(bottom.fit(scale=geoms.min_altitude - min_altitude,
                                                    offset=min_altitude - int(0.7 * 1000)),
@@ -93,52 +207,39 @@ class MapRenderer:
 
             # render altitude areas in default ground color and add ground colors to each one afterwards
             # shadows are directly calculated and added by the engine
-            for i, altitudearea in enumerate(geoms.altitudeareas):
-                geometry = altitudearea.geometry.difference(crop_areas)
+            for i in altitudeareas:
+                geometry = cropped.altitudearea(i)
                 if not_full_levels:
                     geometry = geometry.filter(bottom=False)
-                engine.add_geometry(geometry, altitude=altitudearea.altitude,
+                engine.add_geometry(geometry, altitude=geoms.altitudeareas[i].altitude,
                                     fill=FillAttribs(color_manager.ground_fill), category='ground', item=i)
 
-                j = 0
-                for (order, color), areas in altitudearea.colors.items():
-                    # only select ground colors if their access restriction is unlocked
-                    areas = tuple(area for access_restriction, area in areas.items()
-                                  if access_restriction in access_permissions)
-                    if areas:
-                        j += 1
-                        hexcolor = ''.join(hex(int(i*255))[2:].zfill(2) for i in engine.color_to_rgb(color)).upper()
-                        engine.add_geometry(hybrid_union(areas), fill=FillAttribs(color),
-                                            category='ground_%s' % hexcolor, item=j)
+                for j, (color, area) in enumerate(cropped.ground_colors(i), start=1):
+                    hexcolor = ''.join(hex(int(i*255))[2:].zfill(2) for i in engine.color_to_rgb(color)).upper()
+                    engine.add_geometry(area, fill=FillAttribs(color), category='ground_%s' % hexcolor, item=j)
 
             # add obstacles after everything related to ground for the nice right order
-            for i, altitudearea in enumerate(geoms.altitudeareas):
-                for height, height_obstacles in altitudearea.obstacles.items():
-                    for color, color_obstacles in height_obstacles.items():
-                        for obstacle in color_obstacles:
-                            obstacle_geom = obstacle.difference(crop_areas)
-                            if color:
-                                fill_rgb = color_to_rgb(color)
-                                stroke_color = rgb_to_color((*((0.75*i) for i in fill_rgb[:3]), fill_rgb[3]))
-                                engine.add_geometry(
-                                    obstacle_geom,
-                                    fill=FillAttribs(color),
-                                    stroke=StrokeAttribs(stroke_color, 0.05, min_px=0.2),
-                                    category='obstacles'
-                                )
-                            else:
-                                engine.add_geometry(
-                                    obstacle_geom,
-                                    fill=FillAttribs(color_manager.obstacles_default_fill),
-                                    stroke=StrokeAttribs(color_manager.obstacles_default_border, 0.05, min_px=0.2),
-                                    category='obstacles'
-                                )
+            for i in obstacles:
+                color, obstacle_geom = cropped.obstacle(i)
+                if color:
+                    fill_rgb = color_to_rgb(color)
+                    stroke_color = rgb_to_color((*((0.75*i) for i in fill_rgb[:3]), fill_rgb[3]))
+                    engine.add_geometry(
+                        obstacle_geom,
+                        fill=FillAttribs(color),
+                        stroke=StrokeAttribs(stroke_color, 0.05, min_px=0.2),
+                        category='obstacles'
+                    )
+                else:
+                    engine.add_geometry(
+                        obstacle_geom,
+                        fill=FillAttribs(color_manager.obstacles_default_fill),
+                        stroke=StrokeAttribs(color_manager.obstacles_default_border, 0.05, min_px=0.2),
+                        category='obstacles'
+                    )
 
             # add walls, stroke_px makes sure that all walls are at least 1px thick on all zoom levels,
-            walls = None
-            # we use all_walls instead of walls, because the short wall rendering stuff doesn't work
-            if not add_walls.is_empty or not geoms.all_walls.is_empty:
-                walls = geoms.all_walls.union(add_walls)
+            walls = cropped.walls
 
             walls_extended = geoms.walls_extended and full_levels
             if walls is not None:
@@ -157,7 +258,7 @@ class MapRenderer:
 
             doors_extended = geoms.doors_extended and full_levels
             if not geoms.doors.is_empty:
-                engine.add_geometry(geoms.doors.difference(add_walls).filter(top=not doors_extended),
+                engine.add_geometry(cropped.doors.filter(top=not doors_extended),
                                     fill=FillAttribs(color_manager.door_fill),
                                     stroke=StrokeAttribs(color_manager.door_fill, 0.05, min_px=0.2),
                                     category='doors')
@@ -0,0 +1,139 @@
+import logging
+import math
+import os
+from functools import partial
+from typing import Iterable, NamedTuple, Optional, Sequence
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections
+
+from c3nav.mapdata.utils.cache import CachePackage
+from c3nav.mapdata.utils.cache.local import per_request_cache
+from c3nav.mapdata.utils.cache.types import MapUpdateTuple
+from c3nav.mapdata.utils.processes import fork_map
+from c3nav.mapdata.utils.tiles import (build_access_cache_key, build_base_cache_key, get_tile_bounds,
+                                       get_tile_cache_directory, get_tile_cache_update_cache_key,
+                                       remove_tile_cache_directory)
+
+logger = logging.getLogger('c3nav')
+
+
+class SeedTile(NamedTuple):
+    level: int
+    zoom: int
+    x: int
+    y: int
+    theme: Optional[int]
+    access_permissions: frozenset[int]  # only the permissions relevant to this tile, like in the tile view
+
+
+def get_common_access_permissions(cache_package: CachePackage,
+                                  extra: Iterable[frozenset[int]] = ()) -> tuple[frozenset[int], ...]:
+    """
+    Get the access permission sets that tiles are commonly requested with: the public one, the ones needed to see
+    each restricted level and the given extra ones.
+    """
+    permissions = {frozenset(): None}
+    for level_data in cache_package.levels.values():
+        permissions[level_data.global_restrictions] = None
+    for extra_permissions in extra:
+        permissions[frozenset(extra_permissions)] = None
+    return tuple(permissions)
+
+
+def get_tiles_to_seed(cache_package: CachePackage, zooms: Iterable[int],
+                      access_permissions: Iterable[frozenset[int]] = (frozenset(), ),
+                      since: Optional[MapUpdateTuple] = None, levels: Optional[set[int]] = None) -> list[SeedTile]:
+    """
+    Get all tiles that intersect the map, or only those that changed after the given update.
+    """
+    tiles = {}
+    bounds_minx, bounds_miny, bounds_maxx, bounds_maxy = cache_package.bounds
+    for (level, theme), level_data in cache_package.levels.items():
+        if levels is not None and level not in levels:
+            continue
+        for zoom in zooms:
+            size = 256 / 2 ** zoom
+            for x in range(math.floor(bounds_minx / size) - 1, math.ceil(bounds_maxx / size) + 1):
+                for y in range(math.floor(-bounds_maxy / size) - 1, math.ceil(-bounds_miny / size) + 1):
+                    minx, miny, maxx, maxy = get_tile_bounds(zoom, x, y)
+                    if not cache_package.bounds_valid(minx, miny, maxx, maxy):
+                        continue
+                    if since is not None and level_data.history.last_update(minx, miny, maxx, maxy) <= tuple(since):
+                        continue
+                    tile_restrictions = (set(level_data.restrictions[minx:maxx, miny:maxy]) |
+                                         level_data.global_restrictions)
+                    for permissions in access_permissions:
+                        if not all((r in permissions) for r in level_data.global_restrictions):
+                            continue
+                        tile = SeedTile(level, zoom, x, y, theme, frozenset(permissions & tile_restrictions))
+                        tiles[tile] = None
+    return list(tiles)
+
+
+def seed_tile(tile: SeedTile, formats: Sequence[str]) -> bool:
+    """
+    Render the given tile into the tile cache, unless it is already up to date there.
+    """
+    from c3nav.mapdata.render.engines import ImageRenderEngine
+    from c3nav.mapdata.render.renderer import MapRenderer
+
+    level_data = CachePackage.open_cached().levels[(tile.level, tile.theme)]
+    minx, miny, maxx, maxy = get_tile_bounds(tile.zoom, tile.x, tile.y)
+    base_cache_key = build_base_cache_key(level_data.history.last_update(minx, miny, maxx, maxy))
+    theme_key = '0' if tile.theme is None else str(tile.theme)
+
+    tile_directory = get_tile_cache_directory(tile.level, tile.zoom, tile.x, tile.y,
+                                              build_access_cache_key(tile.access_permissions))
+    last_update_file = tile_directory / 'last_update'
+    try:
+        up_to_date = last_update_file.read_text() == base_cache_key
+    except FileNotFoundError:
+        up_to_date = False
+
+    if up_to_date:
+        formats = [ext for ext in formats if not (tile_directory / f'{theme_key}.{ext}').exists()]
+        if not formats:
+            return False
+    else:
+        remove_tile_cache_directory(tile_directory)
+
+    renderer = MapRenderer(tile.level, minx, miny, maxx, maxy, scale=2 ** tile.zoom,
+                           access_permissions=tile.access_permissions)
+    image = renderer.render(ImageRenderEngine, theme=tile.theme)
+
+    os.makedirs(tile_directory, exist_ok=True)
+    for ext in formats:
+        (tile_directory / f'{theme_key}.{ext}').write_bytes(image.render(ext))
+    last_update_file.write_text(base_cache_key)
+    cache.set(get_tile_cache_update_cache_key(tile.level, tile.zoom, tile.x, tile.y), base_cache_key, 60)
+    return True
+
+
+def seed_tiles(zooms: Iterable[int], formats: Sequence[str] = ('webp', ),
+               access_permissions: Optional[Iterable[frozenset[int]]] = None,
+               since: Optional[MapUpdateTuple] = None, levels: Optional[set[int]] = None, processes: int = 1) -> int:
+    """
+    Pre-render the tiles that intersect the map, or only those that changed after the given update,
+    so the first visitors don't have to wait for them. Returns the number of tiles that were rendered.
+    Without access permissions, the common ones and those in TILE_SEED_PERMISSIONS are used.
+    """
+    # make sure we are using the newest processed update
+    per_request_cache.clear()
+
+    cache_package = CachePackage.open_cached()
+    if access_permissions is None:
+        access_permissions = get_common_access_permissions(cache_package, extra=settings.TILE_SEED_PERMISSIONS)
+
+    tiles = get_tiles_to_seed(cache_package, zooms=zooms, access_permissions=access_permissions,
+                              since=since, levels=levels)
+    logger.info('Seeding %d tiles...' % len(tiles))
+
+    if processes > 1 and len(tiles) > 1:
+        # the forked worker processes must not share database connections
+        connections.close_all()
+    rendered = sum(fork_map(partial(seed_tile, formats=formats), tiles, processes=processes, chunksize=16))
+
+    logger.info('%d tiles rendered.' % rendered)
+    return rendered
@@ -2,6 +2,7 @@ import logging
 import time
 
 from celery.exceptions import MaxRetriesExceededError
+from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.core.cache import cache
 from django.utils.formats import date_format
@@ -50,6 +51,34 @@ def process_map_updates(self):
         })
 
 
+@app.task(bind=True, max_retries=3)
+def seed_tiles(self, since=None):
+    if not settings.TILE_SEED_ZOOMS or not settings.CACHE_TILES:
+        return
+
+    from c3nav.mapdata.render.seed import seed_tiles as seed
+    seed(zooms=settings.TILE_SEED_ZOOMS, formats=settings.TILE_SEED_FORMATS,
+         since=None if since is None else tuple(since), processes=settings.TILE_SEED_PROCESSES)
+
+
+@app.task(bind=True, max_retries=3)
+def build_api_snapshots(self, update):
+    if not settings.API_SNAPSHOTS:
+        return
+
+    from c3nav.mapdata.api.snapshots import APISnapshots
+    from c3nav.mapdata.models import MapUpdate
+    from c3nav.mapdata.utils.cache.local import per_request_cache
+
+    # make sure we are using the newest update, if there is a newer one its own task will build the snapshots
+    per_request_cache.clear()
+    if MapUpdate.last_update() != tuple(update):
+        logger.info('Skipping API snapshots, map update is outdated.')
+        return
+
+    APISnapshots.build(MapUpdate.build_cache_key(*update))
+
+
 @app.task(bind=True, max_retries=10)
 def delete_map_cache_key(self, cache_key):
     if hasattr(cache, 'keys'):
@@ -45,6 +45,10 @@ class GeometryChangeTracker:
                     for level_id in self._geometries_by_level.keys()
                     if level_id not in self._deleted_levels), 0)
 
+    def get_geometries_by_level(self):
+        self.finalize()
+        return {level_id: self._get_unary_union(level_id) for level_id in self._geometries_by_level.keys()}
+
     def finalize(self):
         for level_id in self._deleted_levels:
             try:
@@ -1,5 +1,6 @@
 import math
 import struct
+from io import BytesIO
 from os import PathLike
 from pathlib import Path
 from typing import Self, Optional, Union, TYPE_CHECKING
@@ -28,6 +29,7 @@ class GeometryIndexed:
     # x bytes data, line after line. (cell size depends on subclass)
     dtype = np.uint16
     variant_id = 0
+    block_size = 16  # for get_geometry_cells()
 
     def __init__(self, resolution: Optional[int] = None, x: int = 0, y: int = 0,
                  data: NDArray = None, filename: str | bytes | PathLike = None):
@@ -69,6 +71,28 @@ class GeometryIndexed:
             (height, width))
         return cls(**kwargs)
 
+    @classmethod
+    def read_mapped(cls, buffer, offset: int) -> Self:
+        """
+        Read from a buffer written by write_mapped(), usually a memory map. The data is not copied and read-only.
+        """
+        reader = BufferReader(buffer, offset)
+        variant_id, resolution, x, y, width, height = struct.unpack('<BBhhHH', reader.read(10))
+        if variant_id != cls.variant_id:
+            raise ValueError('variant id does not match')
+
+        kwargs = {
+            'resolution': resolution,
+            'x': x,
+            'y': y,
+        }
+        cls._read_metadata(reader, kwargs)
+
+        # noinspection PyTypeChecker
+        kwargs['data'] = np.frombuffer(buffer, cls.dtype, count=width * height, offset=reader.offset).reshape(
+            (height, width))
+        return cls(**kwargs)
+
     @classmethod
     def _read_metadata(cls, f, kwargs: dict):
         pass
@@ -87,6 +111,23 @@ class GeometryIndexed:
         self._write_metadata(f)
         f.write(self.data.tobytes('C'))
 
+    def write_mapped(self, f, offset: int, alignment: int = 64) -> int:
+        """
+        Write to f, which is at the given offset, with padding in front so the data is aligned.
+        Returns the offset to pass to read_mapped().
+        """
+        header = BytesIO()
+        header.write(struct.pack('<BBhhHH', self.variant_id, self.resolution, self.x, self.y,
+                                 *reversed(self.data.shape)))
+        self._write_metadata(header)
+        header = header.getvalue()
+
+        padding = -(offset + len(header)) % alignment
+        f.write(b'\0' * padding)
+        f.write(header)
+        f.write(self.data.tobytes('C'))
+        return offset + padding
+
     def _write_metadata(self, f):
         pass
 
@@ -131,16 +172,33 @@ class GeometryIndexed:
         maxx = min(maxx, self.x + width)
         maxy = min(maxy, self.y + height)
 
-        from shapely import prepared
-        from shapely.geometry import box
+        import shapely
 
         cells = np.zeros_like(self.data, dtype=bool)
-        prep = prepared.prep(geometry)
+        if maxx <= minx or maxy <= miny:
+            return cells
+
+        shapely.prepare(geometry)
         res = self.resolution
-        for iy, y in enumerate(range(miny * res, maxy * res, res), start=miny - self.y):
-            for ix, x in enumerate(range(minx * res, maxx * res, res), start=minx - self.x):
-                if prep.intersects(box(x, y, x + res, y + res)):
-                    cells[iy, ix] = True
+        size = self.block_size
+
+        # first test blocks of cells: blocks inside the geometry are set completely, blocks that don't intersect it
+        # are skipped, so only the cells of blocks on the boundary of the geometry need to be tested one by one
+        block_x, block_y = np.meshgrid(np.arange(minx, maxx, size), np.arange(miny, maxy, size))
+        block_x, block_y = block_x.ravel(), block_y.ravel()
+        block_maxx, block_maxy = np.minimum(block_x + size, maxx), np.minimum(block_y + size, maxy)
+        blocks = shapely.box(block_x * res, block_y * res, block_maxx * res, block_maxy * res)
+        inside = shapely.contains(geometry, blocks)
+        boundary = ~inside & shapely.intersects(geometry, blocks)
+
+        for x0, y0, x1, y1 in zip(*(i[inside].tolist() for i in (block_x, block_y, block_maxx, block_maxy))):
+            cells[y0 - self.y:y1 - self.y, x0 - self.x:x1 - self.x] = True
+
+        for x0, y0, x1, y1 in zip(*(i[boundary].tolist() for i in (block_x, block_y, block_maxx, block_maxy))):
+            x, y = np.meshgrid(np.arange(x0, x1) * res, np.arange(y0, y1) * res)
+            cells[y0 - self.y:y1 - self.y, x0 - self.x:x1 - self.x] = shapely.intersects(
+                geometry, shapely.box(x, y, x + res, y + res)
+            )
 
         return cells
 
@@ -252,3 +310,17 @@ class LevelGeometryIndexed(GeometryIndexed):
         result = cls.open_level(level_id, mode)
         cls.cached.data[(level_id, mode)] = result
         return result
+
+
+class BufferReader:
+    """
+    Minimal file-like reader for a buffer, keeping track of the offset.
+    """
+    def __init__(self, buffer, offset: int = 0):
+        self.buffer = memoryview(buffer)
+        self.offset = offset
+
+    def read(self, size: int) -> bytes:
+        data = self.buffer[self.offset:self.offset + size].tobytes()
+        self.offset += size
+        return data
@@ -1,3 +1,5 @@
+import json
+import mmap
 import os
 import struct
 from io import BytesIO
@@ -15,6 +17,8 @@ except ImportError:
     from threading import local as LocalContext
 
 ZSTD_MAGIC_NUMBER = b"\x28\xb5\x2f\xfd"
+MAPPED_MAGIC_NUMBER = b"C3NAVPKG"
+MAPPED_VERSION = 1
 
 
 class CachePackageLevel(NamedTuple):
@@ -140,6 +144,67 @@ class CachePackage:
 
         return cls(bounds, levels)
 
+    def write_mapped(self, f: BinaryIO):
+        """
+        Write the package uncompressed, with all arrays aligned, so it can be memory-mapped by read_mapped().
+
+        format (everything little-endian):
+        8 bytes: magic number
+        4 bytes (uint32): version
+        8 bytes (uint64): offset of the index
+        4 bytes (uint32): length of the index
+        sections of the history and restrictions of each level, each as written by GeometryIndexed.write_mapped()
+        index as json: bounds and levels with their global restrictions and section offsets
+        """
+        header_format = '<8sIQI'
+        offset = struct.calcsize(header_format)
+        f.write(b'\0' * offset)
+
+        levels = []
+        for (level_id, theme_id), level_data in self.levels.items():
+            history_offset = level_data.history.write_mapped(f, offset)
+            offset = f.tell()
+            restrictions_offset = level_data.restrictions.write_mapped(f, offset)
+            offset = f.tell()
+            levels.append((level_id, theme_id, sorted(level_data.global_restrictions),
+                           history_offset, restrictions_offset))
+
+        index = json.dumps({'bounds': self.bounds, 'levels': levels}).encode()
+        f.write(index)
+        f.seek(0)
+        f.write(struct.pack(header_format, MAPPED_MAGIC_NUMBER, MAPPED_VERSION, offset, len(index)))
+
+    @classmethod
+    def read_mapped(cls, buffer) -> Self:
+        """
+        Read a package written by write_mapped() from a buffer, without copying any of the arrays.
+        """
+        header_format = '<8sIQI'
+        magic_number, version, index_offset, index_length = struct.unpack_from(header_format, buffer)
+        if magic_number != MAPPED_MAGIC_NUMBER or version != MAPPED_VERSION:
+            raise ValueError('not a mapped cache package or unsupported version')
+
+        index = json.loads(bytes(buffer[index_offset:index_offset + index_length]))
+        levels = {
+            (level_id, theme_id): CachePackageLevel(
+                history=MapHistory.read_mapped(buffer, history_offset),
+                restrictions=AccessRestrictionAffected.read_mapped(buffer, restrictions_offset),
+                global_restrictions=frozenset(global_restrictions),
+            )
+            for level_id, theme_id, global_restrictions, history_offset, restrictions_offset in index['levels']
+        }
+        return cls(tuple(index['bounds']), levels)
+
+    @classmethod
+    def open_mapped(cls, filename: str | os.PathLike) -> Self:
+        """
+        Memory-map a package written by write_mapped(). This is cheap and all processes share the same pages.
+        """
+        with open(filename, 'rb') as f:
+            # the mapping stays valid after the file is closed
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls.read_mapped(buffer)
+
     @classmethod
     def open(cls, update_cache_key=None, package: Optional[str | os.PathLike] = None) -> Self:
         if package is None:
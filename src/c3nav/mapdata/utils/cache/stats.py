@@ -1,5 +1,10 @@
+import atexit
+import os
+import threading
+from collections import Counter
 from operator import itemgetter
 
+from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.core.cache import cache
 from django.utils import timezone
@@ -13,14 +18,109 @@ from c3nav.mapdata.models.locations import LocationRedirect
 from c3nav.mapdata.utils.locations import CustomLocation, get_location_by_id_for_request
 
 
+class StatsBuffer:
+    """
+    Per-process buffer for stats counters. Increments are summed up in memory and written to the cache in bulk, once
+    enough of them have been collected, once the oldest one is older than the flush interval, or on exit.
+    """
+    def __init__(self, max_pending: int, flush_interval: float):
+        self.max_pending = max_pending
+        self.flush_interval = flush_interval
+        self._reset()
+        os.register_at_fork(after_in_child=self._reset)
+        atexit.register(self.flush)
+
+    def _reset(self):
+        # forked children don't inherit the increments of their parent, its timer thread, or its lock, which might
+        # have been held by another thread while forking
+        self._lock = threading.Lock()
+        self._pending = Counter()
+        self._num_pending = 0
+        self._timer = None
+
+    def incr(self, cache_key: str, delta: int = 1):
+        if self.max_pending <= 1:
+            self._write({cache_key: delta})
+            return
+
+        with self._lock:
+            self._pending[cache_key] += delta
+            self._num_pending += 1
+            if self._num_pending < self.max_pending:
+                if self._timer is None:
+                    self._timer = threading.Timer(self.flush_interval, self.flush)
+                    self._timer.daemon = True
+                    self._timer.start()
+                return
+            pending = self._take_pending()
+        self._write(pending)
+
+    def _take_pending(self) -> Counter:
+        pending = self._pending
+        self._pending = Counter()
+        self._num_pending = 0
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        return pending
+
+    def flush(self):
+        with self._lock:
+            pending = self._take_pending()
+        if pending:
+            self._write(pending)
+
+    @staticmethod
+    def _write(pending: dict[str, int]):
+        if settings.CACHES['default']['BACKEND'] == 'django.core.cache.backends.redis.RedisCache':
+            # one round trip for all of them. the redis cache stores integers unserialized, so INCRBY works on them
+            # and creates missing keys without expiry, just like the cache.set() fallback below
+            client = cache._cache.get_client(write=True)
+            with client.pipeline(transaction=False) as pipeline:
+                for cache_key, delta in pending.items():
+                    pipeline.incrby(cache.make_and_validate_key(cache_key), delta)
+                pipeline.execute()
+            return
+
+        if settings.CACHES['default']['BACKEND'] == 'django.core.cache.backends.memcached.PyLibMCCache':
+            StatsBuffer._write_pylibmc(pending)
+            return
+
+        for cache_key, delta in pending.items():
+            try:
+                cache.incr(cache_key, delta)
+            except ValueError:
+                cache.set(cache_key, delta, None)
+
+    @staticmethod
+    def _write_pylibmc(pending: dict[str, int]):
+        # add all missing keys at once, without expiry like the cache.set() fallback above, then increment the
+        # existing ones at once per distinct delta. that's a handful of round trips instead of one per key
+        import pylibmc
+        client = cache._cache
+        keys = {cache.make_and_validate_key(cache_key): delta for cache_key, delta in pending.items()}
+        existing_by_delta = {}
+        for key in client.add_multi(keys, time=0):
+            existing_by_delta.setdefault(keys[key], []).append(key)
+        for delta, existing_keys in existing_by_delta.items():
+            try:
+                client.incr_multi(existing_keys, delta=delta)
+            except pylibmc.NotFound:
+                # some of them got reset by stats_snapshot() in between, these increments are lost
+                pass
+
+
+stats_buffer = StatsBuffer(max_pending=settings.API_STATS_BUFFER_SIZE,
+                           flush_interval=settings.API_STATS_FLUSH_INTERVAL)
+
+
 def increment_cache_key(cache_key):
-    try:
-        cache.incr(cache_key)
-    except ValueError:
-        cache.set(cache_key, 1, None)
+    stats_buffer.incr(cache_key)
 
 
 def stats_snapshot(reset=True):
+    # increments buffered by other processes will show up in the next snapshot
+    stats_buffer.flush()
     last_now = cache.get('apistats_last_reset', '', None)
     now = timezone.now()
     results = {}
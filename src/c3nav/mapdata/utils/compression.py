@@ -0,0 +1,60 @@
+import gzip
+from typing import Callable, Iterable, Optional
+
+from django.conf import settings
+from pyzstd import compress as zstd_compress
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# content codings we can pre-compress responses with, in order of preference,
+# using levels that are still fast enough to run on a cache miss
+encoders: dict[str, Callable[[bytes], bytes]] = {
+    'zstd': lambda content: zstd_compress(content, 12),
+    **({'br': lambda content: brotli.compress(content, quality=9)} if brotli is not None else {}),
+    'gzip': lambda content: gzip.compress(content, compresslevel=9, mtime=0),
+}
+
+
+def get_encodings() -> tuple[str, ...]:
+    # configured encodings, in order of preference, that are available
+    return tuple(encoding for encoding in settings.API_CACHE_ENCODINGS if encoding in encoders)
+
+
+def encode_content(content: bytes, encodings: Iterable[str], min_size: int = 1024) -> dict[str, bytes]:
+    """
+    Compress the content with all given encodings. Small content is not compressed at all, and encodings that don't
+    make the content smaller are skipped.
+    """
+    if len(content) < min_size:
+        return {}
+    result = {}
+    for encoding in encodings:
+        encoded = encoders[encoding](content)
+        if len(encoded) < len(content):
+            result[encoding] = encoded
+    return result
+
+
+def get_accepted_encodings(request) -> dict[str, float]:
+    # parse the Accept-Encoding header into a quality value for each content coding
+    result = {}
+    for item in request.headers.get('Accept-Encoding', '').split(','):
+        encoding, *params = (s.strip() for s in item.split(';'))
+        if not encoding:
+            continue
+        try:
+            result[encoding.lower()] = next((float(param[2:]) for param in params if param.startswith('q=')), 1.0)
+        except ValueError:
+            pass
+    return result
+
+
+def choose_encoding(request, available: Iterable[str]) -> Optional[str]:
+    """
+    Pick the first of the available encodings (in order of preference) that the client accepts, if any.
+    """
+    accepted = get_accepted_encodings(request)
+    return next((encoding for encoding in available if accepted.get(encoding, accepted.get('*', 0)) > 0), None)
@@ -5,6 +5,7 @@ from typing import List, Sequence, Union
 
 import matplotlib.pyplot as plt
 import numpy as np
+import shapely
 from django.utils.functional import cached_property
 from shapely import prepared
 from shapely.geometry import GeometryCollection, LinearRing, LineString, MultiLineString, MultiPolygon, Point, Polygon
@@ -36,6 +37,33 @@ class WrappedGeometry():
         return WrappedGeometry, (self.wrapped_geojson, )
 
 
+class WrappedWKBGeometry(WrappedGeometry):
+    """
+    Like WrappedGeometry, but for calculated geometries. Pickled as WKB and only decoded when first used.
+    """
+    wrapped_wkb = None
+
+    def __init__(self, wkb):
+        self.wrapped_wkb = wkb
+
+    @classmethod
+    def wrap(cls, geometry):
+        if isinstance(geometry, WrappedGeometry):
+            return geometry
+        return cls(shapely.to_wkb(geometry))
+
+    @cached_property
+    def wrapped_geom(self):
+        return shapely.from_wkb(self.wrapped_wkb)
+
+    @cached_property
+    def wrapped_geojson(self):
+        return shapely_mapping(self.wrapped_geom)
+
+    def __reduce__(self):
+        return WrappedWKBGeometry, (self.wrapped_wkb, )
+
+
 def unwrap_geom(geometry):
     return geometry.wrapped_geom if isinstance(geometry, WrappedGeometry) else geometry
 
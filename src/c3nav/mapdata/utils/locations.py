@@ -1,7 +1,9 @@
 import math
 import operator
 import re
+import threading
 from collections import OrderedDict
+from copy import copy
 from dataclasses import dataclass, field
 from functools import reduce
 from itertools import chain
@@ -14,6 +16,7 @@ from django.utils.functional import cached_property
 from django.utils.text import format_lazy
 from django.utils.translation import get_language
 from django.utils.translation import gettext_lazy as _
+import numpy as np
 from shapely import Point
 from shapely.ops import unary_union
 
@@ -27,110 +30,260 @@ from c3nav.mapdata.models.locations import LocationRedirect, LocationSlug, Posit
 from c3nav.mapdata.utils.cache.local import LocalCacheProxy
 from c3nav.mapdata.utils.geometry import unwrap_geom
 from c3nav.mapdata.utils.models import get_submodels
+from c3nav.mapdata.utils.search import LocationSearchIndex
 
 proxied_cache = LocalCacheProxy(maxsize=settings.CACHE_SIZE_LOCATIONS)
 
 
-def locations_for_request(request) -> Mapping[int, LocationSlug]:
-    # todo this takes a long time because it's a lot of data, we might want to change that
-    cache_key = 'mapdata:locations:%s' % AccessPermission.cache_key_for_request(request)
-    locations = proxied_cache.get(cache_key, None)
-    if locations is not None:
-        return locations
-
-    locations = LocationSlug.objects.all().order_by('id')
-
-    conditions = []
-    for model in get_submodels(Location):
-        related_name = model._meta.default_related_name
-        for prefix in ('', 'locationredirects__target__'):
-            condition = Q(**{prefix + related_name + '__isnull': False})
-            # noinspection PyUnresolvedReferences
-            condition &= model.q_for_request(request, prefix=prefix + related_name + '__')
-            conditions.append(condition)
-        locations = locations.select_related(
-            related_name + '__label_settings'
-        ).prefetch_related(
-            related_name + '__redirects'
-        )
-
-    locations = locations.filter(reduce(operator.or_, conditions))
-    locations = locations.select_related('locationredirects', 'locationgroups__category')
-
-    # prefetch locationgroups
-    base_qs = LocationGroup.qs_for_request(request).select_related('category', 'label_settings')
-    for model in get_submodels(SpecificLocation):
-        locations = locations.prefetch_related(Prefetch(model._meta.default_related_name + '__groups',
-                                                        queryset=base_qs))
-
-    locations = {obj.pk: obj.get_child() for obj in locations}
-
-    # add locations to groups
-    locationgroups = {pk: obj for pk, obj in locations.items() if isinstance(obj, LocationGroup)}
-    for group in locationgroups.values():
-        group.locations = []
-    for obj in locations.values():
-        if not isinstance(obj, SpecificLocation):
-            continue
-        for group in obj.groups.all():
-            group = locationgroups.get(group.pk, None)
-            if group is not None:
-                group.locations.append(obj)
-
-    # add levels to spaces
-    remove_pks = set()
-    levels = {pk: obj for pk, obj in locations.items() if isinstance(obj, Level)}
-    for pk, obj in locations.items():
-        if isinstance(obj, LevelGeometryMixin):
-            level = levels.get(obj.level_id, None)
-            if level is None:
-                remove_pks.add(pk)
-                continue
-            obj._level_cache = level
-
-    # hide spaces on hidden levels
-    for pk in remove_pks:
-        locations.pop(pk)
-
-    # add spaces to areas and POIs
-    remove_pks = set()
-    spaces = {pk: obj for pk, obj in locations.items() if isinstance(obj, Space)}
-    for pk, obj in locations.items():
+class LocationIndex:
+    """
+    All locations with the access restrictions required to see them, independent of any access permissions.
+    Built once per map update, the locations for a request are then just filtered using a bitmask.
+    """
+    _views_lock = threading.Lock()
+
+    def __init__(self, locations: dict[int, LocationSlug]):
+        self.locations = tuple(locations.values())
+        index_by_pk = {pk: i for i, pk in enumerate(locations.keys())}
+
+        required_restrictions = tuple(self._get_required_restrictions(obj, locations) for obj in self.locations)
+
+        # one bit per access restriction
+        self.restriction_bits = {pk: i for i, pk in enumerate(sorted(set(chain(*required_restrictions))))}
+        self.required = np.zeros((len(self.locations), max(1, math.ceil(len(self.restriction_bits) / 64))),
+                                 dtype=np.uint64)
+        for i, restrictions in enumerate(required_restrictions):
+            for restriction in restrictions:
+                bit = self.restriction_bits[restriction]
+                self.required[i, bit // 64] |= np.uint64(1 << (bit % 64))
+
+        # locations whose groups, group members or redirect target depend on the permissions need to be copied
+        restricted = self.required.any(axis=1)
+        self.permission_dependent = np.zeros(len(self.locations), dtype=bool)
+        group_restrictions = set()
+        for i, obj in enumerate(self.locations):
+            if isinstance(obj, SpecificLocation):
+                restrictions = set(group.access_restriction_id for group in obj.groups.all()) - {None}
+                self.permission_dependent[i] = bool(restrictions)
+                group_restrictions.update(restrictions)
+        for i, obj in enumerate(self.locations):
+            if isinstance(obj, LocationGroup):
+                self.permission_dependent[i] = any((restricted[j] or self.permission_dependent[j])
+                                                   for j in (index_by_pk[location.pk] for location in obj.locations))
+        for i, obj in enumerate(self.locations):
+            if isinstance(obj, LocationRedirect) and obj.target is not None:
+                self.permission_dependent[i] = self.permission_dependent[index_by_pk[obj.target.pk]]
+
+        # all access restrictions that make a difference, other permissions can be ignored
+        self.relevant_restrictions = frozenset(self.restriction_bits.keys()) | frozenset(group_restrictions)
+
+        self._views = OrderedDict()
+        self._search_index = None
+
+    def __getstate__(self):
+        return {**self.__dict__, '_views': OrderedDict(), '_search_index': None}
+
+    @staticmethod
+    def _get_required_restrictions(obj: LocationSlug, locations: dict[int, LocationSlug]) -> frozenset[int]:
+        # these are the same checks that q_for_request() does for each model
+        if isinstance(obj, LocationRedirect):
+            target = locations.get(obj.target_id)
+            return frozenset() if target is None else LocationIndex._get_required_restrictions(target, locations)
+        result = set()
         if isinstance(obj, SpaceGeometryMixin):
-            space = spaces.get(obj.space_id, None)
-            if space is None:
-                remove_pks.add(pk)
-                continue
-            obj._space_cache = space
+            parent = locations.get(obj.space_id)
+        elif isinstance(obj, LevelGeometryMixin):
+            parent = locations.get(obj.level_id)
+        else:
+            parent = None
+        if parent is not None:
+            result.update(LocationIndex._get_required_restrictions(parent, locations))
+        if obj.access_restriction_id is not None:
+            result.add(obj.access_restriction_id)
+        return frozenset(result)
 
-    # hide locations on hidden spaces
-    for pk in remove_pks:
-        locations.pop(pk)
+    @classmethod
+    def build(cls) -> "LocationIndex":
+        locations = LocationSlug.objects.all().order_by('id')
+
+        conditions = []
+        for model in get_submodels(Location):
+            related_name = model._meta.default_related_name
+            for prefix in ('', 'locationredirects__target__'):
+                conditions.append(Q(**{prefix + related_name + '__isnull': False}))
+            locations = locations.select_related(
+                related_name + '__label_settings'
+            ).prefetch_related(
+                related_name + '__redirects'
+            )
 
-    # add targets to LocationRedirects
-    levels = {pk: obj for pk, obj in locations.items() if isinstance(obj, Level)}
-    for obj in locations.values():
-        if isinstance(obj, LocationRedirect):
-            obj.target = locations.get(obj.target_id, None)
+        locations = locations.filter(reduce(operator.or_, conditions))
+        locations = locations.select_related('locationredirects', 'locationgroups__category')
+
+        # prefetch locationgroups
+        base_qs = LocationGroup.objects.all().select_related('category', 'label_settings')
+        for model in get_submodels(SpecificLocation):
+            locations = locations.prefetch_related(Prefetch(model._meta.default_related_name + '__groups',
+                                                            queryset=base_qs))
 
-    # apply better space geometries
-    for pk, geometry in get_better_space_geometries().items():
-        if pk in locations:
-            locations[pk].geometry = geometry
+        locations = {obj.pk: obj.get_child() for obj in locations}
 
-    # precache cached properties
-    for obj in locations.values():
+        # add locations to groups
+        locationgroups = {pk: obj for pk, obj in locations.items() if isinstance(obj, LocationGroup)}
+        for group in locationgroups.values():
+            group.locations = []
+        for obj in locations.values():
+            if not isinstance(obj, SpecificLocation):
+                continue
+            for group in obj.groups.all():
+                group = locationgroups.get(group.pk, None)
+                if group is not None:
+                    group.locations.append(obj)
+
+        # add levels to spaces
+        levels = {pk: obj for pk, obj in locations.items() if isinstance(obj, Level)}
+        for obj in locations.values():
+            if isinstance(obj, LevelGeometryMixin):
+                obj._level_cache = levels.get(obj.level_id, None)
+
+        # add spaces to areas and POIs
+        spaces = {pk: obj for pk, obj in locations.items() if isinstance(obj, Space)}
+        for obj in locations.values():
+            if isinstance(obj, SpaceGeometryMixin):
+                obj._space_cache = spaces.get(obj.space_id, None)
+
+        # add targets to LocationRedirects
+        for obj in locations.values():
+            if isinstance(obj, LocationRedirect):
+                obj.target = locations.get(obj.target_id, None)
+
+        # apply better space geometries
+        for pk, geometry in get_better_space_geometries().items():
+            if pk in locations:
+                locations[pk].geometry = geometry
+
+        # precache cached properties
+        for obj in locations.values():
+            cls._precache(obj)
+
+        return cls(locations)
+
+    @staticmethod
+    def _precache(obj: LocationSlug):
         if isinstance(obj, LocationRedirect):
-            continue
+            return
         # noinspection PyStatementEffect
         obj.subtitle, obj.order
         if isinstance(obj, GeometryMixin):
             # noinspection PyStatementEffect
             obj.point
 
-    proxied_cache.set(cache_key, locations, 1800)
+    @classmethod
+    def get(cls) -> "LocationIndex":
+        cache_key = 'mapdata:locations:index:%s' % MapUpdate.current_cache_key()
+        index = proxied_cache.get(cache_key, None)
+        if index is None:
+            index = cls.build()
+            proxied_cache.set(cache_key, index, 1800)
+        return index
+
+    def _get_view(self, name: str, permissions: set[int], func):
+        # lru cache, shared by the threads of this process
+        key = (name, self.relevant_restrictions & frozenset(permissions))
+        with self._views_lock:
+            result = self._views.get(key, None)
+            if result is not None:
+                self._views.move_to_end(key)
+                return result
+
+        result = func(key[1])
+        with self._views_lock:
+            self._views[key] = result
+            while len(self._views) > settings.CACHE_SIZE_LOCATIONS:
+                self._views.popitem(last=False)
+        return result
+
+    def visible_mask(self, permissions: set[int]) -> np.ndarray:
+        permission_bits = np.zeros(self.required.shape[1], dtype=np.uint64)
+        for restriction in permissions:
+            bit = self.restriction_bits.get(restriction)
+            if bit is not None:
+                permission_bits[bit // 64] |= np.uint64(1 << (bit % 64))
+        return ~(self.required & ~permission_bits).any(axis=1)
+
+    def get_locations(self, permissions: set[int]) -> Mapping[int, LocationSlug]:
+        return self._get_view('locations', permissions, self._build_locations)
+
+    def _build_locations(self, permissions: frozenset[int]) -> dict[int, LocationSlug]:
+        visible = self.visible_mask(permissions)
+        locations = {self.locations[i].pk: self.locations[i] for i in np.flatnonzero(visible)}
+
+        # only the few locations whose related objects depend on the permissions need to be copied
+        dependent = tuple(self.locations[i] for i in np.flatnonzero(visible & self.permission_dependent))
+        for obj in dependent:
+            if isinstance(obj, SpecificLocation):
+                locations[obj.pk] = self._copy_with_groups(obj, [
+                    group for group in obj.groups.all()
+                    if group.access_restriction_id is None or group.access_restriction_id in permissions
+                ])
+        for obj in dependent:
+            if isinstance(obj, LocationGroup):
+                group = locations[obj.pk] = copy(obj)
+                group.locations = [locations[location.pk] for location in obj.locations if location.pk in locations]
+                self._precache(group)
+        for obj in dependent:
+            if isinstance(obj, LocationRedirect):
+                redirect = locations[obj.pk] = copy(obj)
+                redirect.target = locations[obj.target_id]
+        return locations
+
+    def _copy_with_groups(self, obj: SpecificLocation, groups: list[LocationGroup]) -> SpecificLocation:
+        groups_queryset = copy(obj.groups.all())
+        groups_queryset._result_cache = groups
+        obj_copy = copy(obj)
+        obj_copy._prefetched_objects_cache = {**obj._prefetched_objects_cache, 'groups': groups_queryset}
+        # these were calculated using all groups
+        for name in ('order', 'describing_groups'):
+            obj_copy.__dict__.pop(name, None)
+        self._precache(obj_copy)
+        return obj_copy
+
+    def get_visible_locations(self, permissions: set[int]) -> Mapping[int, Location]:
+        return self._get_view('visible', permissions, lambda permissions: {
+            pk: location for pk, location in self.get_locations(permissions).items()
+            if not isinstance(location, LocationRedirect) and (location.can_search or location.can_describe)
+        })
+
+    def get_searchable_locations(self, permissions: set[int]) -> List[Location]:
+        return self._get_view('searchable', permissions, lambda permissions: sorted(
+            (location for location in self.get_locations(permissions).values()
+             if isinstance(location, Location) and location.can_search),
+            key=operator.attrgetter('order'), reverse=True
+        ))
+
+    def get_locations_by_slug(self, permissions: set[int]) -> Mapping[str, LocationSlug]:
+        return self._get_view('by_slug', permissions, lambda permissions: {
+            location.slug: location for location in self.get_locations(permissions).values() if location.slug
+        })
+
+    def get_levels_by_level_index(self, permissions: set[int]) -> Mapping[str, Level]:
+        return self._get_view('levels_by_level_index', permissions, lambda permissions: OrderedDict(
+            (level.level_index, level)
+            for level in sorted((location for location in self.get_locations(permissions).values()
+                                 if isinstance(location, Level) and location.on_top_of_id is None),
+                                key=operator.attrgetter('base_altitude'))
+        ))
+
+    def search(self, permissions: set[int], query: str, limit: int) -> List[Location]:
+        # the search index does not depend on permissions, so it is only built once per map update
+        if self._search_index is None:
+            self._search_index = LocationSearchIndex(self)
+        locations = self.get_locations(permissions)
+        return [locations[pk] for pk in self._search_index.search(query, self.visible_mask(permissions), limit)]
 
-    return locations
+
+def locations_for_request(request) -> Mapping[int, LocationSlug]:
+    return LocationIndex.get().get_locations(AccessPermission.get_for_request(request))
 
 
 def get_better_space_geometries():
@@ -154,62 +307,23 @@ def get_better_space_geometries():
 
 
 def visible_locations_for_request(request) -> Mapping[int, Location]:
-    cache_key = 'mapdata:locations:real:%s' % AccessPermission.cache_key_for_request(request)
-    locations = proxied_cache.get(cache_key, None)
-    if locations is not None:
-        return locations
-
-    locations = {pk: location for pk, location in locations_for_request(request).items()
-                 if not isinstance(location, LocationRedirect) and (location.can_search or location.can_describe)}
-
-    proxied_cache.set(cache_key, locations, 1800)
-
-    return locations
+    return LocationIndex.get().get_visible_locations(AccessPermission.get_for_request(request))
 
 
 def searchable_locations_for_request(request) -> List[Location]:
-    cache_key = 'mapdata:locations:searchable:%s' % AccessPermission.cache_key_for_request(request)
-    locations = proxied_cache.get(cache_key, None)
-    if locations is not None:
-        return locations
+    return LocationIndex.get().get_searchable_locations(AccessPermission.get_for_request(request))
 
-    locations = (location for location in locations_for_request(request).values() if isinstance(location, Location))
-    locations = tuple(location for location in locations if location.can_search)
 
-    locations = sorted(locations, key=operator.attrgetter('order'), reverse=True)
-
-    proxied_cache.set(cache_key, locations, 1800)
-
-    return locations
+def search_locations_for_request(request, query: str, limit: int) -> List[Location]:
+    return LocationIndex.get().search(AccessPermission.get_for_request(request), query, limit)
 
 
 def locations_by_slug_for_request(request) -> Mapping[str, LocationSlug]:
-    cache_key = 'mapdata:locations:by_slug:%s' % AccessPermission.cache_key_for_request(request)
-    locations = proxied_cache.get(cache_key, None)
-    if locations is not None:
-        return locations
-
-    locations = {location.slug: location for location in locations_for_request(request).values() if location.slug}
-
-    proxied_cache.set(cache_key, locations, 1800)
-
-    return locations
+    return LocationIndex.get().get_locations_by_slug(AccessPermission.get_for_request(request))
 
 
 def levels_by_level_index_for_request(request) -> Mapping[str, Level]:
-    cache_key = 'mapdata:levels:by_level_index:%s' % AccessPermission.cache_key_for_request(request)
-    levels = proxied_cache.get(cache_key, None)
-    if levels is not None:
-        return levels
-
-    levels = OrderedDict(
-        (level.level_index, level)
-        for level in Level.qs_for_request(request).filter(on_top_of_id__isnull=True).order_by('base_altitude')
-    )
-
-    proxied_cache.set(cache_key, levels, 1800)
-
-    return levels
+    return LocationIndex.get().get_levels_by_level_index(AccessPermission.get_for_request(request))
 
 
 def get_location_by_id_for_request(pk, request):
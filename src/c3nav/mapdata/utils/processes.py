@@ -0,0 +1,39 @@
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Iterable
+
+logger = logging.getLogger('c3nav')
+
+
+def is_daemon_process() -> bool:
+    # celery's prefork workers are daemonic billiard processes, which are not allowed to have child processes
+    if multiprocessing.current_process().daemon:
+        return True
+    try:
+        import billiard
+    except ImportError:
+        return False
+    return bool(billiard.current_process().daemon)
+
+
+def fork_map(func: Callable, *iterables: Iterable, processes: int, chunksize: int = 1) -> list:
+    """
+    Like map(), but spread over the given number of forked worker processes, so they don't need to set up django.
+    Inside of daemonic processes (e.g. celery prefork workers), billiard's pool is used, since it allows them to
+    have child processes.
+    """
+    if processes <= 1:
+        return list(map(func, *iterables))
+
+    if is_daemon_process():
+        try:
+            import billiard
+        except ImportError:
+            logger.warning('Running in a daemonic process without billiard, ignoring processes=%d.' % processes)
+            return list(map(func, *iterables))
+        with billiard.get_context('fork').Pool(processes) as pool:
+            return pool.starmap(func, zip(*iterables), chunksize=chunksize)
+
+    with ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context('fork')) as executor:
+        return list(executor.map(func, *iterables, chunksize=chunksize))
@@ -0,0 +1,131 @@
+import re
+from itertools import chain
+from typing import TYPE_CHECKING, Sequence
+
+import numpy as np
+
+from c3nav.mapdata.models import Location
+from c3nav.mapdata.models.locations import SpecificLocation
+
+if TYPE_CHECKING:
+    from c3nav.mapdata.utils.locations import LocationIndex
+
+word_re = re.compile(r'\w+')
+
+
+def split_words(text: str) -> list[str]:
+    return word_re.findall(str(text).casefold())
+
+
+class LocationSearchIndex:
+    """
+    Trigram and prefix index over the titles (in all languages), slugs, additional search terms and group titles
+    of all searchable locations. Ranks results like the search in the web client does.
+    """
+    # words shorter than this are looked up as word prefixes instead of using trigrams
+    trigram_length = 3
+
+    def __init__(self, location_index: "LocationIndex"):
+        entries = sorted(
+            ((i, location) for i, location in enumerate(location_index.locations)
+             if isinstance(location, Location) and location.can_search),
+            key=lambda item: item[1].order, reverse=True
+        )
+
+        # rows of the entries in the location index, to filter them using its visibility bitmask
+        self.rows = np.array(tuple(i for i, location in entries), dtype=np.int64)
+        self.pks = tuple(location.pk for i, location in entries)
+
+        self.titles_words: list[tuple[tuple[str, ...], ...]] = []
+        self.title_lengths: list[int] = []
+        self.matches: list[str] = []
+
+        trigrams: dict[str, list[int]] = {}
+        prefixes: dict[str, list[int]] = {}
+        for entry_id, (i, location) in enumerate(entries):
+            titles = tuple(title for title in location.titles.values() if title) or (str(location.title), )
+            self.titles_words.append(tuple(tuple(split_words(title)) for title in titles))
+            self.title_lengths.append(min(len(title) for title in titles))
+
+            words = tuple(dict.fromkeys(chain(
+                *(split_words(title) for title in titles),
+                split_words(location.effective_slug or ''),
+                split_words(location.add_search),
+                *(split_words(title) for title in self._get_group_titles(location)),
+            )))
+            self.matches.append(' %s ' % ' '.join(words))
+
+            for word in words:
+                for length in range(1, min(len(word), self.trigram_length - 1) + 1):
+                    prefixes.setdefault(word[:length], []).append(entry_id)
+                for start in range(len(word) - self.trigram_length + 1):
+                    trigrams.setdefault(word[start:start + self.trigram_length], []).append(entry_id)
+
+        self.trigrams = {key: np.unique(np.array(value, dtype=np.int32)) for key, value in trigrams.items()}
+        self.prefixes = {key: np.unique(np.array(value, dtype=np.int32)) for key, value in prefixes.items()}
+
+    @staticmethod
+    def _get_group_titles(location) -> Sequence[str]:
+        if not isinstance(location, SpecificLocation):
+            return ()
+        # titles of restricted groups would tell users that these groups exist, so they are not searchable
+        return tuple(chain(*(group.titles.values() for group in location.groups.all()
+                             if group.access_restriction_id is None)))
+
+    def _get_candidates(self, word: str) -> np.ndarray:
+        # entries that might contain this word, trigram matches still need to be checked
+        if len(word) < self.trigram_length:
+            return self.prefixes.get(word, np.empty((0, ), dtype=np.int32))
+        result = None
+        for start in range(len(word) - self.trigram_length + 1):
+            postings = self.trigrams.get(word[start:start + self.trigram_length])
+            if postings is None:
+                return np.empty((0, ), dtype=np.int32)
+            result = postings if result is None else np.intersect1d(result, postings, assume_unique=True)
+        return result
+
+    def _get_sort_key(self, entry_id: int, words: list[str]) -> tuple | None:
+        match = self.matches[entry_id]
+        if not all((word in match) for word in words if len(word) >= self.trigram_length):
+            return None
+
+        # how many words from the beginning are in the title
+        leading_words_count = 0
+        for title_words in self.titles_words[entry_id]:
+            count = 0
+            for j, word in enumerate(words[:len(title_words)]):
+                if title_words[j] != word and (j != len(words) - 1 or not title_words[j].startswith(word)):
+                    break
+                count += 1
+            leading_words_count = max(leading_words_count, count)
+
+        # how many words in total can be found
+        words_total_count = 0
+        words_start_count = 0
+        for word in words:
+            if (' %s ' % word) in match:
+                words_total_count += 1
+            elif (' %s' % word) in match:
+                words_start_count += 1
+
+        return (-leading_words_count, -words_total_count, -words_start_count,
+                self.title_lengths[entry_id], entry_id)
+
+    def search(self, query: str, visible: np.ndarray, limit: int) -> list[int]:
+        """
+        Search for the given query in the entries that are visible according to the given location index bitmask.
+        Returns the pks of the best matching locations.
+        """
+        words = split_words(query)
+        if not words:
+            return []
+
+        candidates = np.flatnonzero(visible[self.rows])
+        for word in sorted(set(words), key=len, reverse=True):
+            candidates = np.intersect1d(candidates, self._get_candidates(word), assume_unique=True)
+            if not candidates.size:
+                return []
+
+        results = ((self._get_sort_key(entry_id, words), entry_id) for entry_id in candidates.tolist())
+        results = sorted((key, entry_id) for key, entry_id in results if key is not None)
+        return [self.pks[entry_id] for key, entry_id in results[:limit]]
@@ -3,6 +3,8 @@ import binascii
 import hashlib
 import hmac
 import time
+from pathlib import Path
+from shutil import rmtree
 
 
 def get_tile_bounds(zoom, x, y):
@@ -54,3 +56,22 @@ def build_tile_etag(level_id, zoom, x, y, theme_id, base_cache_key, access_cache
         ('%d-%d-%d-%d:%s:%s:%s:%s' %
          (level_id, zoom, x, y, str(theme_id), base_cache_key, access_cache_key, tile_secret[:26])).encode()
     ).digest()[:15], newline=False).decode() + '"'
+
+
+def get_tile_cache_directory(level_id, zoom, x, y, access_cache_key) -> Path:
+    # the tileserver uses this module without django
+    from django.conf import settings
+    return settings.TILES_ROOT / str(level_id) / str(zoom) / str(x) / str(y) / access_cache_key
+
+
+def get_tile_cache_update_cache_key(level_id, zoom, x, y) -> str:
+    return 'mapdata:tile-cache-update:%d-%d-%d-%d' % (level_id, zoom, x, y)
+
+
+def remove_tile_cache_directory(tile_directory: Path):
+    # rename first, so no new tiles get written into the directory while it is being deleted
+    try:
+        old_tile_directory = tile_directory.rename(tile_directory.parent / (tile_directory.name + '_old_tile_dir'))
+        rmtree(old_tile_directory)
+    except FileNotFoundError:
+        pass
@@ -20,12 +20,15 @@ from c3nav.mapdata.models import Level, MapUpdate
 from c3nav.mapdata.models.access import AccessPermission
 from c3nav.mapdata.render.engines import ImageRenderEngine
 from c3nav.mapdata.render.engines.base import FillAttribs, StrokeAttribs
+from c3nav.mapdata.render.engines.svg import png_to_webp
 from c3nav.mapdata.render.renderer import MapRenderer
 from c3nav.mapdata.utils.cache import CachePackage, MapHistory
 from c3nav.mapdata.utils.cors import allow_cors
 from c3nav.mapdata.utils.locations import visible_locations_for_request
 from c3nav.mapdata.utils.tiles import (build_access_cache_key, build_base_cache_key, build_tile_access_cookie,
-                                       build_tile_etag, get_tile_bounds, parse_tile_access_cookie)
+                                       build_tile_etag, get_tile_bounds, get_tile_cache_directory,
+                                       get_tile_cache_update_cache_key, parse_tile_access_cookie,
+                                       remove_tile_cache_directory)
 
 PREVIEW_HIGHLIGHT_FILL_OPACITY = 0.1
 PREVIEW_HIGHLIGHT_STROKE_WIDTH = 0.5
@@ -88,6 +91,22 @@ def bounds_for_preview(geometry, cache_package):
     return minx, miny, maxx, maxy, img_scale
 
 
+def read_cached_image(image_file, png_file, ext) -> Optional[bytes]:
+    # only the requested format gets rendered, a missing webp can be encoded from an existing png though
+    try:
+        return image_file.read_bytes()
+    except FileNotFoundError:
+        pass
+    if ext != 'webp':
+        return None
+    try:
+        data = png_to_webp(png_file.read_bytes())
+    except FileNotFoundError:
+        return None
+    image_file.write_bytes(data)
+    return data
+
+
 def cache_preview(request, ext, key, last_update, render_fn):
     import binascii
     import hashlib
@@ -120,28 +139,18 @@ def cache_preview(request, ext, key, last_update, render_fn):
             except FileNotFoundError:
                 pass
         else:
-            try:
-                data = preview_file.read_bytes()
-            except FileNotFoundError:
-                pass
+            data = read_cached_image(preview_file, previews_directory / 'preview.png', ext)
 
     if data is None:
-        data_png, data_webp = render_fn()
+        data = render_fn(ext)
 
         if settings.CACHE_PREVIEWS:
             os.makedirs(previews_directory, exist_ok=True)
-
-            preview_file_png = previews_directory / 'preview.png'
-            preview_file_webp = previews_directory / 'preview.webp'
-
-            preview_file_png.write_bytes(data_png)
-            preview_file_webp.write_bytes(data_webp)
+            preview_file.write_bytes(data)
 
             last_update_file.write_text(base_cache_key)
             cache.set(preview_cache_update_cache_key, base_cache_key, 60)
 
-        data = data_png if ext == "png" else data_webp
-
     response = HttpResponse(data, f'image/{ext}')
     response['ETag'] = preview_etag
     response['Cache-Control'] = 'no-cache'
@@ -211,7 +220,7 @@ def preview_location(request, slug, ext: Union[Literal["png"], Literal["webp"]])
     if level_data is None:
         raise Http404
 
-    def render_preview():
+    def render_preview(ext):
         renderer = MapRenderer(level, minx, miny, maxx, maxy, scale=img_scale, access_permissions=set())
         image = renderer.render(ImageRenderEngine, theme)
         if highlight:
@@ -222,7 +231,7 @@ def preview_location(request, slug, ext: Union[Literal["png"], Literal["webp"]])
                                    fill=FillAttribs(color_manager.highlight, PREVIEW_HIGHLIGHT_FILL_OPACITY),
                                    stroke=StrokeAttribs(color_manager.highlight, PREVIEW_HIGHLIGHT_STROKE_WIDTH),
                                    category='highlight')
-        return image.render()
+        return image.render(ext)
 
     return cache_preview(request, ext, slug, level_data.history.last_update(minx, miny, maxx, maxy), render_preview)
 
@@ -323,7 +332,7 @@ def preview_route(request, slug, slug2, ext: Union[Literal["png"], Literal["webp
     if level_data is None:
         raise Http404
 
-    def render_preview():
+    def render_preview(ext):
         renderer = MapRenderer(origin_level, minx, miny, maxx, maxy, scale=img_scale, access_permissions=set())
         image = renderer.render(ImageRenderEngine, theme)
         from c3nav.mapdata.render.theme import ColorManager
@@ -343,7 +352,7 @@ def preview_route(request, slug, slug2, ext: Union[Literal["png"], Literal["webp
             image.add_geometry(geom,
                                stroke=StrokeAttribs(color_manager.highlight, PREVIEW_HIGHLIGHT_STROKE_WIDTH),
                                category='route')
-        return image.render()
+        return image.render(ext)
 
     return cache_preview(request, ext, f'{slug}:{slug2}',
                          level_data.history.last_update(minx, miny, maxx, maxy),
@@ -419,12 +428,12 @@ def tile(request, level, zoom, x, y, theme, ext: Union[Literal["png"], Literal["
 
     # get tile cache last update
     if settings.CACHE_TILES:
-        tile_directory = settings.TILES_ROOT / str(level) / str(zoom) / str(x) / str(y) / access_cache_key
+        tile_directory = get_tile_cache_directory(level, zoom, x, y, access_cache_key)
         last_update_file = tile_directory / 'last_update'
         tile_file = tile_directory / f'{theme_key}.{ext}'
 
         # get tile cache last update
-        tile_cache_update_cache_key = 'mapdata:tile-cache-update:%d-%d-%d-%d' % (level, zoom, x, y)
+        tile_cache_update_cache_key = get_tile_cache_update_cache_key(level, zoom, x, y)
         tile_cache_update = cache.get(tile_cache_update_cache_key, None)
         if tile_cache_update is None:
             try:
@@ -433,38 +442,23 @@ def tile(request, level, zoom, x, y, theme, ext: Union[Literal["png"], Literal["
                 pass
 
         if tile_cache_update != base_cache_key:
-            try:
-                old_tile_directory = tile_directory.rename(tile_directory.parent /
-                                                           (tile_directory.name + '_old_tile_dir'))
-                rmtree(old_tile_directory)
-            except FileNotFoundError:
-                pass
+            remove_tile_cache_directory(tile_directory)
         else:
-            try:
-                data = tile_file.read_bytes()
-            except FileNotFoundError:
-                pass
+            data = read_cached_image(tile_file, tile_directory / f'{theme_key}.png', ext)
 
     if data is None:
         renderer = MapRenderer(level, minx, miny, maxx, maxy, scale=2 ** zoom, access_permissions=access_permissions)
         image = renderer.render(ImageRenderEngine, theme=theme,
                                 force_transparent_background=force_transparent_background)
-        data_png, data_webp = image.render()
+        data = image.render(ext)
 
         if settings.CACHE_TILES:
             os.makedirs(tile_directory, exist_ok=True)
-
-            tile_file_png = tile_directory / f'{theme_key}.png'
-            tile_file_webp = tile_directory / f'{theme_key}.webp'
-
-            tile_file_png.write_bytes(data_png)
-            tile_file_webp.write_bytes(data_webp)
+            tile_file.write_bytes(data)
 
             last_update_file.write_text(base_cache_key)
             cache.set(tile_cache_update_cache_key, base_cache_key, 60)
 
-        data = data_png if ext == "png" else data_webp
-
     response = HttpResponse(data, f'image/{ext}')
     response['ETag'] = tile_etag
     response['Cache-Control'] = 'no-cache'
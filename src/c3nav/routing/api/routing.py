@@ -1,4 +1,5 @@
 from enum import StrEnum
+from itertools import chain
 from typing import Annotated, Any, Optional, Union
 
 from django.core.exceptions import ValidationError
@@ -22,7 +23,7 @@ from c3nav.mapdata.schemas.model_base import AnyLocationID, Coordinates3D, Title
 from c3nav.mapdata.schemas.models import SlimLocationSchema, SpaceSchema, LevelSchema, SlimSpaceLocationSchema, \
     SlimLevelLocationSchema
 from c3nav.mapdata.utils.cache.stats import increment_cache_key
-from c3nav.mapdata.utils.locations import visible_locations_for_request
+from c3nav.mapdata.utils.locations import get_location_by_id_for_request, visible_locations_for_request
 from c3nav.routing.exceptions import LocationUnreachable, NoRouteFound, NotYetRoutable
 from c3nav.routing.forms import RouteForm
 from c3nav.routing.models import RouteOptions
@@ -253,6 +254,10 @@ def get_route(request, parameters: RouteParametersSchema):
             error=_('No route found.')
         )
 
+    increment_cache_key('apistats__route_config__%s__%s' % (
+        '-'.join(str(pk) for pk in sorted(AccessPermission.get_for_request(request))),
+        options.serialize_string(only_changed=True)
+    ))
     origin_values = api_stats_clean_location_value(form.cleaned_data['origin'].pk)
     destination_values = api_stats_clean_location_value(form.cleaned_data['destination'].pk)
     increment_cache_key('apistats__route')
@@ -277,9 +282,110 @@ def get_route(request, parameters: RouteParametersSchema):
     )
 
 
+class RouteMatrixParametersSchema(BaseSchema):
+    origins: list[AnyLocationID] = APIField(min_length=1)
+    destinations: list[AnyLocationID] = APIField(min_length=1)
+    options_override: Optional[UpdateRouteOptionsSchema] = APIField(
+        None,
+        title="override routing options",
+    )
+    path: bool = APIField(
+        False,
+        title="include path",
+        description="include the coordinates of all route nodes for each entry",
+    )
+
+
+class RouteMatrixEntrySchema(BaseSchema):
+    distance: float
+    duration: int
+    path: Optional[list[Coordinates3D]] = APIField(
+        None,
+        title="path",
+        description="coordinates of all route nodes, only if requested",
+    )
+
+
+class RouteMatrixResponse(BaseSchema):
+    request: RouteMatrixParametersSchema
+    options: RouteOptionsSchema
+    result: list[list[Union[
+        Annotated[RouteMatrixEntrySchema, APIField(title="route found")],
+        Annotated[None, APIField(title="null", description="no route found or location unreachable")],
+    ]]] = APIField(
+        title="route matrix",
+        description="one row for each origin, with one entry for each destination",
+    )
+
+    model_config = ConfigDict(title="route matrix calculated")
+
+
+class NoRouteMatrixResponse(BaseSchema):
+    request: RouteMatrixParametersSchema
+    options: RouteOptionsSchema
+    error: NonEmptyStr = APIField(
+        name="error description",
+        description=("the routing parameters were valid, but it was not possible to calculate the route matrix. "
+                     "this field contains the reason.")
+    )
+
+    model_config = ConfigDict(title="route matrix could not be calculated")
+
+
+@routing_api_router.post('/matrix/', summary="query route matrix", auth=APIKeyAuth(is_readonly=True),
+                         description="query distances and durations from multiple origins to multiple destinations",
+                         response={200: RouteMatrixResponse | NoRouteMatrixResponse,
+                                   **validate_responses, **auth_responses})
+def get_route_matrix(request, parameters: RouteMatrixParametersSchema):
+    if len(parameters.origins) * len(parameters.destinations) > settings.ROUTE_MATRIX_MAX_SIZE:
+        raise APIRequestValidationFailed("Too many origin/destination pairs, the maximum is %d."
+                                         % settings.ROUTE_MATRIX_MAX_SIZE)
+
+    # resolve every location only once
+    locations = {}
+    for location_id in chain(parameters.origins, parameters.destinations):
+        if location_id not in locations:
+            location = get_location_by_id_for_request(location_id, request)
+            if location is None:
+                raise APIRequestValidationFailed("Unknown location: %s" % location_id)
+            locations[location_id] = location
+
+    options = RouteOptions.get_for_request(request)
+    if parameters.options_override is not None:
+        _new_update_route_options(options, parameters.options_override)
+
+    try:
+        routes = Router.load().get_route_matrix(
+            origins=[locations[location_id] for location_id in parameters.origins],
+            destinations=[locations[location_id] for location_id in parameters.destinations],
+            permissions=AccessPermission.get_for_request(request),
+            options=options,
+            visible_locations=visible_locations_for_request(request),
+        )
+    except NotYetRoutable:
+        return NoRouteMatrixResponse(
+            request=parameters,
+            options=_new_serialize_route_options(options),
+            error=_('Not yet routable, try again shortly.'),
+        )
+
+    increment_cache_key('apistats__route_matrix')
+
+    return RouteMatrixResponse(
+        request=parameters,
+        options=_new_serialize_route_options(options),
+        result=[
+            [(None if route is None else route.serialize_summary(path=parameters.path)) for route in row]
+            for row in routes
+        ],
+    )
+
+
 if settings.METRICS:
     from c3nav.mapdata.metrics import APIStatsCollector
     APIStatsCollector.add_stat('route')
+    APIStatsCollector.add_stat('route_matrix')
+    APIStatsCollector.add_stat('route_config', ['permissions', 'options'])
     APIStatsCollector.add_stat('route_tuple', ['origin', 'destination'])
     APIStatsCollector.add_stat('route_origin', ['origin'])
     APIStatsCollector.add_stat('route_destination', ['destination'])
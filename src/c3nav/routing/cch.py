@@ -0,0 +1,230 @@
+from dataclasses import dataclass
+from heapq import heapify, heappop, heappush
+from typing import Iterable, NamedTuple, Sequence
+
+import numpy as np
+
+
+class ContractionHierarchyMetric(NamedTuple):
+    """
+    Arc weights of a ContractionHierarchy for one set of edge weights. Middle nodes are -1 for arcs that are
+    original edges, otherwise the node through which the shortcut leads.
+    """
+    up: np.ndarray  # weight from lower to upper node
+    down: np.ndarray  # weight from upper to lower node
+    up_middle: np.ndarray
+    down_middle: np.ndarray
+
+
+@dataclass
+class ContractionHierarchy:
+    """
+    Customizable contraction hierarchy of the routing graph.
+
+    The node order and the shortcut arcs only depend on the topology of the graph and are calculated once per router
+    build. Weights are only assigned to them in customize(), which is cheap enough to do for every combination of
+    restrictions and route options.
+    """
+    rank: np.ndarray  # contraction rank of every node
+    parent: np.ndarray  # elimination tree parent of every node, -1 for roots
+    arc_nodes: np.ndarray  # (lower, upper) node of every arc, sorted
+    arc_keys: np.ndarray  # lower * number of nodes + upper for every arc, for lookups
+    arc_indptr: np.ndarray  # upward arcs of node n are arc_indptr[n]:arc_indptr[n+1]
+    triangles: np.ndarray  # (arc bottom-v, arc bottom-w, arc v-w, bottom) for all lower triangles, sorted by level
+    triangle_indptr: np.ndarray  # triangles with bottom nodes on the same level can be processed at once
+    edge_arcs: np.ndarray  # arc of every router edge, -1 for loops
+    edge_upward: np.ndarray  # whether the router edge goes from the lower to the upper node of its arc
+
+    @classmethod
+    def build(cls, num_nodes: int, edge_nodes: np.ndarray) -> "ContractionHierarchy":
+        neighbors = [set() for i in range(num_nodes)]
+        for from_node, to_node in edge_nodes.tolist():
+            if from_node != to_node:
+                neighbors[from_node].add(to_node)
+                neighbors[to_node].add(from_node)
+
+        # contract nodes by minimum degree, connecting the remaining neighbors of every contracted node
+        rank = np.full(num_nodes, -1, dtype=np.int64)
+        upward: list[set[int]] = [set() for i in range(num_nodes)]
+        heap = [(len(node_neighbors), node) for node, node_neighbors in enumerate(neighbors)]
+        heapify(heap)
+        next_rank = 0
+        while heap:
+            degree, node = heappop(heap)
+            if rank[node] >= 0 or degree != len(neighbors[node]):
+                continue
+            rank[node] = next_rank
+            next_rank += 1
+            upward[node] = neighbors[node]
+            for neighbor in upward[node]:
+                neighbors[neighbor].discard(node)
+                neighbors[neighbor].update(upward[node] - {neighbor})
+                heappush(heap, (len(neighbors[neighbor]), neighbor))
+
+        arc_nodes = np.array(tuple((node, upper) for node in range(num_nodes) for upper in upward[node]),
+                             dtype=np.int64).reshape((-1, 2))
+        arc_keys = arc_nodes[:, 0] * num_nodes + arc_nodes[:, 1]
+        order = np.argsort(arc_keys)
+        arc_nodes, arc_keys = arc_nodes[order], arc_keys[order]
+        arc_indptr = np.searchsorted(arc_nodes[:, 0], np.arange(num_nodes + 1))
+
+        # lower triangles and the level of every node in the elimination order
+        triangle_nodes = []
+        level = np.zeros(num_nodes, dtype=np.int64)
+        for node in np.argsort(rank).tolist():
+            uppers = sorted(upward[node], key=rank.__getitem__)
+            for i, lower in enumerate(uppers):
+                level[lower] = max(level[lower], level[node] + 1)
+                triangle_nodes.extend((node, lower, upper) for upper in uppers[i + 1:])
+        triangle_nodes = np.array(triangle_nodes, dtype=np.int64).reshape((-1, 3))
+        triangle_nodes = triangle_nodes[np.argsort(level[triangle_nodes[:, 0]], kind='stable')]
+        bottom, lower, upper = triangle_nodes.transpose()
+        triangles = np.column_stack((
+            np.searchsorted(arc_keys, bottom * num_nodes + lower),
+            np.searchsorted(arc_keys, bottom * num_nodes + upper),
+            np.searchsorted(arc_keys, lower * num_nodes + upper),
+            bottom,
+        ))
+        triangle_indptr = np.searchsorted(level[bottom], np.arange(level.max(initial=0) + 2))
+
+        from_nodes, to_nodes = edge_nodes.astype(np.int64).transpose()
+        edge_upward = rank[from_nodes] < rank[to_nodes]
+        edge_arcs = np.searchsorted(arc_keys, np.where(edge_upward, from_nodes * num_nodes + to_nodes,
+                                                       to_nodes * num_nodes + from_nodes))
+        edge_arcs[from_nodes == to_nodes] = -1
+
+        return cls(
+            rank=rank,
+            parent=np.array(tuple(min(upward[node], key=rank.__getitem__, default=-1)
+                                  for node in range(num_nodes)), dtype=np.int64),
+            arc_nodes=arc_nodes,
+            arc_keys=arc_keys,
+            arc_indptr=arc_indptr,
+            triangles=triangles,
+            triangle_indptr=triangle_indptr,
+            edge_arcs=edge_arcs,
+            edge_upward=edge_upward,
+        )
+
+    def arc(self, lower: int, upper: int) -> int:
+        return int(np.searchsorted(self.arc_keys, lower * len(self.rank) + upper))
+
+    @staticmethod
+    def _relax(weights: np.ndarray, middles: np.ndarray, arcs: np.ndarray, candidates: np.ndarray,
+               middle_nodes: np.ndarray):
+        # only keep the best candidate for each arc
+        order = np.lexsort((candidates, arcs))
+        arcs, candidates, middle_nodes = arcs[order], candidates[order], middle_nodes[order]
+        first = np.ones(len(arcs), dtype=bool)
+        first[1:] = arcs[1:] != arcs[:-1]
+        arcs, candidates, middle_nodes = arcs[first], candidates[first], middle_nodes[first]
+
+        better = candidates < weights[arcs]
+        weights[arcs[better]] = candidates[better]
+        middles[arcs[better]] = middle_nodes[better]
+
+    def customize(self, edge_weights: np.ndarray) -> ContractionHierarchyMetric:
+        """
+        Calculate the arc weights for the given weights of the router edges (infinity for unusable edges).
+        """
+        num_arcs = len(self.arc_nodes)
+        metric = ContractionHierarchyMetric(
+            up=np.full(num_arcs, np.inf, dtype=np.float32),
+            down=np.full(num_arcs, np.inf, dtype=np.float32),
+            up_middle=np.full(num_arcs, -1, dtype=np.int64),
+            down_middle=np.full(num_arcs, -1, dtype=np.int64),
+        )
+        valid = self.edge_arcs >= 0
+        for weights, edges in ((metric.up, valid & self.edge_upward), (metric.down, valid & ~self.edge_upward)):
+            np.minimum.at(weights, self.edge_arcs[edges], edge_weights[edges])
+
+        # triangles whose bottom nodes are on the same level never depend on each other
+        for start, end in zip(self.triangle_indptr[:-1].tolist(), self.triangle_indptr[1:].tolist()):
+            if start == end:
+                continue
+            bottom_lower, bottom_upper, lower_upper, bottom = self.triangles[start:end].transpose()
+            # lower -> bottom -> upper
+            self._relax(metric.up, metric.up_middle, lower_upper,
+                        metric.down[bottom_lower] + metric.up[bottom_upper], bottom)
+            # upper -> bottom -> lower
+            self._relax(metric.down, metric.down_middle, lower_upper,
+                        metric.down[bottom_upper] + metric.up[bottom_lower], bottom)
+        return metric
+
+    def _search(self, weights: np.ndarray, sources: Iterable[int]) -> tuple[dict[int, float], dict[int, int]]:
+        # the upward search space of a node is its ancestors in the elimination tree, so no priority queue is needed
+        search_space = set()
+        for node in sources:
+            while node >= 0 and node not in search_space:
+                search_space.add(node)
+                node = int(self.parent[node])
+
+        distances = {node: 0.0 for node in sources}
+        predecessor_arcs = {}
+        for node in sorted(search_space, key=self.rank.__getitem__):
+            distance = distances.get(node)
+            if distance is None or distance == np.inf:
+                continue
+            for arc in range(self.arc_indptr[node], self.arc_indptr[node + 1]):
+                upper = int(self.arc_nodes[arc, 1])
+                new_distance = distance + float(weights[arc])
+                if new_distance < distances.get(upper, np.inf):
+                    distances[upper] = new_distance
+                    predecessor_arcs[upper] = arc
+        return distances, predecessor_arcs
+
+    def _unpack(self, metric: ContractionHierarchyMetric, arc: int, upward: bool) -> list[int]:
+        """
+        Unpack an arc into the nodes of the original edges it consists of, excluding the first node.
+        """
+        result = []
+        stack = [(arc, upward)]
+        while stack:
+            arc, upward = stack.pop()
+            lower, upper = self.arc_nodes[arc].tolist()
+            middle = int((metric.up_middle if upward else metric.down_middle)[arc])
+            if middle < 0:
+                result.append(upper if upward else lower)
+            elif upward:
+                # lower -> middle -> upper, pushed in reverse order
+                stack.append((self.arc(middle, upper), True))
+                stack.append((self.arc(middle, lower), False))
+            else:
+                # upper -> middle -> lower, pushed in reverse order
+                stack.append((self.arc(middle, lower), True))
+                stack.append((self.arc(middle, upper), False))
+        return result
+
+    def shortest_path(self, metric: ContractionHierarchyMetric, origin_nodes: Sequence[int],
+                      destination_nodes: Sequence[int]) -> tuple[float, tuple[int, ...]]:
+        """
+        Find the shortest path from any of the origin nodes to any of the destination nodes.
+        Returns the distance and the path nodes, or infinity and an empty tuple if there is no path.
+        """
+        forward_distances, forward_arcs = self._search(metric.up, origin_nodes)
+        backward_distances, backward_arcs = self._search(metric.down, destination_nodes)
+
+        distance, meeting_node = min(
+            ((forward_distances[node] + backward_distances[node], node)
+             for node in forward_distances.keys() & backward_distances.keys()),
+            default=(np.inf, None)
+        )
+        if distance == np.inf:
+            return np.inf, ()
+
+        # walk down from the meeting node to the origin, then from the meeting node to the destination
+        path = []
+        node = meeting_node
+        while node in forward_arcs:
+            arc = forward_arcs[node]
+            path[:0] = self._unpack(metric, arc, upward=True)
+            node = int(self.arc_nodes[arc, 0])
+        path.insert(0, node)
+
+        node = meeting_node
+        while node in backward_arcs:
+            arc = backward_arcs[node]
+            path.extend(self._unpack(metric, arc, upward=False))
+            node = int(self.arc_nodes[arc, 0])
+
+        return distance, tuple(path)
@@ -3,7 +3,8 @@ import bisect
 import math
 import operator
 import pickle
-from collections import Counter, defaultdict
+import threading
+from collections import Counter, OrderedDict, defaultdict
 from dataclasses import dataclass, field
 from enum import StrEnum
 from functools import cached_property, reduce
@@ -15,6 +16,7 @@ from uuid import UUID
 
 import matplotlib.pyplot as plt
 import numpy as np
+import shapely
 from annotated_types import Lt
 from django.conf import settings
 from pydantic.types import NonNegativeInt
@@ -33,6 +35,7 @@ from c3nav.mapdata.utils.index import Index
 from c3nav.mapdata.utils.locations import CustomLocation
 from c3nav.mapdata.utils.placement import PointPlacementHelper
 from c3nav.mesh.utils import get_nodes_and_ranging_beacons
+from c3nav.routing.exceptions import LocationUnreachable
 from c3nav.routing.router import Router, RouterSpace
 from c3nav.routing.schemas import LocateWifiPeerSchema, BeaconMeasurementDataSchema, LocateIBeaconPeerSchema, \
     RangePeerSchema
@@ -79,6 +82,9 @@ class RangeLocateKnobs:
     stepwise_factor: float = 0.511
     stepsize: float = 2129
 
+    # 'basinhopping' or 'levenberg_marquardt', not trained
+    solver: str = settings.RANGE_LOCATE_SOLVER
+
     LIMITS = (
         (0, 2),
         (-20, 50),
@@ -194,15 +200,160 @@ class RealSpace:
         return result
 
 
+@dataclass
+class RasterizedArea:
+    """
+    Distances to an area on a regular grid (zero inside), for fast vectorized lookups instead of shapely calls.
+    """
+    origin: np.ndarray  # coordinates of the first grid cell, in meters
+    resolution: float
+    distances: np.ndarray  # rows are y, columns are x
+
+    @classmethod
+    def create(cls, geometry: Polygon | MultiPolygon, resolution: float = 0.5, margin: float = 10) -> Self:
+        from scipy.ndimage import distance_transform_edt
+        minx, miny, maxx, maxy = geometry.bounds
+        xs = np.arange(minx - margin, maxx + margin + resolution, resolution)
+        ys = np.arange(miny - margin, maxy + margin + resolution, resolution)
+        inside = shapely.contains_xy(geometry, *np.meshgrid(xs, ys))
+        if inside.any():
+            distances = distance_transform_edt(~inside) * resolution
+        else:
+            distances = np.full(inside.shape, fill_value=margin)
+        return cls(
+            origin=np.array((xs[0], ys[0])),
+            resolution=resolution,
+            distances=distances.astype(np.float32),
+        )
+
+    def distance(self, xy: np.ndarray) -> np.ndarray:
+        """
+        Get the bilinearly interpolated distances for the given (n, 2) array of coordinates in meters.
+        """
+        position = (xy - self.origin) / self.resolution
+        max_position = np.array(self.distances.shape[::-1]) - 1
+        clipped = np.clip(position, 0, max_position)
+        outside = np.linalg.norm(position - clipped, axis=1) * self.resolution
+
+        x0, y0 = np.minimum(np.floor(clipped).astype(np.int64), max_position - 1).transpose()
+        fx, fy = (clipped - np.column_stack((x0, y0))).transpose()
+        d = self.distances
+        return outside + (d[y0, x0] * (1 - fx) * (1 - fy) + d[y0, x0 + 1] * fx * (1 - fy) +
+                          d[y0 + 1, x0] * (1 - fx) * fy + d[y0 + 1, x0 + 1] * fx * fy)
+
+    def inside_points(self, max_points: int) -> np.ndarray:
+        """
+        Get up to max_points (roughly) evenly distributed grid points inside the area, as coordinates in meters.
+        """
+        rows, cols = np.nonzero(self.distances == 0)
+        step = max(1, len(rows) // max_points)
+        return self.origin + np.column_stack((cols[::step], rows[::step])) * self.resolution
+
+
+@dataclass
+class RasterizedAltitudes:
+    """
+    Ground altitudes around an area on a regular grid, in centimeters, for fast vectorized lookups instead of finding
+    the space and altitude area of every point with shapely.
+    """
+    origin: np.ndarray  # coordinates of the first grid cell, in meters
+    resolution: float
+    altitudes: np.ndarray  # rows are y, columns are x
+
+    @classmethod
+    def create(cls, geometry: Polygon | MultiPolygon, spaces: Sequence[RouterSpace],
+               resolution: float = 0.5, margin: float = 10) -> Self:
+        from scipy.ndimage import distance_transform_edt
+        minx, miny, maxx, maxy = geometry.bounds
+        xs = np.arange(minx - margin, maxx + margin + resolution, resolution)
+        ys = np.arange(miny - margin, maxy + margin + resolution, resolution)
+        x, y = np.meshgrid(xs, ys)
+        points = shapely.points(x.ravel(), y.ravel())
+        altitudes = np.full(len(points), fill_value=np.nan)
+
+        # like altitudearea_for_point(): the space containing the point or the nearest one, and in there the
+        # altitude area containing the point, the nearest one within 20 meters or the first one
+        if len(spaces) == 1:
+            space_indices = np.zeros(len(points), dtype=np.int64)
+        else:
+            space_indices = np.vstack([shapely.distance(unwrap_geom(space.geometry), points)
+                                       for space in spaces]).argmin(axis=0)
+        for i, space in enumerate(spaces):
+            if not space.altitudeareas:
+                continue
+            point_indices = np.nonzero(space_indices == i)[0]
+            area_distances = np.vstack([shapely.distance(unwrap_geom(area.geometry), points[point_indices])
+                                        for area in space.altitudeareas])
+            area_indices = area_distances.argmin(axis=0)
+            area_indices[area_distances.min(axis=0) > 20] = 0
+            for j, area in enumerate(space.altitudeareas):
+                selected = point_indices[area_indices == j]
+                if len(selected):
+                    altitudes[selected] = area.get_altitudes(shapely.get_coordinates(points[selected])) * 100
+
+        # points in spaces without altitude areas get the altitude of the nearest point that has one
+        altitudes = altitudes.reshape(x.shape)
+        missing = np.isnan(altitudes)
+        if missing.all():
+            raise LocationUnreachable
+        if missing.any():
+            altitudes = altitudes[tuple(distance_transform_edt(missing, return_distances=False,
+                                                               return_indices=True))]
+        return cls(
+            origin=np.array((xs[0], ys[0])),
+            resolution=resolution,
+            altitudes=altitudes.astype(np.float32),
+        )
+
+    def altitude(self, xy: np.ndarray) -> np.ndarray:
+        """
+        Get the altitudes of the nearest grid cells for the given (n, 2) array of coordinates in meters.
+        """
+        max_position = np.array(self.altitudes.shape[::-1]) - 1
+        x, y = np.clip(np.rint((xy - self.origin) / self.resolution).astype(np.int64), 0, max_position).transpose()
+        return self.altitudes[y, x]
+
+
 @dataclass
 class LineOfSightArea:
     geometry: Polygon | MultiPolygon
     space_ids: frozenset[int]
 
+    # rasters of large areas take up a lot of memory, so only the most recently used ones are kept, in an lru cache
+    # shared by all areas. it keeps the areas themselves too, so their ids can't be reused by other areas
+    raster_cache_size = 32
+    raster_cache = OrderedDict()
+    raster_cache_lock = threading.Lock()
+
     @cached_property
     def geometry_prep(self):
         return prepared.prep(self.geometry)
 
+    def _get_cached_raster(self, kind: str, create):
+        key = (kind, id(self))
+        with self.raster_cache_lock:
+            cached = self.raster_cache.get(key)
+            if cached is not None:
+                self.raster_cache.move_to_end(key)
+                return cached[1]
+
+        raster = create()
+        with self.raster_cache_lock:
+            self.raster_cache[key] = (self, raster)
+            while len(self.raster_cache) > self.raster_cache_size:
+                self.raster_cache.popitem(last=False)
+        return raster
+
+    @property
+    def raster(self) -> RasterizedArea:
+        return self._get_cached_raster('distances', lambda: RasterizedArea.create(self.geometry))
+
+    def altitude_raster(self, router: Router) -> RasterizedAltitudes:
+        # areas belong to the locator of one map update, so they are always used with the same router
+        return self._get_cached_raster('altitudes', lambda: RasterizedAltitudes.create(
+            self.geometry, [router.spaces[space_id] for space_id in self.space_ids]
+        ))
+
     @cached_property
     def start_points(self):
         return tuple(good_representative_point(polygon) for polygon in assert_multipolygon(self.geometry))
@@ -218,7 +369,7 @@ class Locator:
     peers: list[LocatorPeer] = field(default_factory=list)
     peer_lookup: dict[TypedIdentifier, int] = field(default_factory=dict)
     xyz: np.array = field(default_factory=(lambda: np.empty((0,))))
-    spaces: dict[int, "LocatorSpace"] = field(default_factory=dict)
+    fingerprints: Optional["LocatorFingerprints"] = None
     placement_helper: Optional[PointPlacementHelper] = None
     peers_with_80211mc: frozenset[int] = field(default_factory=frozenset)
     initial_80211mc_peers: list[int] = field(default_factory=list)
@@ -487,20 +638,19 @@ class Locator:
         for peer in self.peers:
             peer.seen_with_with = dict(peer.seen_with_with.items())
 
+        points_by_space = {}
         for space in Space.objects.prefetch_related('beacon_measurements'):
-            new_space = LocatorSpace.create(
-                pk=space.pk,
-                points=tuple(
-                    LocatorPoint(
-                        x=measurement.geometry.x,
-                        y=measurement.geometry.y,
-                        values=self.convert_scans(measurement.data, create_peers=True),
-                    )
-                    for measurement in space.beacon_measurements.all()
+            points = tuple(
+                LocatorPoint(
+                    x=measurement.geometry.x,
+                    y=measurement.geometry.y,
+                    values=self.convert_scans(measurement.data, create_peers=True),
                 )
+                for measurement in space.beacon_measurements.all()
             )
-            if new_space.points:
-                self.spaces[space.pk] = new_space
+            if points:
+                points_by_space[space.pk] = points
+        self.fingerprints = LocatorFingerprints.create(points_by_space, num_peers=len(self.peers))
 
         self.placement_helper = PointPlacementHelper()
 
@@ -727,22 +877,18 @@ class Locator:
         router = Router.load()
         restrictions = router.get_restrictions(permissions)
 
-        # get visible spaces
-        spaces = tuple(space for pk, space in self.spaces.items() if pk not in restrictions.spaces)
+        if self.fingerprints is None:
+            return None
 
         # find best point
         best_peer_id = max(scan_data.items(), key=lambda v: v[1].rssi)[0]
         best_location = None
         best_score = float('inf')
-        for space in spaces:
-            point, score = space.get_best_point(scan_data, needed_peer_id=best_peer_id)
-            if point is None:
-                continue
-            if score < best_score:
-                location = CustomLocation(router.spaces[space.pk].level, point.x, point.y,
-                                          permissions=permissions, icon='my_location')
-                best_location = location
-                best_score = score
+        for point, space_id, score in self.fingerprints.get_best_points(scan_data, needed_peer_id=best_peer_id,
+                                                                        excluded_spaces=restrictions.spaces):
+            best_location = CustomLocation(router.spaces[space_id].level, point.x, point.y,
+                                           permissions=permissions, icon='my_location')
+            best_score = score
 
         if best_location is not None:
             best_location.score = best_score
@@ -1021,7 +1167,20 @@ class Locator:
         #if dimensions == 3:
         #    bounds += ((min(relevant_xyz[:, 2]), max(relevant_xyz[:, 2])),)
 
-        if False:
+        if knobs.solver == 'levenberg_marquardt':
+            from scipy.optimize import OptimizeResult
+            results = OptimizeResult(x=self._solve_range_levenberg_marquardt(
+                np_ranges=np_ranges,
+                measured_ranges=measured_ranges,
+                factors=factors,
+                must_be_in_area=must_be_in_area,
+                close_to_area=close_to_area,
+                bounds=bounds,
+                initial_guess=np.array(initial_guess, dtype=np.float64),
+                altitude_raster=None if len(initial_guess) > 2 else must_be_in_area.altitude_raster(router),
+                knobs=knobs,
+            ))
+        elif False:
             results = self.least_squares_func(
                 fun=cost_func,
                 # jac="3-point",
@@ -1184,6 +1343,96 @@ class Locator:
             space=located_space,
         )
 
+    @staticmethod
+    def _solve_range_levenberg_marquardt(np_ranges: np.ndarray, measured_ranges: np.ndarray, factors: np.ndarray,
+                                         must_be_in_area: LineOfSightArea, close_to_area: LineOfSightArea,
+                                         bounds: tuple[tuple[float, float], ...], initial_guess: np.ndarray,
+                                         altitude_raster: RasterizedAltitudes | None,
+                                         knobs: RangeLocateKnobs,
+                                         max_iterations: int = 30, max_candidates: int = 1024) -> np.ndarray:
+        """
+        Alternative to basinhopping: the same cost as in _raw_locate_range(), but evaluated for many guesses at once
+        and with rasterized areas. Starts from a linear least squares estimate and the best of a grid of points
+        inside the must be in area, then refines the best starts with Levenberg-Marquardt.
+        In 2D, the altitude of each guess is looked up in the altitude raster, like add_to_guess() does for the
+        original cost.
+        """
+        lower, upper = np.array(bounds, dtype=np.float64).transpose()
+        dimensions = len(initial_guess)
+
+        def residuals(guesses):
+            # guesses are in cm, one per row, just like in the original cost function
+            xyz = (guesses if dimensions > 2
+                   else np.column_stack((guesses, altitude_raster.altitude(guesses / 100))))
+            guess_distances = np.linalg.norm(xyz[:, np.newaxis, :] - np_ranges[np.newaxis, :, :3], axis=2)
+            inaccuracy = measured_ranges - guess_distances
+            inaccuracy = np.where(inaccuracy < 0, inaccuracy * knobs.too_far_penalty, inaccuracy) * factors
+            xy = guesses[:, :2] / 100
+            return np.column_stack((
+                inaccuracy,
+                must_be_in_area.raster.distance(xy) * knobs.must_be_in_penalty,
+                close_to_area.raster.distance(xy) * knobs.close_to_penalty,
+            ))
+
+        def costs(guesses):
+            return np.sum(residuals(guesses) ** 2, axis=1)
+
+        # linear least squares estimate: subtracting the first sphere equation from the others makes them linear
+        anchors = np_ranges[:, :dimensions]
+        squared_ranges = measured_ranges ** 2
+        if dimensions == 2:
+            # assume the altitude of the initial guess here, it's only a starting point
+            initial_z = altitude_raster.altitude(initial_guess[np.newaxis] / 100)[0]
+            squared_ranges = np.clip(squared_ranges - (np_ranges[:, 2] - initial_z) ** 2, 0, None)
+        squared_norms = np.sum(anchors ** 2, axis=1)
+        linear_estimate, *_ = np.linalg.lstsq(
+            2 * (anchors[1:] - anchors[0]),
+            squared_ranges[0] - squared_ranges[1:] + squared_norms[1:] - squared_norms[0],
+            rcond=None,
+        )
+
+        candidates = must_be_in_area.raster.inside_points(max_candidates) * 100
+        if dimensions > 2:
+            candidates = np.column_stack((candidates, np.full(len(candidates), initial_guess[2])))
+        candidates = np.clip(np.vstack((initial_guess, linear_estimate, candidates)), lower, upper)
+        candidate_costs = costs(candidates)
+
+        best_guess, best_cost = None, np.inf
+        for guess in candidates[np.argsort(candidate_costs)[:3]]:
+            cost = costs(guess[np.newaxis])[0]
+            damping = 1e-3
+            step = np.eye(dimensions)
+            for i in range(max_iterations):
+                # numerical jacobian, all probes at once
+                probes = residuals(np.vstack((guess, guess + step, guess - step)))
+                current = probes[0]
+                jacobian = (probes[1:dimensions + 1] - probes[dimensions + 1:]).transpose() / 2
+                jtj = jacobian.transpose() @ jacobian
+                gradient = jacobian.transpose() @ current
+
+                # try several dampings at once
+                dampings = damping * np.logspace(-2, 4, 7)
+                try:
+                    deltas = np.linalg.solve(
+                        jtj + dampings[:, np.newaxis, np.newaxis] * np.diag(np.diag(jtj) + 1e-9),
+                        -np.broadcast_to(gradient, (len(dampings), dimensions))[..., np.newaxis],
+                    )[..., 0]
+                except np.linalg.LinAlgError:
+                    break
+                new_guesses = np.clip(guess + deltas, lower, upper)
+                new_costs = costs(new_guesses)
+                best_i = np.argmin(new_costs)
+                if new_costs[best_i] >= cost:
+                    break
+                converged = np.linalg.norm(new_guesses[best_i] - guess) < 1
+                guess, cost, damping = new_guesses[best_i], new_costs[best_i], dampings[best_i] / 10
+                if converged:
+                    break
+            if cost < best_cost:
+                best_guess, best_cost = guess, cost
+
+        return best_guess
+
     def raw_locate_range(self, scan_data: ScanData, debug=settings.DEBUG,
                          knobs: RangeLocateKnobs | None = None) -> RawRangeLocatorResult | None:
         if knobs is None:
@@ -1350,60 +1599,91 @@ no_signal = int(-90)**2
 
 
 @dataclass
-class LocatorSpace:
-    pk: int
+class LocatorFingerprints:
+    """
+    RSSI fingerprints of all measurement points of all spaces. Values are stored sparsely by peer (like a csc matrix),
+    so matching a scan only touches the columns of the peers in that scan, for all points at once.
+    """
     points: list[LocatorPoint]
-    peer_ids: frozenset[int]
-    peer_lookup: dict[int, int]
-    levels: np.array
+    space_ids: np.ndarray  # space id of every space that has points
+    point_spaces: np.ndarray  # index into space_ids for every point
+    peer_indptr: np.ndarray  # values of peer i are at peer_indptr[i]:peer_indptr[i+1]
+    point_indices: np.ndarray  # point of every value
+    levels: np.ndarray  # every value, no_signal if the point saw the peer but has no rssi for it
 
     @classmethod
-    def create(cls, pk: int, points: Sequence[LocatorPoint]):
-        peer_set = reduce(operator.or_, (frozenset(point.values.keys()) for point in points), frozenset())
-        peers = tuple(peer_set)
-        peer_lookup = {peer_id: i for i, peer_id in enumerate(peers)}
-        levels = np.full((len(points), len(peers)), fill_value=no_signal, dtype=np.int64)
-        for i, point in enumerate(points):
-            for peer_id, value in point.values.items():
-                if value.rssi is None:
-                    continue  # todo: ibeaconrange
-                levels[i][peer_lookup[peer_id]] = int(value.rssi)**2
-
+    def create(cls, points_by_space: dict[int, Sequence[LocatorPoint]], num_peers: int):
+        points = []
+        point_spaces = []
+        values = []
+        for space_i, space_points in enumerate(points_by_space.values()):
+            for point in space_points:
+                for peer_id, value in point.values.items():
+                    # todo: ibeaconrange
+                    values.append((peer_id, len(points), no_signal if value.rssi is None else int(value.rssi)**2))
+                points.append(point)
+                point_spaces.append(space_i)
+
+        values = np.array(values, dtype=np.int64).reshape((-1, 3))
+        values = values[np.argsort(values[:, 0], kind='stable')]
         return cls(
-            pk=pk,
-            points=list(points),
-            peer_ids=peer_set,
-            peer_lookup=peer_lookup,
-            levels=levels,
-        )
-
-    def get_best_point(self, scan_values: ScanData,
-                       needed_peer_id=None) -> tuple[LocatorPoint, float] | tuple[None, None]:
-        # check if this space knows the needed peer id, otherwise no results here
-        if needed_peer_id not in self.peer_ids:
-            return None, None
-
-        # peers that this space knows
-        peer_ids = frozenset(scan_values.keys()) & self.peer_ids
-        penalty = 0
-        for peer_id, value in scan_values.items():
-            if peer_id not in self.peer_ids:
-                penalty += (value.rssi - no_signal)**2
-
-        peers = tuple(self.peer_lookup[peer_id] for peer_id in peer_ids)
-        values = np.array(tuple(scan_values[peer_id].rssi for peer_id in peer_ids), dtype=np.int64)
-
-        # acceptable points need to have a value for the needed_peer_id
-        points = tuple(
-            np.argwhere(self.levels[:, self.peer_lookup[needed_peer_id]] > 0).ravel()
+            points=points,
+            space_ids=np.array(tuple(points_by_space.keys()), dtype=np.int64),
+            point_spaces=np.array(point_spaces, dtype=np.int64),
+            peer_indptr=np.searchsorted(values[:, 0], np.arange(num_peers + 1)),
+            point_indices=values[:, 1],
+            levels=values[:, 2],
         )
-        if not points:
-            return None, None
 
+    def get_scores(self, scan_values: ScanData, needed_peer_id=None,
+                   excluded_spaces: Iterable[int] = ()) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Score all points against the given scan, lower is better. Peers that a space never saw are penalized.
+        Only points in spaces that know the needed peer id and are not excluded are returned, as indices and scores.
+        """
+        scan_peer_ids = tuple(peer_id for peer_id in scan_values.keys() if peer_id < len(self.peer_indptr) - 1)
+        values = np.array(tuple(scan_values[peer_id].rssi for peer_id in scan_peer_ids), dtype=np.int64)
+
+        levels = np.full((len(self.points), len(scan_peer_ids)), fill_value=no_signal, dtype=np.int64)
+        known = np.zeros((len(self.space_ids), len(scan_peer_ids)), dtype=bool)
+        for i, peer_id in enumerate(scan_peer_ids):
+            values_slice = slice(self.peer_indptr[peer_id], self.peer_indptr[peer_id + 1])
+            point_indices = self.point_indices[values_slice]
+            levels[point_indices, i] = self.levels[values_slice]
+            known[self.point_spaces[point_indices], i] = True
+        known = known[self.point_spaces]
+
+        # peers that are not in the fingerprints at all are unknown for every space
+        penalty = sum((value.rssi - no_signal)**2 for peer_id, value in scan_values.items()
+                      if peer_id >= len(self.peer_indptr) - 1)
         scores = (np.sum(
-            (self.levels[np.array(points, dtype=np.uint32).reshape((-1, 1)), peers] - values)**2,
+            np.where(known, (levels - values)**2, (values - no_signal)**2),
             axis=1
-        )+penalty) / len(scan_values)
-        best_point_i = np.argmin(scores).ravel()[0]
-        best_point = points[best_point_i]
-        return self.points[best_point], scores[best_point_i]
+        ) + penalty) / len(scan_values)
+
+        # check if the space knows the needed peer id, otherwise no results there
+        mask = np.isin(self.point_spaces, np.flatnonzero(np.isin(self.space_ids, tuple(excluded_spaces))),
+                       invert=True)
+        if needed_peer_id is not None:
+            if needed_peer_id not in scan_peer_ids:
+                return np.empty((0, ), dtype=np.int64), np.empty((0, ), dtype=np.float64)
+            mask &= known[:, scan_peer_ids.index(needed_peer_id)]
+
+        point_indices = np.flatnonzero(mask)
+        return point_indices, scores[point_indices]
+
+    def get_best_points(self, scan_values: ScanData, needed_peer_id=None, excluded_spaces: Iterable[int] = (),
+                        k: int = 1) -> list[tuple[LocatorPoint, int, float]]:
+        """
+        Get the k best matching points for the given scan as (point, space id, score), best first.
+        """
+        point_indices, scores = self.get_scores(scan_values, needed_peer_id=needed_peer_id,
+                                                excluded_spaces=excluded_spaces)
+        if k == 1:
+            best = scores.argmin(keepdims=True) if len(scores) else np.empty((0, ), dtype=np.int64)
+        else:
+            best = np.argsort(scores, kind='stable')[:k]
+        return [
+            (self.points[point_i], int(self.space_ids[self.point_spaces[point_i]]), float(score))
+            for point_i, score in zip(point_indices[best].tolist(), scores[best].tolist())
+        ]
@@ -0,0 +1,274 @@
+import json
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+from decimal import Decimal
+from pathlib import Path
+
+import numpy as np
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from django.test.utils import override_settings, setup_databases, teardown_databases
+from shapely import Point, box
+
+from c3nav import __version__ as c3nav_version
+from c3nav.mapdata.models import AltitudeArea, GraphEdge, GraphNode, Level, MapUpdate, Space, WayType
+from c3nav.mapdata.models.geometry.space import BeaconMeasurement, RangingBeacon
+from c3nav.mapdata.utils.cache.local import per_request_cache
+from c3nav.mapdata.utils.locations import CustomLocation
+from c3nav.routing.schemas import BeaconMeasurementDataSchema, LocateWifiPeerSchema
+
+
+class Command(BaseCommand):
+    help = 'benchmark routing and positioning against a synthetic venue in a temporary database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--levels', type=int, default=3, help='number of levels')
+        parser.add_argument('--spaces', type=int, default=6,
+                            help='spaces per level side, every level is a grid of spaces')
+        parser.add_argument('--nodes', type=int, default=5, help='graph nodes per space side')
+        parser.add_argument('--beacons', type=int, default=8, help='ranging beacons per level')
+        parser.add_argument('--measurements', type=int, default=2, help='beacon measurements per space')
+        parser.add_argument('--algorithm', choices=('matrix', 'dijkstra', 'cch'), default=settings.ROUTING_ALGORITHM,
+                            help='routing algorithm to benchmark (default: routing_algorithm)')
+        parser.add_argument('--iterations', type=int, default=100, help='iterations per benchmark')
+        parser.add_argument('--seed', type=int, default=0, help='random seed')
+        parser.add_argument('--output', default='-', help='file to write the json results to, - for stdout')
+
+    space_size = 10
+    ssid = 'c3nav-benchmark'
+
+    def handle(self, *args, **options):
+        self.rng = np.random.default_rng(options['seed'])
+        if settings.WIFI_SSIDS:
+            self.ssid = settings.WIFI_SSIDS[0]
+
+        # never touch the configured caches, the benchmark fills them with results for a venue that doesn't exist
+        local_caches = {
+            alias: {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'benchmark-%s' % alias}
+            for alias in settings.CACHES
+        }
+
+        old_config = setup_databases(verbosity=0, interactive=False)
+        try:
+            with tempfile.TemporaryDirectory() as cache_root, override_settings(CACHE_ROOT=Path(cache_root),
+                                                                                CACHES=local_caches,
+                                                                                ROUTING_ALGORITHM=options['algorithm']):
+                result = self.run_benchmarks(options)
+        finally:
+            teardown_databases(old_config, verbosity=0)
+
+        output = json.dumps(result, indent=2)
+        if options['output'] == '-':
+            self.stdout.write(output)
+        else:
+            Path(options['output']).write_text(output)
+
+    def create_venue(self, options):
+        num_spaces, num_nodes = options['spaces'], options['nodes']
+        stairs = WayType.objects.create(titles={'en': 'Stairs'}, titles_plural={'en': 'Stairs'}, color='#ff0000',
+                                        speed=Decimal('0.5'), speed_up=Decimal('0.3'))
+
+        spaces = []
+        previous_grid = None
+        for level_i in range(options['levels']):
+            level = Level.objects.create(titles={'en': 'Level %d' % level_i}, base_altitude=Decimal(level_i * 4),
+                                         short_label=str(level_i), level_index=str(level_i))
+            size = num_spaces * self.space_size
+            AltitudeArea.objects.create(level=level, geometry=box(0, 0, size, size).buffer(0),
+                                        altitude=level.base_altitude)
+            level_spaces = Space.objects.bulk_create(
+                Space(level=level, titles={'en': 'Space %d.%d.%d' % (level_i, x, y)},
+                      geometry=box(x * self.space_size, y * self.space_size,
+                                   (x + 1) * self.space_size, (y + 1) * self.space_size))
+                for x in range(num_spaces) for y in range(num_spaces)
+            )
+            spaces.extend(level_spaces)
+
+            # a grid of nodes over the whole level, connected in both directions
+            step = self.space_size / num_nodes
+            coords = (np.arange(num_spaces * num_nodes) + 0.5) * step
+            node_grid = np.array(GraphNode.objects.bulk_create(
+                GraphNode(space=level_spaces[int(x // self.space_size) * num_spaces + int(y // self.space_size)],
+                          geometry=Point(x, y))
+                for x in coords for y in coords
+            ), dtype=object).reshape((len(coords), len(coords)))
+            edges = []
+            for a, b in chain_pairs(node_grid):
+                edges.append(GraphEdge(from_node=a, to_node=b))
+                edges.append(GraphEdge(from_node=b, to_node=a))
+            if previous_grid is not None:
+                for a, b in ((previous_grid[0, 0], node_grid[0, 0]), (previous_grid[-1, -1], node_grid[-1, -1])):
+                    edges.append(GraphEdge(from_node=a, to_node=b, waytype=stairs))
+                    edges.append(GraphEdge(from_node=b, to_node=a, waytype=stairs))
+            GraphEdge.objects.bulk_create(edges)
+            previous_grid = node_grid
+
+            # beacons, with some fingerprint measurements in every space
+            beacons = RangingBeacon.objects.bulk_create(
+                RangingBeacon(space=level_spaces[int(x // self.space_size) * num_spaces + int(y // self.space_size)],
+                              geometry=Point(x, y), addresses=[self.random_mac()], altitude=Decimal('2'))
+                for x, y in self.rng.uniform(0.5, size - 0.5, (options['beacons'], 2))
+            )
+            BeaconMeasurement.objects.bulk_create(
+                BeaconMeasurement(space=space, geometry=point,
+                                  data=BeaconMeasurementDataSchema(wifi=[self.scan(point, level_i, beacons)]))
+                for space in level_spaces
+                for point in (Point(*xy) for xy in self.rng.uniform(space.geometry.bounds[:2],
+                                                                    space.geometry.bounds[2:],
+                                                                    (options['measurements'], 2)))
+            )
+        return spaces
+
+    def random_mac(self):
+        return ':'.join('%02x' % i for i in (0x02, *self.rng.integers(0, 256, 5)))
+
+    def scan(self, point: Point, level_i: int, beacons) -> list[LocateWifiPeerSchema]:
+        result = []
+        for beacon in beacons:
+            distance = max(point.distance(beacon.geometry), 0.5)
+            result.append(LocateWifiPeerSchema(
+                bssid=beacon.addresses[0],
+                ssid=self.ssid,
+                rssi=min(-1, int(-40 - 25 * np.log10(distance) + self.rng.normal(0, 3) - level_i * 10)),
+                distance=float(distance + self.rng.normal(0, 1)),
+                distance_sd=0.5,
+            ))
+        return result
+
+    def benchmark(self, func, args_list, iterations: int) -> dict:
+        durations = []
+        for i in range(iterations):
+            args = args_list[i % len(args_list)]
+            start = time.perf_counter()
+            func(*args)
+            durations.append(time.perf_counter() - start)
+
+        # measure memory separately, tracing slows everything down
+        tracemalloc.start()
+        func(*args_list[0])
+        peak_memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        durations = np.array(durations) * 1000
+        return {
+            'iterations': iterations,
+            'mean_ms': round(float(durations.mean()), 4),
+            'min_ms': round(float(durations.min()), 4),
+            **{'p%d_ms' % p: round(float(np.percentile(durations, p)), 4) for p in (50, 90, 99)},
+            'max_ms': round(float(durations.max()), 4),
+            'peak_memory_bytes': peak_memory,
+        }
+
+    def run_benchmarks(self, options):
+        from c3nav.routing.locator import Locator
+        from c3nav.routing.models import RouteOptions
+        from c3nav.routing.router import Router
+
+        start = time.perf_counter()
+        spaces = self.create_venue(options)
+        create_duration = time.perf_counter() - start
+
+        # without any map updates, the last processed update is (0, 0)
+        per_request_cache.clear()
+        update = MapUpdate.last_processed_update()
+        (settings.CACHE_ROOT / MapUpdate.build_cache_key(*update)).mkdir(parents=True)
+
+        start = time.perf_counter()
+        router = Router.rebuild(update)
+        router_duration = time.perf_counter() - start
+        start = time.perf_counter()
+        locator = Locator.rebuild(update, router)
+        locator_duration = time.perf_counter() - start
+
+        router = Router.load()
+        locator = Locator.load()
+        iterations = options['iterations']
+        options_ = RouteOptions()
+        restrictions = router.get_restrictions(set())
+
+        pairs = [tuple(spaces[i] for i in self.rng.choice(len(spaces), 2, replace=False))
+                 for j in range(iterations)]
+        points = [
+            (space, Point(*self.rng.uniform(space.geometry.bounds[:2], space.geometry.bounds[2:])))
+            for space in (spaces[i] for i in self.rng.integers(0, len(spaces), iterations))
+        ]
+        node_pairs = [((int(a), ), (int(b), )) for a, b in self.rng.integers(0, len(router.nodes), (iterations, 2))]
+        levels = {level.pk: level for level in Level.objects.all()}
+        beacons = {level_id: [] for level_id in levels}
+        for beacon in RangingBeacon.objects.select_related('space'):
+            beacons[beacon.space.level_id].append(beacon)
+        scans = [
+            locator.convert_raw_scan_data(self.scan(point, int(levels[space.level_id].level_index),
+                                                    beacons[space.level_id]))
+            for space, point in points
+        ]
+
+        def prepare_path_finder():
+            # measure the preparation of the configured algorithm itself, not the caches that keep its results
+            cache.clear()
+            router.hierarchy_metrics.clear()
+            return router.get_path_finder(restrictions, options_)
+
+        find_path = router.get_path_finder(restrictions, options_)
+
+        results = {
+            'router.get_route': self.benchmark(
+                lambda origin, destination: router.get_route(origin, destination, permissions=set(),
+                                                             options=options_, visible_locations={}),
+                pairs, iterations,
+            ),
+            'router.get_path_finder': self.benchmark(
+                prepare_path_finder,
+                [()], max(1, iterations // 20),
+            ),
+            'router.find_path': self.benchmark(
+                find_path,
+                node_pairs, iterations,
+            ),
+            'router.describe_custom_location': self.benchmark(
+                router.describe_custom_location,
+                [(CustomLocation(levels[space.level_id], point.x, point.y), ) for space, point in points],
+                iterations,
+            ),
+            'locator.locate_range': self.benchmark(
+                lambda scan_data: locator.locate_range(scan_data, debug=False),
+                [(scan_data, ) for scan_data in scans], iterations,
+            ),
+            'locator.locate_rssi': self.benchmark(
+                locator.locate_rssi,
+                [(scan_data, ) for scan_data in scans], iterations,
+            ),
+        }
+
+        return {
+            'meta': {
+                'version': c3nav_version,
+                'python': sys.version.split()[0],
+                'numpy': np.__version__,
+                'machine': platform.machine(),
+                'routing_algorithm': settings.ROUTING_ALGORITHM,
+                'range_locate_solver': settings.RANGE_LOCATE_SOLVER,
+                **{name: options[name] for name in ('levels', 'spaces', 'nodes', 'beacons', 'measurements',
+                                                    'iterations', 'seed')},
+                'graph_nodes': len(router.nodes),
+                'graph_edges': len(router.edges),
+            },
+            'build': {
+                'create_venue_s': round(create_duration, 4),
+                'router_rebuild_s': round(router_duration, 4),
+                'locator_rebuild_s': round(locator_duration, 4),
+            },
+            'results': results,
+        }
+
+
+def chain_pairs(grid: np.ndarray):
+    """
+    All pairs of horizontally or vertically neighboring items of a 2d grid.
+    """
+    yield from zip(grid[:-1, :].ravel(), grid[1:, :].ravel())
+    yield from zip(grid[:, :-1].ravel(), grid[:, 1:].ravel())
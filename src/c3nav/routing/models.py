@@ -185,13 +185,15 @@ class RouteOptions(models.Model):
             for name, field in self.get_fields().items()
         ]
 
-    def serialize_string(self):
-        return ','.join('%s=%s' % (key, val) for key, val in self.data.items())
+    def serialize_string(self, only_changed=False):
+        fields = self.get_fields()
+        return ','.join('%s=%s' % (key, val) for key, val in self.data.items()
+                        if not only_changed or val != fields[key].initial)
 
     @classmethod
     def unserialize_string(cls, data):
         return RouteOptions(
-            data=dict(item.split('=') for item in data.split(','))
+            data=dict(item.split('=') for item in data.split(',') if item)
         )
 
     def save(self, *args, **kwargs):
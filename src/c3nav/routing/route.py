@@ -44,7 +44,11 @@ class Route:
     destination_xyz: np.ndarray | None
     visible_locations: Mapping[int, Location]
 
-    def serialize(self):  # todo: move this into schema
+    def get_nodes(self) -> tuple[list[RouteNodeWithOptionalEdge], float, float]:
+        """
+        Get the route nodes including the origin and destination additions, and the straight distances from the
+        origin to the first node and from the last node to the destination.
+        """
         nodes: list[RouteNodeWithOptionalEdge] = [
             RouteNodeWithOptionalEdge(node=node, edge=None) for node in self.path_nodes
         ]
@@ -73,6 +77,11 @@ class Route:
         else:
             destination_distance = 0
 
+        return nodes, origin_distance, destination_distance
+
+    def serialize(self):  # todo: move this into schema
+        nodes, origin_distance, destination_distance = self.get_nodes()
+
         items: deque[RouteItem] = deque()
         last_node = None
         last_item = None
@@ -81,7 +90,7 @@ class Route:
         duration = origin_distance * walk_factor
         for i, (node, edge) in enumerate(nodes):
             if edge is None:
-                edge = self.router.edges[last_node, node] if last_node else None
+                edge = self.router.edges[last_node, node] if last_node is not None else None
             node_obj = self.router.nodes[node] if isinstance(node, (int, np.int32, np.int64)) else node
             item = RouteItem(self, node_obj, edge, last_item)
             if edge:
@@ -190,6 +199,36 @@ class Route:
             ('items', items),
         ))
 
+    def serialize_summary(self, path=False):
+        """
+        Only the distance and duration of this route and optionally the coordinates of its nodes,
+        without building route items and descriptions.
+        """
+        nodes, origin_distance, destination_distance = self.get_nodes()
+        walk_factor = self.options.walk_factor
+        distance = origin_distance + destination_distance
+        duration = distance * walk_factor
+        coordinates = []
+        last_node = None
+        for node, edge in nodes:
+            if edge is None:
+                edge = self.router.edges[last_node, node] if last_node is not None else None
+            if edge:
+                distance += edge.distance
+                duration += self.router.waytypes[edge.waytype].get_duration(edge, walk_factor)
+            if path:
+                node_obj = self.router.nodes[node] if isinstance(node, (int, np.int32, np.int64)) else node
+                coordinates.append((node_obj.x, node_obj.y, node_obj.altitude))
+            last_node = node
+
+        result = OrderedDict((
+            ('distance', round(distance, 1)),
+            ('duration', round(duration)),
+        ))
+        if path:
+            result['path'] = coordinates
+        return result
+
     @property
     def options_summary(self):
         options_summary = [
@@ -1,12 +1,15 @@
 import logging
 import operator
 import pickle
-from collections import deque, namedtuple
+from collections import OrderedDict, deque, namedtuple
 from dataclasses import dataclass, field
 from functools import reduce
+from hashlib import sha256
 from itertools import chain
 from operator import itemgetter
-from typing import Optional, TypeVar, Generic, Mapping, Any, Sequence, TypeAlias, ClassVar, NamedTuple
+from pathlib import Path
+from typing import (Optional, TypeVar, Generic, Mapping, Any, Sequence, TypeAlias, ClassVar, NamedTuple, Iterator,
+                    Iterable, Callable)
 
 import numpy as np
 from django.conf import settings
@@ -14,6 +17,7 @@ from django.core.cache import cache
 from django.utils.functional import cached_property, Promise
 from shapely import prepared
 from shapely.geometry import LineString, Point, Polygon, MultiPolygon
+from shapely.geometry.base import BaseGeometry
 from shapely.ops import unary_union
 from twisted.protocols.amp import Decimal
 
@@ -21,12 +25,17 @@ from c3nav.mapdata.models import AltitudeArea, Area, GraphEdge, Level, LocationG
 from c3nav.mapdata.models.geometry.level import AltitudeAreaPoint
 from c3nav.mapdata.models.geometry.space import POI, CrossDescription, LeaveDescription
 from c3nav.mapdata.models.locations import CustomLocationProxyMixin, Location
-from c3nav.mapdata.utils.geometry import assert_multipolygon, get_rings, good_representative_point, unwrap_geom
+from c3nav.mapdata.utils.cache.types import MapUpdateTuple
+from c3nav.mapdata.utils.geometry import (assert_multipolygon, get_rings, good_representative_point, unwrap_geom,
+                                          WrappedWKBGeometry)
 from c3nav.mapdata.utils.index import Index
 from c3nav.mapdata.utils.locations import CustomLocation
+from c3nav.mapdata.utils.processes import fork_map
+from c3nav.routing.cch import ContractionHierarchy, ContractionHierarchyMetric
 from c3nav.routing.exceptions import LocationUnreachable, NoRouteFound, NotYetRoutable
 from c3nav.routing.models import RouteOptions
 from c3nav.routing.route import Route
+from c3nav.routing.utils.mapped import dump_mapped, load_mapped
 
 try:
     from asgiref.local import Local as LocalContext
@@ -44,6 +53,8 @@ class RouterNodeAndEdge(NamedTuple):
 NodeConnectionsByNode: TypeAlias = dict[int, RouterNodeAndEdge]
 PointCompatible: TypeAlias = Point | CustomLocation | CustomLocationProxyMixin
 EdgeIndex: TypeAlias = tuple[int, int]
+# (origin nodes, destination nodes) -> (origin node, destination node, path nodes)
+PathFinder: TypeAlias = Callable[[Iterable[int], Iterable[int]], tuple[int, int, tuple[int, ...]]]
 
 
 @dataclass
@@ -56,23 +67,64 @@ class Router:
     pois: dict[int, "RouterPoint"]
     groups: dict[int, "RouterGroup"]
     restrictions: dict[int, "RouterRestriction"]
-    nodes: deque["RouterNode"]
+    nodes: "RouterNodes"
     edges: dict[EdgeIndex, "RouterEdge"]
     waytypes: dict[int, "RouterWayType"]
-    graph: np.ndarray
+    edge_nodes: np.ndarray  # (from_node, to_node) of every edge, sorted
+    edge_weights: np.ndarray  # base weight of every edge, same order as edge_nodes
+    hierarchy: ContractionHierarchy | None = None  # only built if ROUTING_ALGORITHM is 'cch'
+
+    # how many customized contraction hierarchy metrics to keep per router
+    hierarchy_metrics_size: ClassVar = 16
 
     @staticmethod
     def get_altitude_in_areas(areas, point):
         return max(area.get_altitudes(point)[0] for area in areas if area.geometry_prep.intersects(point))
 
     @classmethod
-    def rebuild(cls, update):
+    def rebuild(cls, update, changed_geometries: Mapping[int, BaseGeometry] | None = None,
+                previous_update: MapUpdateTuple | None = None):
+        """
+        Rebuild the router for the given update.
+        If changed_geometries (by level) and the previous update are given, the space geometry calculations of the
+        previous update are reused for all spaces that don't intersect the changed geometries.
+        """
+        previous_space_geometries: dict[int, RouterSpaceGeometries] = {}
+        if changed_geometries is not None and previous_update is not None:
+            previous_space_geometries = cls.load_space_geometries(previous_update)
+        space_geometries: dict[int, RouterSpaceGeometries] = {}
+        reused_spaces = 0
+
         levels_query = Level.objects.prefetch_related('buildings', 'spaces', 'altitudeareas', 'groups',
                                                       'spaces__holes', 'spaces__columns', 'spaces__groups',
                                                       'spaces__obstacles', 'spaces__lineobstacles',
                                                       'spaces__graphnodes', 'spaces__areas', 'spaces__areas__groups',
                                                       'spaces__pois',  'spaces__pois__groups')
 
+        # calculate space geometries first, so this can be done in parallel
+        space_geometries_args: dict[int, tuple] = {}
+        for level in levels_query:
+            buildings_geom = unary_union(tuple(unwrap_geom(building.geometry) for building in level.buildings.all()))
+            level_changed_geometry = None if changed_geometries is None else changed_geometries.get(level.pk)
+            for altitudearea in level.altitudeareas.all():
+                altitudearea.geometry = unwrap_geom(altitudearea.geometry).buffer(0)
+
+            for space in level.spaces.all():
+                # reuse space geometries from the previous update if they are unaffected
+                signature = RouterSpaceGeometries.get_signature(space)
+                previous = previous_space_geometries.get(space.pk)
+                if (previous is not None and previous.signature == signature and (
+                        level_changed_geometry is None or
+                        not level_changed_geometry.intersects(unwrap_geom(space.geometry)))):
+                    space_geometries[space.pk] = previous
+                    reused_spaces += 1
+                else:
+                    space_geometries_args[space.pk] = RouterSpaceGeometries.get_build_args(
+                        space, signature=signature, buildings_geom=buildings_geom,
+                        altitudeareas=level.altitudeareas.all()
+                    )
+        space_geometries.update(RouterSpaceGeometries.build_many(space_geometries_args))
+
         levels: dict[int, RouterLevel] = {}
         spaces: dict[int, RouterSpace] = {}
         areas: dict[int, RouterArea] = {}
@@ -81,8 +133,6 @@ class Router:
         restrictions: dict[int, RouterRestriction] = {}
         nodes: deque[RouterNode] = deque()
         for level in levels_query:
-            buildings_geom = unary_union(tuple(unwrap_geom(building.geometry) for building in level.buildings.all()))
-
             nodes_before_count = len(nodes)
 
             for group in level.groups.all():
@@ -94,20 +144,8 @@ class Router:
                 )
 
             for space in level.spaces.all():
-                # create space geometries
-                accessible_geom = space.geometry.difference(unary_union(
-                    tuple(unwrap_geom(column.geometry)
-                          for column in space.columns.all()
-                          if column.access_restriction_id is None) +
-                    tuple(unwrap_geom(hole.geometry) for hole in space.holes.all()) +
-                    ((buildings_geom, ) if space.outside else ())
-                ))
-                obstacles_geom = unary_union(
-                    tuple(unwrap_geom(obstacle.geometry) for obstacle in space.obstacles.all()) +
-                    tuple(unwrap_geom(lineobstacle.buffered_geometry) for lineobstacle in space.lineobstacles.all())
-                )
-                clear_geom = unary_union(tuple(get_rings(accessible_geom.difference(obstacles_geom))))
-                clear_geom_prep = prepared.prep(clear_geom)
+                accessible_geom = unwrap_geom(space_geometries[space.pk].accessible_geometry)
+                clear_geom_prep = prepared.prep(unwrap_geom(space_geometries[space.pk].clear_geometry))
 
                 for group in space.groups.all():
                     groups.setdefault(group.pk, RouterGroup()).spaces.add(space.pk)
@@ -141,30 +179,21 @@ class Router:
                     areas[area.pk] = area
                     space.areas.add(area.pk)
 
-                for area in level.altitudeareas.all():
-                    area.geometry = unwrap_geom(area.geometry).buffer(0)
-                    if not space.geometry_prep.intersects(unwrap_geom(area.geometry)):
-                        continue
-                    for subgeom in assert_multipolygon(accessible_geom.intersection(unwrap_geom(area.geometry))):
-                        if subgeom.is_empty:
-                            continue
-                        area_clear_geom = unary_union(tuple(get_rings(subgeom.difference(obstacles_geom))))
-                        if area_clear_geom.is_empty:
-                            continue
-                        area = RouterAltitudeArea(
-                            geometry=subgeom,
-                            clear_geometry=area_clear_geom,
-                            altitude=area.altitude,
-                            points=area.points
-                        )
-                        area_nodes = tuple(node for node in space_nodes if area.geometry_prep.intersects(node.point))
-                        area.nodes = set(node.i for node in area_nodes)
-                        for node in area_nodes:
-                            altitude = area.get_altitude(node)
-                            if node.altitude is None or node.altitude < altitude:
-                                node.altitude = altitude
+                for area in space_geometries[space.pk].altitudeareas:
+                    area = RouterAltitudeArea(
+                        geometry=unwrap_geom(area.geometry),
+                        clear_geometry=unwrap_geom(area.clear_geometry),
+                        altitude=area.altitude,
+                        points=area.points
+                    )
+                    area_nodes = tuple(node for node in space_nodes if area.geometry_prep.intersects(node.point))
+                    area.nodes = set(node.i for node in area_nodes)
+                    for node in area_nodes:
+                        altitude = area.get_altitude(node)
+                        if node.altitude is None or node.altitude < altitude:
+                            node.altitude = altitude
 
-                        space.altitudeareas.append(area)
+                    space.altitudeareas.append(area)
 
                 for node in space_nodes:
                     if node.altitude is not None:
@@ -233,7 +262,7 @@ class Router:
 
                 space_obj._prefetched_objects_cache = {}
 
-                space.src.geometry = accessible_geom
+                space.src.geometry = WrappedWKBGeometry.wrap(accessible_geom)
 
                 spaces[space.pk] = space
 
@@ -276,11 +305,11 @@ class Router:
         )
         edges = {(edge.from_node, edge.to_node): edge for edge in edges}
 
-        # build graph matrix
-        graph = np.full(shape=(len(nodes), len(nodes)), fill_value=np.inf, dtype=np.float32)
+        # build edge arrays, sorted by from_node and to_node so they can be looked up and turned into a csr matrix
+        edge_nodes = np.array(sorted(edges.keys()), dtype=np.uint32).reshape((-1, 2))
+        edge_weights = np.array(tuple(edges[index].distance for index in sorted(edges.keys())), dtype=np.float32)
         for edge in edges.values():
             index = (edge.from_node, edge.to_node)
-            graph[index] = edge.distance
             waytype = waytypes[edge.waytype]
             (waytype.upwards_indices if edge.rise > 0 else waytype.nonupwards_indices).append(index)
             if edge.access_restriction:
@@ -289,8 +318,11 @@ class Router:
         # respect slow_down_factor
         for area in areas.values():
             if area.slow_down_factor != 1:
-                area_nodes = np.array(tuple(area.nodes), dtype=np.uint32)
-                graph[area_nodes.reshape((-1, 1)), area_nodes] *= float(area.slow_down_factor)
+                area_nodes = np.zeros(len(nodes), dtype=bool)
+                area_nodes[np.array(tuple(area.nodes), dtype=np.uint32)] = True
+                edge_weights[area_nodes[edge_nodes[:, 0]] & area_nodes[edge_nodes[:, 1]]] *= float(
+                    area.slow_down_factor
+                )
 
         # finalize waytype matrixes
         for waytype in waytypes:
@@ -308,14 +340,33 @@ class Router:
             pois=pois,
             groups=groups,
             restrictions=restrictions,
-            nodes=nodes,
+            nodes=RouterNodes.from_nodes(nodes),
             edges=edges,
             waytypes=waytypes,
-            graph=graph
+            edge_nodes=edge_nodes,
+            edge_weights=edge_weights,
+            hierarchy=(ContractionHierarchy.build(len(nodes), edge_nodes)
+                       if settings.ROUTING_ALGORITHM == 'cch' else None),
         )
-        pickle.dump(router, open(cls.build_filename(update), 'wb'))
+        dump_mapped(router, cls.build_filename(update))
+        with open(cls.space_geometries_filename(update), 'wb') as f:
+            pickle.dump(space_geometries, f)
+        logger.info('Reused geometries of %d of %d spaces.' % (reused_spaces, len(space_geometries)))
         return router
 
+    @classmethod
+    def space_geometries_filename(cls, update):
+        return settings.CACHE_ROOT / MapUpdate.build_cache_key(*update) / 'router_spaces.pickle'
+
+    @classmethod
+    def load_space_geometries(cls, update) -> dict[int, "RouterSpaceGeometries"]:
+        try:
+            with open(cls.space_geometries_filename(update), 'rb') as f:
+                return pickle.load(f)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            logger.info('No router space geometries found for previous update, rebuilding everything.')
+            return {}
+
     def build_indexes(self):
         # can't be precalculated because of this bug: https://github.com/Toblerity/rtree/issues/87
         for level_id, level in self.levels.items():
@@ -335,7 +386,7 @@ class Router:
 
     @classmethod
     def load_nocache(cls, update):
-        router = pickle.load(open(cls.build_filename(update), 'rb'))
+        router = load_mapped(cls.build_filename(update))
         router.build_indexes()
         return router
 
@@ -488,18 +539,34 @@ class Router:
         from scipy.sparse.csgraph import shortest_path
         return shortest_path
 
-    def shortest_path(self, restrictions, options):
-        options_key = options.serialize_string()
-        cache_key = 'router:shortest_path:%s:%s:%s' % (MapUpdate.current_processed_cache_key(),
-                                                       restrictions.cache_key,
-                                                       options_key)
-        result = cache.get(cache_key)
-        if result:
-            distances, predecessors = result
-            return (np.frombuffer(distances, dtype=np.float32).reshape(self.graph.shape),
-                    np.frombuffer(predecessors, dtype=np.int32).reshape(self.graph.shape))
+    @cached_property
+    def dijkstra_func(self):
+        from scipy.sparse.csgraph import dijkstra
+        return dijkstra
 
-        graph = self.graph.copy()
+    @cached_property
+    def edge_keys(self) -> np.ndarray:
+        return self.edge_nodes[:, 0].astype(np.int64) * len(self.nodes) + self.edge_nodes[:, 1]
+
+    def edge_positions(self, indices: np.ndarray) -> np.ndarray:
+        """
+        Get the positions of the given edges (array of (from_node, to_node) pairs) in edge_nodes and edge_weights.
+        """
+        indices = np.asarray(indices, dtype=np.int64).reshape((-1, 2))
+        return np.searchsorted(self.edge_keys, indices[:, 0] * len(self.nodes) + indices[:, 1])
+
+    def nodes_mask(self, nodes) -> np.ndarray:
+        mask = np.zeros(len(self.nodes), dtype=bool)
+        mask[np.array(tuple(nodes), dtype=np.uint32)] = True
+        return mask
+
+    def get_edge_weights(self, restrictions, options) -> np.ndarray:
+        """
+        Get the weight of every edge (in the order of edge_nodes) for the given restrictions and route options.
+        Edges that can't be used have a weight of infinity.
+        """
+        weights = self.edge_weights.copy()
+        from_nodes, to_nodes = self.edge_nodes.transpose()
 
         # speeds of waytypes, if relevant
         if options['mode'] == 'fastest':
@@ -516,20 +583,18 @@ class Router:
                     speed_up *= options.walk_factor
 
                 for indices, dir_speed in ((waytype.nonupwards_indices, speed), (waytype.upwards_indices, speed_up)):
-                    indices = tuple(indices.transpose().tolist())
-                    values = graph[indices]
-                    values /= dir_speed
+                    positions = self.edge_positions(indices)
+                    weights[positions] /= dir_speed
                     if waytype.extra_seconds:
-                        values += int(waytype.extra_seconds)
-                    graph[indices] = values
+                        weights[positions] += int(waytype.extra_seconds)
 
         # avoid waytypes as specified in settings
         for waytype in self.waytypes[1:]:
             value = options.get('waytype_%s' % waytype.pk, 'allow')
             if value in ('avoid', 'avoid_up'):
-                graph[tuple(waytype.upwards_indices.transpose().tolist())] *= 100000
+                weights[self.edge_positions(waytype.upwards_indices)] *= 100000
             if value in ('avoid', 'avoid_down'):
-                graph[tuple(waytype.nonupwards_indices.transpose().tolist())] *= 100000
+                weights[self.edge_positions(waytype.nonupwards_indices)] *= 100000
 
         # prefer/avoid restrictions
         restrictions_setting = options.get("restrictions", "normal")
@@ -537,32 +602,205 @@ class Router:
             if restrictions_setting == "avoid":
                 factor = 100000
             else:
-                graph *= 100000
+                weights *= 100000
                 factor = 1/100000
             all_restrictions = RouterRestrictionSet(self.restrictions)
-            space_nodes = tuple(reduce(operator.or_, (self.spaces[space].nodes
-                                                      for space in all_restrictions.spaces), set()))
-            graph[space_nodes, :] *= factor
-            graph[:, space_nodes] *= factor
+            space_nodes = self.nodes_mask(reduce(operator.or_, (self.spaces[space].nodes
+                                                                for space in all_restrictions.spaces), set()))
+            weights[space_nodes[from_nodes]] *= factor
+            weights[space_nodes[to_nodes]] *= factor
             if restrictions.additional_nodes:
-                graph[tuple(restrictions.additional_nodes), :] *= factor
-                graph[:, tuple(restrictions.additional_nodes)] *= factor
-            graph[tuple(restrictions.edges.transpose().tolist())] *= factor
+                additional_nodes = self.nodes_mask(restrictions.additional_nodes)
+                weights[additional_nodes[from_nodes]] *= factor
+                weights[additional_nodes[to_nodes]] *= factor
+            weights[self.edge_positions(restrictions.edges)] *= factor
 
         # exclude spaces and edges
-        space_nodes = tuple(reduce(operator.or_, (self.spaces[space].nodes for space in restrictions.spaces), set()))
-        graph[space_nodes, :] = np.inf
-        graph[:, space_nodes] = np.inf
-        if restrictions.additional_nodes:
-            graph[tuple(restrictions.additional_nodes), :] = np.inf
-            graph[:, tuple(restrictions.additional_nodes)] = np.inf
-        graph[tuple(restrictions.edges.transpose().tolist())] = np.inf
+        space_nodes = self.nodes_mask(reduce(operator.or_, (self.spaces[space].nodes
+                                                            for space in restrictions.spaces), set()))
+        excluded_nodes = space_nodes | self.nodes_mask(restrictions.additional_nodes)
+        weights[excluded_nodes[from_nodes] | excluded_nodes[to_nodes]] = np.inf
+        weights[self.edge_positions(restrictions.edges)] = np.inf
 
-        distances, predecessors = self.shortest_path_func(graph, directed=True, return_predecessors=True)
-        cache.set(cache_key, (distances.astype(np.float32).tobytes(),
-                              predecessors.astype(np.int32).tobytes()), 600)
+        return weights
+
+    @staticmethod
+    def shortest_path_filename(update: MapUpdateTuple, restrictions, options) -> Path:
+        key = sha256(('%s:%s' % (restrictions.cache_key, options.serialize_string())).encode()).hexdigest()[:32]
+        return settings.CACHE_ROOT / MapUpdate.build_cache_key(*update) / 'shortest_paths' / key
+
+    def shortest_path(self, restrictions, options):
+        """
+        Calculate the dense all-pairs shortest path matrix. Cached in memcached, but needs memory quadratic to the
+        number of nodes, see sparse_path_finder() for the alternative.
+        Popular combinations are precalculated after each map update, see warm_shortest_paths().
+        """
+        try:
+            filename = self.shortest_path_filename(MapUpdate.last_processed_update(), restrictions, options)
+            return (np.load(filename.with_suffix('.distances.npy'), mmap_mode='r'),
+                    np.load(filename.with_suffix('.predecessors.npy'), mmap_mode='r'))
+        except FileNotFoundError:
+            pass
+
+        options_key = options.serialize_string()
+        cache_key = 'router:shortest_path:%s:%s:%s' % (MapUpdate.current_processed_cache_key(),
+                                                       restrictions.cache_key,
+                                                       options_key)
+        shape = (len(self.nodes), len(self.nodes))
+        result = cache.get(cache_key)
+        if result:
+            distances, predecessors = result
+            return (np.frombuffer(distances, dtype=np.float32).reshape(shape),
+                    np.frombuffer(predecessors, dtype=np.int32).reshape(shape))
+
+        distances, predecessors = self.calculate_shortest_path(restrictions, options)
+        cache.set(cache_key, (distances.tobytes(), predecessors.tobytes()), 600)
         return distances, predecessors
 
+    def calculate_shortest_path(self, restrictions, options) -> tuple[np.ndarray, np.ndarray]:
+        graph = np.full(shape=(len(self.nodes), len(self.nodes)), fill_value=np.inf, dtype=np.float32)
+        graph[tuple(self.edge_nodes.transpose().tolist())] = self.get_edge_weights(restrictions, options)
+
+        distances, predecessors = self.shortest_path_func(graph, directed=True, return_predecessors=True)
+        return distances.astype(np.float32), predecessors.astype(np.int32)
+
+    def warm_shortest_paths(self, update: MapUpdateTuple, configs: Iterable[tuple[set[int], RouteOptions]]):
+        """
+        Precalculate the shortest path matrices for the given permissions and route options and save them
+        to disk for the given update, so routing requests don't have to calculate them.
+        """
+        for permissions, options in configs:
+            restrictions = self.get_restrictions(permissions)
+            filename = self.shortest_path_filename(update, restrictions, options)
+            if filename.with_suffix('.predecessors.npy').exists():
+                continue
+            filename.parent.mkdir(exist_ok=True)
+            distances, predecessors = self.calculate_shortest_path(restrictions, options)
+            for suffix, data in (('.distances.npy', distances), ('.predecessors.npy', predecessors)):
+                # write to a temporary file first, workers might be trying to read this already
+                tmp_filename = filename.with_suffix(suffix + '.tmp')
+                with open(tmp_filename, 'wb') as f:
+                    np.save(f, data)
+                tmp_filename.rename(filename.with_suffix(suffix))
+
+    def get_sparse_graph(self, restrictions, options):
+        from scipy.sparse import csr_matrix
+        weights = self.get_edge_weights(restrictions, options)
+        usable = np.isfinite(weights)
+        return csr_matrix((weights[usable], (self.edge_nodes[usable, 0], self.edge_nodes[usable, 1])),
+                          shape=(len(self.nodes), len(self.nodes)))
+
+    def get_path_finder(self, restrictions, options) -> PathFinder:
+        """
+        Get a function that finds the shortest path from any of the given origin nodes to any of the given
+        destination nodes and returns the best origin node, the best destination node and the nodes of the path
+        between them. Everything that only depends on the restrictions and options is done once, so it can be
+        called repeatedly, e.g. for route matrixes.
+        """
+        return {
+            'matrix': self.dense_path_finder,
+            'dijkstra': self.sparse_path_finder,
+            'cch': self.hierarchy_path_finder,
+        }[settings.ROUTING_ALGORITHM](restrictions, options)
+
+    def sparse_path_finder(self, restrictions, options) -> PathFinder:
+        """
+        Run a multi-source dijkstra from the origin nodes on the sparse graph, once for each set of origin nodes.
+        Memory scales with the number of edges.
+        """
+        graph = self.get_sparse_graph(restrictions, options)
+        results = {}
+
+        def find_path(origin_nodes, destination_nodes):
+            origin_nodes = frozenset(origin_nodes)
+            result = results.get(origin_nodes)
+            if result is None:
+                result = self.dijkstra_func(graph, directed=True, indices=np.array(tuple(origin_nodes)),
+                                            return_predecessors=True, min_only=True)
+                results[origin_nodes] = result
+            distances, predecessors, sources = result
+
+            destination_nodes = np.array(tuple(destination_nodes))
+            destination_node = destination_nodes[distances[destination_nodes].argmin()]
+            if distances[destination_node] == np.inf:
+                raise NoRouteFound
+            origin_node = sources[destination_node]
+
+            path_nodes = deque((destination_node, ))
+            last_node = destination_node
+            while last_node != origin_node:
+                last_node = predecessors[last_node]
+                path_nodes.appendleft(last_node)
+
+            return origin_node, destination_node, tuple(path_nodes)
+
+        return find_path
+
+    @cached_property
+    def hierarchy_metrics(self) -> OrderedDict[str, ContractionHierarchyMetric]:
+        return OrderedDict()
+
+    def get_hierarchy_metric(self, restrictions, options) -> ContractionHierarchyMetric:
+        key = '%s:%s' % (restrictions.cache_key, options.serialize_string())
+        metric = self.hierarchy_metrics.get(key)
+        if metric is None:
+            metric = self.hierarchy.customize(self.get_edge_weights(restrictions, options))
+            self.hierarchy_metrics[key] = metric
+            if len(self.hierarchy_metrics) > self.hierarchy_metrics_size:
+                self.hierarchy_metrics.popitem(last=False)
+        else:
+            self.hierarchy_metrics.move_to_end(key)
+        return metric
+
+    def hierarchy_path_finder(self, restrictions, options) -> PathFinder:
+        """
+        Use the contraction hierarchy. Its metric is customized once per combination of restrictions and route
+        options and then kept in memory, queries only visit a few nodes.
+        """
+        if self.hierarchy is None:
+            # router was built with a different algorithm configured
+            return self.sparse_path_finder(restrictions, options)
+
+        metric = self.get_hierarchy_metric(restrictions, options)
+
+        def find_path(origin_nodes, destination_nodes):
+            distance, path_nodes = self.hierarchy.shortest_path(metric, tuple(origin_nodes), tuple(destination_nodes))
+            if distance == np.inf:
+                raise NoRouteFound
+            return path_nodes[0], path_nodes[-1], path_nodes
+
+        return find_path
+
+    def dense_path_finder(self, restrictions, options) -> PathFinder:
+        """
+        Use the (cached) all-pairs shortest path matrix.
+        """
+        distances, predecessors = self.shortest_path(restrictions, options=options)
+
+        def find_path(origin_nodes, destination_nodes):
+            origin_nodes = np.array(tuple(origin_nodes))
+            destination_nodes = np.array(tuple(destination_nodes))
+            origin_node, destination_node = np.unravel_index(
+                distances[origin_nodes.reshape((-1, 1)), destination_nodes].argmin(),
+                (len(origin_nodes), len(destination_nodes))
+            )
+            origin_node = origin_nodes[origin_node]
+            destination_node = destination_nodes[destination_node]
+
+            if distances[origin_node, destination_node] == np.inf:
+                raise NoRouteFound
+
+            # recreate path
+            path_nodes = deque((destination_node, ))
+            last_node = destination_node
+            while last_node != origin_node:
+                last_node = predecessors[origin_node, last_node]
+                path_nodes.appendleft(last_node)
+
+            return origin_node, destination_node, tuple(path_nodes)
+
+        return find_path
+
     def get_restrictions(self, permissions: set[int]) -> "RouterRestrictionSet":
         return RouterRestrictionSet({
             pk: restriction for pk, restriction in self.restrictions.items() if pk not in permissions
@@ -576,22 +814,48 @@ class Router:
         origins = self.get_locations(origin, restrictions)
         destinations = self.get_locations(destination, restrictions)
 
-        # calculate shortest path matrix
-        distances, predecessors = self.shortest_path(restrictions, options=options)
-
         # find shortest path for our origins and destinations
-        origin_nodes = np.array(tuple(origins.nodes))
-        destination_nodes = np.array(tuple(destinations.nodes))
-        origin_node, destination_node = np.unravel_index(
-            distances[origin_nodes.reshape((-1, 1)), destination_nodes].argmin(),
-            (len(origin_nodes), len(destination_nodes))
-        )
-        origin_node = origin_nodes[origin_node]
-        destination_node = destination_nodes[destination_node]
+        find_path = self.get_path_finder(restrictions, options)
+        return self._route_for_path(origins, destinations, *find_path(origins.nodes, destinations.nodes),
+                                    options=options, visible_locations=visible_locations)
+
+    def get_route_matrix(self, origins: Sequence[Location], destinations: Sequence[Location], permissions: set[int],
+                         options: RouteOptions, visible_locations: Mapping[int, Location]):
+        """
+        Get the routes from every origin to every destination, as a list of rows. Entries are None if there is no
+        route. The shortest path calculation for the restrictions and options is only done once.
+        """
+        restrictions = self.get_restrictions(permissions)
 
-        if distances[origin_node, destination_node] == np.inf:
-            raise NoRouteFound
+        def get_locations(location):
+            try:
+                return self.get_locations(location, restrictions)
+            except LocationUnreachable:
+                return None
+
+        origins = tuple(get_locations(origin) for origin in origins)
+        destinations = tuple(get_locations(destination) for destination in destinations)
+
+        find_path = self.get_path_finder(restrictions, options)
+        result = []
+        for origin in origins:
+            row = []
+            for destination in destinations:
+                route = None
+                if origin is not None and destination is not None:
+                    try:
+                        route = self._route_for_path(origin, destination,
+                                                     *find_path(origin.nodes, destination.nodes),
+                                                     options=options, visible_locations=visible_locations)
+                    except NoRouteFound:
+                        pass
+                row.append(route)
+            result.append(row)
+        return result
 
+    def _route_for_path(self, origins: "RouterLocation", destinations: "RouterLocation",
+                        origin_node: int, destination_node: int, path_nodes: tuple[int, ...],
+                        options: RouteOptions, visible_locations: Mapping[int, Location]) -> Route:
         # get best origin and destination
         origin = origins.get_location_for_node(origin_node)
         destination = destinations.get_location_for_node(destination_node)
@@ -599,18 +863,11 @@ class Router:
         if origin is None or destination is None:
             raise ValueError
 
-        # recreate path
-        path_nodes = deque((destination_node, ))
-        last_node = destination_node
-        while last_node != origin_node:
-            last_node = predecessors[origin_node, last_node]
-            path_nodes.appendleft(last_node)
-
         return Route(
             router=self,
             origin=origin,
             destination=destination,
-            path_nodes=tuple(path_nodes),
+            path_nodes=path_nodes,
             options=options,
             origin_addition=origin.nodes_addition.get(origin_node),
             destination_addition=destination.nodes_addition.get(destination_node),
@@ -769,16 +1026,20 @@ class RouterAltitudeArea:
 
     @cached_property
     def geometry_prep(self):
-        return prepared.prep(self.geometry)
+        return prepared.prep(unwrap_geom(self.geometry))
 
     @cached_property
     def clear_geometry_prep(self):
-        return prepared.prep(self.clear_geometry)
+        return prepared.prep(unwrap_geom(self.clear_geometry))
 
     def get_altitude(self, point: PointCompatible):
         # noinspection PyTypeChecker,PyCallByClass
         return AltitudeArea.get_altitudes(self, (point.x, point.y))[0]
 
+    def get_altitudes(self, points: np.ndarray) -> np.ndarray:
+        # noinspection PyTypeChecker,PyCallByClass
+        return AltitudeArea.get_altitudes(self, points)
+
     def nodes_for_point(self, point: PointCompatible, all_nodes) -> NodeConnectionsByNode:
         point = Point(point.x, point.y)
 
@@ -801,6 +1062,103 @@ class RouterAltitudeArea:
         result = self.__dict__.copy()
         result.pop('geometry_prep', None)
         result.pop('clear_geometry_prep', None)
+        result['geometry'] = WrappedWKBGeometry.wrap(self.geometry)
+        result['clear_geometry'] = WrappedWKBGeometry.wrap(self.clear_geometry)
+        return result
+
+
+@dataclass
+class RouterSpaceGeometries:
+    """
+    The results of the expensive geometry operations for one space.
+    Saved with every router build, so the next build can reuse them if the space was not affected by any changes.
+    """
+    signature: tuple
+    accessible_geometry: Polygon | MultiPolygon
+    clear_geometry: Polygon | MultiPolygon
+    altitudeareas: tuple[RouterAltitudeArea, ...]
+
+    @staticmethod
+    def get_signature(space: Space) -> tuple:
+        # changes to any of these objects are also registered as changed geometries, this is just to be safe
+        return (
+            space.outside,
+            tuple(sorted((column.pk, column.access_restriction_id is None) for column in space.columns.all())),
+            tuple(sorted(hole.pk for hole in space.holes.all())),
+            tuple(sorted(obstacle.pk for obstacle in space.obstacles.all())),
+            tuple(sorted(lineobstacle.pk for lineobstacle in space.lineobstacles.all())),
+        )
+
+    @staticmethod
+    def get_build_args(space: Space, signature: tuple, buildings_geom,
+                       altitudeareas: Sequence[AltitudeArea]) -> tuple:
+        """
+        Collect the arguments for build() as plain geometries, so they can be sent to other processes.
+        """
+        space_geometry = unwrap_geom(space.geometry)
+        space_geometry_prep = prepared.prep(space_geometry)
+        return (
+            signature,
+            space_geometry,
+            # geometries that are not accessible
+            (
+                tuple(unwrap_geom(column.geometry)
+                      for column in space.columns.all()
+                      if column.access_restriction_id is None) +
+                tuple(unwrap_geom(hole.geometry) for hole in space.holes.all()) +
+                ((buildings_geom, ) if space.outside else ())
+            ),
+            # obstacles
+            (
+                tuple(unwrap_geom(obstacle.geometry) for obstacle in space.obstacles.all()) +
+                tuple(unwrap_geom(lineobstacle.buffered_geometry) for lineobstacle in space.lineobstacles.all())
+            ),
+            # altitude areas that touch this space
+            tuple((unwrap_geom(area.geometry), area.altitude, area.points) for area in altitudeareas
+                  if space_geometry_prep.intersects(unwrap_geom(area.geometry))),
+        )
+
+    @classmethod
+    def build_many(cls, args_by_space: dict[int, tuple]) -> dict[int, "RouterSpaceGeometries"]:
+        if not args_by_space:
+            return {}
+        return dict(zip(args_by_space.keys(), fork_map(cls.build, *zip(*args_by_space.values()),
+                                                       processes=settings.ROUTER_BUILD_PROCESSES, chunksize=4)))
+
+    @classmethod
+    def build(cls, signature: tuple, space_geometry: Polygon | MultiPolygon,
+              inaccessible_geometries: Sequence[BaseGeometry], obstacle_geometries: Sequence[BaseGeometry],
+              altitudeareas: Sequence[tuple[Polygon | MultiPolygon, Decimal, Sequence[AltitudeAreaPoint]]]):
+        accessible_geom = space_geometry.difference(unary_union(inaccessible_geometries))
+        obstacles_geom = unary_union(obstacle_geometries)
+        clear_geom = unary_union(tuple(get_rings(accessible_geom.difference(obstacles_geom))))
+
+        router_altitudeareas = []
+        for area_geometry, altitude, points in altitudeareas:
+            for subgeom in assert_multipolygon(accessible_geom.intersection(area_geometry)):
+                if subgeom.is_empty:
+                    continue
+                area_clear_geom = unary_union(tuple(get_rings(subgeom.difference(obstacles_geom))))
+                if area_clear_geom.is_empty:
+                    continue
+                router_altitudeareas.append(RouterAltitudeArea(
+                    geometry=subgeom,
+                    clear_geometry=area_clear_geom,
+                    altitude=altitude,
+                    points=points
+                ))
+
+        return cls(
+            signature=signature,
+            accessible_geometry=accessible_geom,
+            clear_geometry=clear_geom,
+            altitudeareas=tuple(router_altitudeareas),
+        )
+
+    def __getstate__(self):
+        result = self.__dict__.copy()
+        result['accessible_geometry'] = WrappedWKBGeometry.wrap(self.accessible_geometry)
+        result['clear_geometry'] = WrappedWKBGeometry.wrap(self.clear_geometry)
         return result
 
 
@@ -834,6 +1192,54 @@ class RouterNode:
         return np.array((self.x, self.y, self.altitude))
 
 
+@dataclass
+class RouterNodes(Sequence[RouterNode]):
+    """
+    All nodes of the router, stored as flat arrays so they can be memory-mapped.
+    RouterNode objects are only created when a node is accessed.
+    """
+    pk: np.ndarray
+    x: np.ndarray
+    y: np.ndarray
+    altitude: np.ndarray
+    space: np.ndarray
+    areas_indptr: np.ndarray  # areas of node i are areas[areas_indptr[i]:areas_indptr[i+1]]
+    areas: np.ndarray
+
+    @classmethod
+    def from_nodes(cls, nodes: Sequence[RouterNode]) -> "RouterNodes":
+        return cls(
+            pk=np.array(tuple((-1 if node.pk is None else node.pk) for node in nodes), dtype=np.int64),
+            x=np.array(tuple(node.x for node in nodes), dtype=np.float64),
+            y=np.array(tuple(node.y for node in nodes), dtype=np.float64),
+            altitude=np.array(tuple(node.altitude for node in nodes), dtype=np.float64),
+            space=np.array(tuple(node.space for node in nodes), dtype=np.int64),
+            areas_indptr=np.cumsum((0, *(len(node.areas) for node in nodes)), dtype=np.int64),
+            areas=np.array(tuple(chain.from_iterable(sorted(node.areas) for node in nodes)), dtype=np.int64),
+        )
+
+    def __len__(self) -> int:
+        return len(self.x)
+
+    def __getitem__(self, i) -> RouterNode:
+        i = int(i)
+        if not 0 <= i < len(self.x):
+            raise IndexError(i)
+        pk = int(self.pk[i])
+        return RouterNode(
+            i=i,
+            pk=None if pk < 0 else pk,
+            x=float(self.x[i]),
+            y=float(self.y[i]),
+            space=int(self.space[i]),
+            altitude=float(self.altitude[i]),
+            areas=set(self.areas[self.areas_indptr[i]:self.areas_indptr[i+1]].tolist()),
+        )
+
+    def __iter__(self) -> Iterator[RouterNode]:
+        return (self[i] for i in range(len(self)))
+
+
 @dataclass
 class RouterEdge:
     from_node: int
@@ -0,0 +1,58 @@
+import logging
+
+from django.conf import settings
+from django.core.cache import cache
+
+from c3nav.celery import app
+
+logger = logging.getLogger('c3nav')
+
+
+def get_route_config_stats() -> list[tuple[str, int]]:
+    # django's cache api can't list keys, so we have to ask redis directly, like the APIStatsCollector does
+    if settings.CACHES['default']['BACKEND'] != 'django.core.cache.backends.redis.RedisCache':
+        logger.warning('Route config stats can only be read from a redis cache, only the default config is used.')
+        return []
+
+    client = cache._cache.get_client()
+    keys = client.keys(f"*{settings.CACHES['default'].get('KEY_PREFIX', '')}apistats__route_config__*")
+    if not keys:
+        return []
+    return [
+        (key.decode('utf-8').split(':', 2)[2], int(value))
+        for key, value in zip(keys, client.mget(keys)) if value is not None
+    ]
+
+
+def get_popular_route_configs(num: int):
+    """
+    Get the most used combinations of permissions and route options from the route_config api stats.
+    The default combination (no permissions, default options) is always included.
+    """
+    from c3nav.routing.models import RouteOptions
+
+    counts = {('', ''): float('inf')}
+    for key, value in get_route_config_stats():
+        try:
+            permissions, options = key.removeprefix('apistats__route_config__').split('__', 1)
+        except ValueError:
+            continue
+        counts[(permissions, options)] = counts.get((permissions, options), 0) + value
+
+    configs = sorted(counts.items(), key=lambda item: item[1], reverse=True)[:num]
+    return [
+        (set(int(pk) for pk in permissions.split('-') if pk), RouteOptions.unserialize_string(options))
+        for (permissions, options), count in configs
+    ]
+
+
+@app.task(bind=True, max_retries=3)
+def warm_router_cache(self, update):
+    if settings.ROUTING_ALGORITHM != 'matrix' or not settings.ROUTING_WARM_CONFIGS:
+        return
+
+    from c3nav.routing.router import Router
+    update = tuple(update)
+    configs = get_popular_route_configs(settings.ROUTING_WARM_CONFIGS)
+    logger.info('Precalculating shortest paths for %d route configurations...' % len(configs))
+    Router.load_nocache(update).warm_shortest_paths(update, configs)
@@ -0,0 +1,103 @@
+"""
+Pickle objects with their larger numpy arrays stored in a separate flat file next to the pickle. When loading, that
+file is memory-mapped and the arrays become read-only views into it, so loading is cheap and all worker processes on
+a host share the same pages.
+"""
+import mmap
+import os
+import pickle
+import uuid
+from pathlib import Path
+
+import numpy as np
+
+ARRAY_ALIGNMENT = 64
+MIN_MAPPED_ARRAY_SIZE = 1024
+MAPPED_HEADER = 'c3nav-mapped-arrays'
+
+
+def get_arrays_filename(filename: Path) -> Path:
+    # every dump gets its own arrays file, so the pickle and the arrays it points into can be replaced at once
+    return filename.with_name('%s.%s.arrays' % (filename.stem, uuid.uuid4().hex))
+
+
+class MappedArrayPickler(pickle.Pickler):
+    def __init__(self, file, arrays_file):
+        super().__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.arrays_file = arrays_file
+        self.offset = 0
+        self.written = {}
+
+    def persistent_id(self, obj):
+        if type(obj) is not np.ndarray or obj.dtype.hasobject or obj.nbytes < MIN_MAPPED_ARRAY_SIZE:
+            return None
+
+        # the same array might be referenced more than once
+        written = self.written.get(id(obj))
+        if written is not None:
+            return written[1]
+
+        padding = -self.offset % ARRAY_ALIGNMENT
+        self.arrays_file.write(b'\0' * padding)
+        self.offset += padding
+
+        data = np.ascontiguousarray(obj)
+        pid = ('array', self.offset, data.dtype.str, data.shape)
+        self.arrays_file.write(data.data)
+        self.offset += data.nbytes
+
+        self.written[id(obj)] = (obj, pid)
+        return pid
+
+
+class MappedArrayUnpickler(pickle.Unpickler):
+    def __init__(self, file, buffer):
+        super().__init__(file)
+        self.buffer = buffer
+
+    def persistent_load(self, pid):
+        kind, offset, dtype, shape = pid
+        if kind != 'array':
+            raise pickle.UnpicklingError('unsupported persistent object: %r' % kind)
+        dtype = np.dtype(dtype)
+        return np.frombuffer(self.buffer, dtype=dtype, count=int(np.prod(shape)), offset=offset).reshape(shape)
+
+
+def dump_mapped(obj, filename: Path):
+    # the pickle starts with a header naming its arrays file, so replacing the pickle switches both at once.
+    # workers might still have the old arrays file mapped, which stays valid for them after it has been removed.
+    arrays_filename = get_arrays_filename(filename)
+    tmp_filename = filename.with_suffix(filename.suffix + '.tmp')
+    with open(arrays_filename, 'wb') as arrays_file, open(tmp_filename, 'wb') as f:
+        pickle.dump((MAPPED_HEADER, arrays_filename.name), f, protocol=pickle.HIGHEST_PROTOCOL)
+        MappedArrayPickler(f, arrays_file).dump(obj)
+    os.replace(tmp_filename, filename)
+
+    for old_arrays_filename in filename.parent.glob('%s.*.arrays' % filename.stem):
+        if old_arrays_filename != arrays_filename:
+            old_arrays_filename.unlink(missing_ok=True)
+
+
+def _load_mapped(filename: Path):
+    with open(filename, 'rb') as f:
+        header = pickle.load(f)
+        if not (isinstance(header, tuple) and header[:1] == (MAPPED_HEADER, )):
+            # pickled before the arrays were stored separately, it's all in there
+            return header
+        with open(filename.parent / header[1], 'rb') as arrays_file:
+            if os.fstat(arrays_file.fileno()).st_size:
+                # the mapping stays valid after the file is closed
+                buffer = mmap.mmap(arrays_file.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                buffer = b''
+        return MappedArrayUnpickler(f, buffer).load()
+
+
+def load_mapped(filename: Path):
+    try:
+        return _load_mapped(filename)
+    except FileNotFoundError:
+        if not filename.exists():
+            raise
+        # the arrays file was removed by a concurrent dump after we read the header, the new pickle points to its own
+        return _load_mapped(filename)
@@ -179,8 +179,19 @@ SERVE_API = config.getboolean('c3nav', 'serve_api', fallback=SERVE_ANYTHING, env
 # how many location lookups to cache in each worker's in-memory LRU cache proxy
 CACHE_SIZE_LOCATIONS = config.getint('c3nav', 'cache_size_locations', fallback=128)
 CACHE_SIZE_API = config.getint('c3nav', 'cache_size_api', fallback=64)
+# content codings to pre-compress cached API responses with, in order of preference, e.g. zstd,br,gzip
+# (br needs the brotli module). empty to cache and serve them uncompressed
+API_CACHE_ENCODINGS = tuple(encoding.strip()
+                            for encoding in config.get('c3nav', 'api_cache_encodings', fallback='').split(',')
+                            if encoding.strip())
+# whether to write the responses of the heaviest public API endpoints to disk after each map update, pre-compressed
+# with api_cache_encodings (or all available encodings), and serve them from there
+API_SNAPSHOTS = config.getboolean('c3nav', 'api_snapshots', fallback=False)
 
 RENDER_SCALE = config.getfloat('c3nav', 'render_scale', fallback=20.0)
+# how many processes to use for building the render data of all levels and themes after each map update
+RENDERDATA_BUILD_PROCESSES = config.getint('c3nav', 'renderdata_build_processes', fallback=1)
+# svg: generate svg documents and render them with SVG_RENDERER, cairo: draw directly onto a cairo surface
 IMAGE_RENDERER = config.get('c3nav', 'image_renderer', fallback='svg')
 SVG_RENDERER = config.get('c3nav', 'svg_renderer', fallback='rsvg-convert')
 
@@ -189,6 +200,35 @@ WEBP_QUALITY = config.getint('c3nav', 'webp_quality', fallback=95)
 CACHE_TILES = config.getboolean('c3nav', 'cache_tiles', fallback=not DEBUG)
 CACHE_PREVIEWS = config.getboolean('c3nav', 'cache_previews', fallback=not DEBUG)
 CACHE_RESOLUTION = config.getint('c3nav', 'cache_resolution', fallback=4)
+# zoom levels to pre-render the changed tiles for after each map update, e.g. 0,1,2. empty to disable tile seeding
+TILE_SEED_ZOOMS = tuple(int(zoom) for zoom in config.get('c3nav', 'tile_seed_zooms', fallback='').split(',')
+                        if zoom.strip())
+# which formats to pre-render tiles in, e.g. webp,png
+TILE_SEED_FORMATS = tuple(ext.strip() for ext in config.get('c3nav', 'tile_seed_formats', fallback='webp').split(',')
+                          if ext.strip())
+# how many processes to use for pre-rendering tiles
+TILE_SEED_PROCESSES = config.getint('c3nav', 'tile_seed_processes', fallback=1)
+# additional access permission sets to pre-render tiles for, as access restriction ids, e.g. 1,2;3. tiles are always
+# pre-rendered for the public and for the permissions needed to see each restricted level
+TILE_SEED_PERMISSIONS = tuple(frozenset(int(pk) for pk in permissions.split(',') if pk.strip())
+                              for permissions in config.get('c3nav', 'tile_seed_permissions', fallback='').split(';')
+                              if permissions.strip())
+
+# how to find shortest paths: 'matrix' (cached dense all-pairs shortest path matrix), 'dijkstra' (single-source
+# dijkstra on a sparse graph) or 'cch' (customizable contraction hierarchy, preprocessed when building the router)
+ROUTING_ALGORITHM = config.get('c3nav', 'routing_algorithm', fallback='matrix')
+if ROUTING_ALGORITHM not in ('matrix', 'dijkstra', 'cch'):
+    raise ImproperlyConfigured(f'invalid routing algorithm "{ROUTING_ALGORITHM!r}"')
+# how many processes to use for calculating space geometries when rebuilding the router
+ROUTER_BUILD_PROCESSES = config.getint('c3nav', 'router_build_processes', fallback=1)
+# how many of the most used permission/route option combinations to precalculate after each map update
+ROUTING_WARM_CONFIGS = config.getint('c3nav', 'routing_warm_configs', fallback=10)
+# maximum number of origin/destination pairs in one route matrix api request
+ROUTE_MATRIX_MAX_SIZE = config.getint('c3nav', 'route_matrix_max_size', fallback=2500)
+# default solver for range-based positioning: 'basinhopping' or 'levenberg_marquardt' (faster)
+RANGE_LOCATE_SOLVER = config.get('c3nav', 'range_locate_solver', fallback='basinhopping')
+if RANGE_LOCATE_SOLVER not in ('basinhopping', 'levenberg_marquardt'):
+    raise ImproperlyConfigured(f'invalid range locate solver "{RANGE_LOCATE_SOLVER!r}"')
 
 COMPLIANCE_CHECKBOX = config.getboolean('c3nav', 'compliance_checkbox', fallback=False)
 
@@ -425,6 +465,10 @@ with suppress(ImportError):
 
 METRICS = config.getboolean('c3nav', 'metrics', fallback=False)
 METRICS_REDIS_CHUNK_SIZE = config.getint('c3nav', 'metrics_redis_chunk_size', fallback=10)
+# how many api stats increments to collect in each process before writing them to the cache, 0 to write them directly
+API_STATS_BUFFER_SIZE = config.getint('c3nav', 'api_stats_buffer_size', fallback=100)
+# after how many seconds buffered api stats increments are written to the cache at the latest
+API_STATS_FLUSH_INTERVAL = config.getfloat('c3nav', 'api_stats_flush_interval', fallback=10.0)
 if METRICS:
     try:
         import django_prometheus  # noqa
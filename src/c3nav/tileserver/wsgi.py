@@ -5,6 +5,7 @@ import pickle
 import re
 import threading
 import time
+from collections import OrderedDict
 from datetime import datetime
 from email.utils import formatdate
 from io import BytesIO
@@ -12,6 +13,7 @@ from io import BytesIO
 import pylibmc
 import requests
 from pyzstd import decompress as zstd_decompress
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
 
 from c3nav.mapdata.utils.cache import CachePackage
@@ -32,6 +34,66 @@ if os.environ.get('C3NAV_LOGFILE'):
 type Headers = tuple[tuple[str, str], ...]
 
 
+class UpstreamFetch:
+    """
+    An upstream fetch in progress, that concurrent requests for the same tile can wait for.
+    """
+    __slots__ = ('event', 'response', 'exception')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.response = None
+        self.exception = None
+
+    def get_result(self, timeout) -> requests.Response:
+        if not self.event.wait(timeout):
+            raise requests.exceptions.Timeout
+        if self.exception is not None:
+            raise self.exception
+        return self.response
+
+
+class TileCache:
+    """
+    Bounded in-process LRU cache for tiles, evicting the least recently used tiles by their total size in bytes.
+    """
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.size = 0
+        self.data: OrderedDict[str, bytes] = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> bytes | None:
+        with self.lock:
+            data = self.data.get(key)
+            if data is None:
+                self.misses += 1
+                return None
+            self.data.move_to_end(key)
+            self.hits += 1
+            return data
+
+    def set(self, key: str, data: bytes):
+        if len(data) > self.max_size:
+            return
+        with self.lock:
+            old_data = self.data.pop(key, None)
+            if old_data is not None:
+                self.size -= len(old_data)
+            self.data[key] = data
+            self.size += len(data)
+            while self.size > self.max_size:
+                old_key, old_data = self.data.popitem(last=False)
+                self.size -= len(old_data)
+
+    def get_stats(self) -> str:
+        with self.lock:
+            return (f'tile cache: {self.hits} hits, {self.misses} misses, '
+                    f'{len(self.data)} tiles, {self.size} of {self.max_size} bytes')
+
+
 class TileServer:
     def __init__(self):
         self.path_regex = re.compile(r'^/(\d+)/(-?\d+)/(-?\d+)/(-?\d+)(/(-?\d+))?.(png|webp)$')
@@ -44,6 +106,7 @@ class TileServer:
             raise Exception('C3NAV_UPSTREAM_BASE needs to be set.')
 
         self.upstream_timeout = int(os.environ.get('C3NAV_UPSTREAM_TIMEOUT', 5))
+        self.upstream_pool_size = int(os.environ.get('C3NAV_UPSTREAM_POOL_SIZE', 10))
 
         try:
             self.data_dir = os.environ.get('C3NAV_DATA_DIR', 'data')
@@ -66,12 +129,31 @@ class TileServer:
 
         self.reload_interval = int(os.environ.get('C3NAV_RELOAD_INTERVAL', 60))
 
+        # optional in-process tile cache in front of memcached, size in bytes
+        tile_cache_size = int(os.environ.get('C3NAV_TILE_CACHE_SIZE', 0))
+        self.tile_cache = TileCache(tile_cache_size) if tile_cache_size > 0 else None
+
         self.http_auth = os.environ.get('C3NAV_HTTP_AUTH', None)
         if self.http_auth:
             self.http_auth = HTTPBasicAuth(*self.http_auth.split(':', 1))
 
         self.auth_headers = {'X-Tile-Secret': base64.b64encode(self.tile_secret.encode()).decode()}
 
+        # keep upstream connections open, shared by all threads of this worker
+        self.upstream_session = requests.Session()
+        self.upstream_session.headers.update(self.auth_headers)
+        self.upstream_session.auth = self.http_auth
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.upstream_pool_size)
+        self.upstream_session.mount('http://', adapter)
+        self.upstream_session.mount('https://', adapter)
+
+        # upstream fetches in progress by cache key
+        self.upstream_fetches: dict[str, UpstreamFetch] = {}
+        self.upstream_fetches_lock = threading.Lock()
+
+        self.thread_local = threading.local()
+        self.cache_package_lock = threading.Lock()
+
         self.processed_geometry_update = None
         self.cache_package = None
         self.cache_package_etag = None
@@ -148,17 +230,18 @@ class TileServer:
             return False
 
         try:
+            # workers memory-map this file, so loading it is cheap and they all share the same pages
             self.cache_package_filename = os.path.join(
                 self.data_dir,
-                datetime.now().strftime('%Y-%m-%d_%H-%M-%S-%f')+'.pickle'
+                datetime.now().strftime('%Y-%m-%d_%H-%M-%S-%f')+'.package'
             )
             with open(self.cache_package_filename, 'wb') as f:
-                pickle.dump(self.cache_package, f)
+                self.cache_package.write_mapped(f)
             cache.set('cache_package_filename', self.cache_package_filename)
             cache.set('cache_package_last_successful_check', time.time())
         except Exception as e:
             self.cache_package_etag = None
-            logger.error('Saving pickled package failed: %s' % e)
+            logger.error('Saving mapped package failed: %s' % e)
             return False
         return True
 
@@ -226,6 +309,8 @@ class TileServer:
                     text = f'last successful cache package check was {time.time() - last_check}s ago.'.encode('utf-8')
                 else:
                     text = b'last successful cache package check is unknown'
+        if self.tile_cache is not None:
+            text += b'\n' + self.tile_cache.get_stats().encode('utf-8')
         start_response(('500 Internal Server Error' if error else '200 OK'),
                        [self.get_date_header(),
                         ('Content-Type', 'text/plain'),
@@ -243,18 +328,56 @@ class TileServer:
             logger.warning('cache_package_filename went missing.')
             return self.cache_package
         if self.cache_package_filename != cache_package_filename:
-            logger.debug('Loading new cache package in worker.')
-            self.cache_package_filename = cache_package_filename
-            with open(self.cache_package_filename, 'rb') as f:
-                self.cache_package = pickle.load(f)
+            with self.cache_package_lock:
+                if self.cache_package_filename != cache_package_filename:
+                    logger.debug('Loading new cache package in worker.')
+                    if cache_package_filename.endswith('.pickle'):
+                        # written by an older version
+                        with open(cache_package_filename, 'rb') as f:
+                            self.cache_package = pickle.load(f)
+                    else:
+                        self.cache_package = CachePackage.open_mapped(cache_package_filename)
+                    self.cache_package_filename = cache_package_filename
         return self.cache_package
 
     @property
     def cache(self):
-        cache = self.get_cache_client()
-        self.__dict__['cache'] = cache
+        # pylibmc clients are not thread safe, so every thread gets its own
+        cache = getattr(self.thread_local, 'cache', None)
+        if cache is None:
+            cache = self.get_cache_client()
+            self.thread_local.cache = cache
         return cache
 
+    def fetch_upstream(self, cache_key, url) -> tuple[requests.Response, bool]:
+        """
+        Fetch a tile from upstream. Concurrent requests for the same tile wait for the first one to finish instead
+        of having upstream render it again. Returns the response and whether this call fetched it.
+        """
+        with self.upstream_fetches_lock:
+            fetch = self.upstream_fetches.get(cache_key)
+            if fetch is not None:
+                leader = False
+            else:
+                leader = True
+                fetch = UpstreamFetch()
+                self.upstream_fetches[cache_key] = fetch
+
+        if not leader:
+            # requests timeouts are per connect/read, so give the fetch we are waiting for some more time
+            return fetch.get_result(timeout=self.upstream_timeout * 2), False
+
+        try:
+            fetch.response = self.upstream_session.get(url, timeout=self.upstream_timeout)
+        except Exception as e:
+            fetch.exception = e
+            raise
+        finally:
+            with self.upstream_fetches_lock:
+                del self.upstream_fetches[cache_key]
+            fetch.event.set()
+        return fetch.response, True
+
     def __call__(self, env, start_response):
         path_info = env['PATH_INFO']
 
@@ -347,24 +470,32 @@ class TileServer:
             return self.not_modified(start_response, tile_etag, headers=cors_headers)
 
         cache_key = path_info+'_'+tile_etag
+        if self.tile_cache is not None:
+            cached_result = self.tile_cache.get(cache_key)
+            if cached_result is not None:
+                return self.deliver_tile(start_response, tile_etag, cached_result, ext, headers=cors_headers)
+
         try:
             cached_result = self.cache.get(cache_key)
         except pylibmc.Error as e:
             logger.error("Can't read tile from memcached: " + repr(cache_key))
             cached_result = None
         if cached_result is not None:
+            if self.tile_cache is not None:
+                self.tile_cache.set(cache_key, cached_result)
             return self.deliver_tile(start_response, tile_etag, cached_result, ext, headers=cors_headers)
 
         try:
-            r = requests.get(f'{self.upstream_base}/map/{level}/{zoom}/{x}/{y}/{theme_id}/{access_cache_key}.{ext}',
-                             headers=self.auth_headers, auth=self.http_auth, timeout=self.upstream_timeout)
+            r, fetched = self.fetch_upstream(
+                cache_key, f'{self.upstream_base}/map/{level}/{zoom}/{x}/{y}/{theme_id}/{access_cache_key}.{ext}'
+            )
         except requests.exceptions.Timeout:
             if if_none_match:
                 # send 304, even though it's wrong. just display an old tile, sorry.
                 return self.not_modified(start_response, tile_etag, headers=(*cors_headers, ('X-Timeout', 'true')))
             # sorry, can't help you right now.
             return self.service_unavailable(start_response, b'upstream timeout', headers=cors_headers)
-        except ConnectionError:
+        except requests.exceptions.ConnectionError:
             return self.service_unavailable(start_response, b'upstream fetch failed',
                                             headers=cors_headers)
 
@@ -372,10 +503,13 @@ class TileServer:
             if int(r.headers.get('X-Processed-Geometry-Update', 0)) < self.processed_geometry_update:
                 return self.service_unavailable(start_response, b'upstream is outdated',
                                                 headers=cors_headers)
-            try:
-                self.cache.set(cache_key, r.content)
-            except pylibmc.Error as e:
-                logger.error("Can't write tile to cache: " + repr(cache_key))
+            if fetched:
+                try:
+                    self.cache.set(cache_key, r.content)
+                except pylibmc.Error as e:
+                    logger.error("Can't write tile to cache: " + repr(cache_key))
+            if self.tile_cache is not None:
+                self.tile_cache.set(cache_key, r.content)
 
             return self.deliver_tile(start_response, tile_etag, r.content, ext, headers=cors_headers)
 